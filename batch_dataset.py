@@ -0,0 +1,150 @@
+from utils.setup import setup_world, environment
+import main_dataset
+import argparse
+import itertools
+import multiprocessing
+import queue
+import re
+import time
+
+parser = argparse.ArgumentParser(description="Carla Dataset - Batch of routes, maps and weathers")
+parser.add_argument('--maps', type=str, nargs='+', help='Maps', default=["Town01_Opt", "Town02_Opt"])
+parser.add_argument('--routes', type=str, nargs='+', help='Routes', default=["route_1", "route_2", "route_3", "route_4"])
+parser.add_argument('--weathers', type=str, nargs='+', help='Weathers', default=list(environment.weather_types), choices=list(environment.weather_types))
+parser.add_argument('--traffic', type=int, nargs='+', help='Generate traffic (0 and/or 1)', default=[0])
+parser.add_argument('--ports', type=int, nargs='+', help='Ports of the CARLA servers running on this host', default=[2000])
+parser.add_argument('--out_root', type=str, help='Folder to save the data of all the jobs', default="_out/batch")
+# All the other arguments (-f, -l, ...) are passed to main_dataset.py for every job
+
+
+def job_name(job, frames):
+    """
+    Name of the folder of a job, with the same format used by 'create_final_dataset.py',
+    e.g. "T1R1_750_DayClear" for Town01_Opt, route_1 and 750 frames.
+    """
+    town = int(re.findall(r'\d+', job['map'])[0])
+    route = int(re.findall(r'\d+', job['route'])[0])
+    name = f"T{town}R{route}_{frames}_{job['weather']}"
+
+    return name + "_traffic" if job['traffic'] else name
+
+
+def create_jobs(maps, routes, weathers, traffic):
+    """
+    Create the matrix of jobs (map, route, weather, traffic), sorted by map so that
+    the jobs of the same map are run one after the other without reloading the world.
+    """
+    jobs = []
+    for map, route, weather, with_traffic in itertools.product(maps, routes, weathers, traffic):
+        jobs.append({"map": map, "route": route, "weather": weather, "traffic": with_traffic})
+
+    return sorted(jobs, key=lambda job: job['map'])
+
+
+def schedule_jobs(jobs, ports):
+    """
+    Split the jobs (already sorted by map) into contiguous chunks, one for each server,
+    so all the servers are busy and each one loads every map at most once.
+
+    :return: Dictionary {port: [jobs]}
+    """
+    chunk_size = -(-len(jobs) // len(ports))  # Ceil division
+
+    return {port: jobs[i * chunk_size:(i + 1) * chunk_size] for i, port in enumerate(ports)}
+
+
+def run_server_jobs(port, jobs, capture_argv, out_root, results):
+    """
+    Run a list of jobs in the CARLA server of 'port', reusing the same connection for all of them.
+    The map is only loaded when it changes and the weather is changed in place by each job.
+
+    :param port: Port of the CARLA server.
+    :param jobs: List of jobs of this server, sorted by map.
+    :param capture_argv: Arguments passed to the parser of main_dataset.py for every job.
+    :param out_root: Folder where the folder of each job is created.
+    :param results: Queue to send the result of each job to the main process.
+    """
+    # Traffic manager port based on the server port so the servers of the same host don't collide
+    tm_port = port + 6000
+    client = setup_world.connect_client(port=port)
+    world = None
+    current_map = None
+
+    try:
+        for job in jobs:
+            job_args = main_dataset.parser.parse_args(capture_argv)
+            job_args.map = job['map']
+            job_args.route = job['route']
+            job_args.weather = job['weather']
+            job_args.traffic = job['traffic']
+            job_args.port = port
+            job_args.tm_port = tm_port
+            job_args.display = 0
+            job_args.out_dir = f"{out_root}/{job['weather']}/{job_name(job, job_args.frames)}"
+
+            start = time.time()
+            try:
+                if job['map'] != current_map:
+                    world, blueprint_library, traffic_manager = setup_world.setup_carla(job['map'], client, tm_port)
+                    current_map = job['map']
+
+                summary = main_dataset.capture_route(client, world, blueprint_library, traffic_manager, job_args)
+                results.put({"port": port, "job": job_args.out_dir, "ok": True, "time": time.time() - start, **summary})
+            except Exception as e:
+                # Force the map to be set up again, the world may be in an unknown state
+                current_map = None
+                results.put({"port": port, "job": job_args.out_dir, "ok": False, "time": time.time() - start, "error": repr(e)})
+
+    finally:
+        # Leave the server in asynchronous mode so it doesn't freeze waiting for ticks
+        if world is not None:
+            settings = world.get_settings()
+            settings.synchronous_mode = False
+            settings.fixed_delta_seconds = None
+            world.apply_settings(settings)
+
+
+def main():
+    args, capture_argv = parser.parse_known_args()
+
+    jobs = create_jobs(args.maps, args.routes, args.weathers, args.traffic)
+    schedule = schedule_jobs(jobs, args.ports)
+    print(f"Jobs: {len(jobs)} | Servers: {len(args.ports)}")
+
+    results = multiprocessing.Queue()
+    workers = []
+    for port, server_jobs in schedule.items():
+        if not server_jobs:
+            continue
+        print(f"Port {port}: {len(server_jobs)} jobs")
+        worker = multiprocessing.Process(target=run_server_jobs, args=(port, server_jobs, capture_argv, args.out_root, results))
+        worker.start()
+        workers.append(worker)
+
+    summaries = []
+    while len(summaries) < len(jobs):
+        try:
+            summary = results.get(timeout=10)
+        except queue.Empty:
+            # Stop waiting if all the workers died without sending the remaining results
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        summaries.append(summary)
+
+        if summary['ok']:
+            print(f"[{len(summaries)}/{len(jobs)}] {summary['job']}: {summary['frames']} frames ({summary['skipped']} ticks skipped, {summary['ticks_per_second']:.1f} ticks/s) in {summary['time']:.0f}s (port {summary['port']})")
+        else:
+            print(f"[{len(summaries)}/{len(jobs)}] {summary['job']}: FAILED (port {summary['port']}) -> {summary['error']}")
+
+    for worker in workers:
+        worker.join()
+
+    failed = [summary['job'] for summary in summaries if not summary['ok']]
+    print(f"\nJobs done: {len(summaries) - len(failed)}/{len(jobs)}")
+    for job in failed:
+        print(f"Failed: {job}")
+
+
+if __name__ == '__main__':
+    main()
@@ -101,7 +101,7 @@ def main():
         # "DayClear" | "DayCloudy" | "DayRain" | "NigthCloudy"
         environment.weather_environment("DayClear", world)
         
-        vehicle = spawn_vehicle.spawn_vehicle(world, blueprint_library)        
+        vehicle = spawn_vehicle.spawn_vehicle(world, blueprint_library, traffic_manager)        
         traffic_manager.ignore_lights_percentage(vehicle, 100)  # Ignore all the red ligths
 
         
@@ -1,7 +1,11 @@
 from utils.setup import setup_world, environment
 from utils.spawn import spawn_sensor, spawn_vehicle
 from utils.ground_truth import ground_truth as ground_truth
-from utils.gennerate_traffic import gennerate_traffic
+from utils.ground_truth import region_of_interest, voxel_map, free_space, occupancy_pyramid
+from utils.gennerate_traffic import gennerate_traffic, route_traffic
+from utils.capture import keyframe, depth_storage, rgb_writer
+from utils.lidar import lidar_voxel, lidar_storage, range_image
+from utils.profiling import stage_timer
 import argparse
 import carla
 import queue
@@ -9,14 +13,43 @@ import cv2
 import numpy as np
 import open3d as o3d
 import time
+import os
 
 parser = argparse.ArgumentParser(description="Carla Dataset")
 parser.add_argument('-l', '--leaf_size', type=float, help='Leaf size for downsampling', default=0.2)
 parser.add_argument('-f', '--frames', type=int, help='Number of frames to get data from the sensors', default=750)
 parser.add_argument('-t', '--traffic', type=int, help='Generate traffic', default=0)
+parser.add_argument('--traffic_radius', type=float, help='Only keep the traffic within this distance in meters of the route (0 = traffic in all the map)', default=0)
 parser.add_argument('-m', '--map', type=str, help='Map', default="Town01_Opt")
 parser.add_argument('-r', '--route', type=str, help='Route', default="route_1")
-args = parser.parse_args()
+parser.add_argument('-w', '--weather', type=str, help='Weather', default="NightCloudy", choices=list(environment.weather_types))
+parser.add_argument('-p', '--port', type=int, help='Port of the CARLA server', default=2000)
+parser.add_argument('--tm_port', type=int, help='Port of the traffic manager', default=8000)
+parser.add_argument('-o', '--out_dir', type=str, help='Folder to save the data', default="_out")
+parser.add_argument('-d', '--display', type=int, help='Show the RGB camera output (press "Q" to stop)', default=1)
+parser.add_argument('--kf_distance', type=float, help='Only save a frame when the vehicle moved this distance in meters (0 = every frame)', default=0)
+parser.add_argument('--kf_yaw', type=float, help='Only save a frame when the vehicle turned this angle in degrees (0 = every frame)', default=0)
+parser.add_argument('--profile', type=int, help='Measure the time of each stage of the loop (saved in OUT_DIR/profile)', default=0)
+parser.add_argument('--kf_interval', type=int, help='Maximum number of ticks between saved frames when --kf_distance/--kf_yaw are used', default=20)
+parser.add_argument('--float32', type=int, help='Process the point clouds in float32 with reused buffers (less memory, faster)', default=0)
+parser.add_argument('--profile_memory', type=int, help='Also measure the peak memory of each frame with --profile (slower)', default=0)
+parser.add_argument('--roi', type=str, help='Region of interest of the ground truth, the points outside are culled before downsampling', default="none", choices=list(region_of_interest.roi_shapes))
+parser.add_argument('--roi_xy', type=float, help='Half of the size of the ROI box or radius of the ROI cylinder in meters', default=40.0)
+parser.add_argument('--accumulate', type=int, help='Also save the occupancy grid of the ground truth accumulated over the frames (in OUT_DIR/ground_truth_map)', default=0)
+parser.add_argument('--map_distance', type=float, help='Distance in meters from the vehicle of the voxels kept in the accumulated map', default=100.0)
+parser.add_argument('--map_voxel_size', type=float, help='Voxel size in meters of the accumulated map', default=0.2)
+parser.add_argument('--free_space', type=int, help='Also save the grid with the voxels labeled as unknown (0), occupied (1) or free (2) (in OUT_DIR/ground_truth_labels)', default=0)
+parser.add_argument('--lidar_voxel', type=int, help='Also save the lidar voxel grid with the count, mean height and mean intensity of the points (in OUT_DIR/lidar_voxel)', default=0)
+parser.add_argument('--depth_format', type=str, help='Format of the depth images: logarithmic PNG, uint16 millimeters or float16 meters (.npz)', default="png", choices=list(depth_storage.DEPTH_FORMATS))
+parser.add_argument('--downsample_kernel', type=str, help='Voxel grid of the downsampling: pcl (libpcl_downsample) or native (libvoxel_downsample, multi-threaded with OpenMP, without PCL)', default="pcl", choices=list(ground_truth.DOWNSAMPLE_KERNELS))
+parser.add_argument('--pyramid_levels', type=int, help='Number of resolutions of the ground truth voxel grid (each level doubles the voxel size), saved in the same file', default=1)
+parser.add_argument('--range_image', type=int, help='Also save the range image of the lidar with the range, intensity and valid mask of each ray (in OUT_DIR/lidar_range)', default=0)
+parser.add_argument('--lidar_format', type=str, help='Format of the lidar points: float64 (only the points), int16 centimeters or float16 meters, with the uint8 intensity', default="float64", choices=list(lidar_storage.LIDAR_FORMATS))
+parser.add_argument('--rgb_codec', type=str, help='Codec of the RGB images, encoded out of the loop (raw = all the images of the route in OUT_DIR/rgb_raw/rgb.u8)', default="png", choices=list(rgb_writer.RGB_CODECS))
+parser.add_argument('--png_level', type=int, help='Compression level of the PNG RGB images (0-9)', default=3)
+parser.add_argument('--rgb_quality', type=int, help='Quality of the JPEG and WebP RGB images (0-100)', default=90)
+parser.add_argument('--rgb_workers', type=int, help='Number of threads encoding the RGB images', default=2)
+parser.add_argument('--roi_z', type=float, nargs=2, help='Minimum and maximum height of the ROI in meters (relative to the sensors)', default=[-4.0, 2.4])
 
 
 lidar_attributes = {
@@ -66,78 +99,35 @@ ROUTES_TOWN2 = {
     "route_4": [44, 51, 72, 41, 24, 67]
 }
 
+out_folders = ["rgb", "depth", "lidar", "lidar_points", "ground_truth", "ground_truth_voxel"]
 
-def lidar_transformation(extrinsic, image_queue_lidar):
+
+def create_out_folders(out_dir, extra_folders=(), skip_folders=()):
+    # Create the folders to save the data if they don't exist
+    for folder in [folder for folder in out_folders if folder not in skip_folders] + list(extra_folders):
+        os.makedirs(f"{out_dir}/{folder}", exist_ok=True)
+
+
+def lidar_transformation(lidar_data, dtype=np.float64):
     """
-    The function 'lidar_transformation' transforms raw lidar data into a point cloud, applies various
-    rotations and translations to fit into ground truth point cloud. Turn into the world coordinates.
+    The function 'lidar_transformation' transforms raw lidar data into the points of the ego frame, the frame
+    of the lidar with the axes of the vehicle (X forward, Y left and Z up). The ground truth is transformed
+    to the same frame with the poses of the sensors (see 'get_ground_truth'), so no other alignment is needed.
     
-    :param extrinsic: Represents the extrinsic calibration matrix that describes the transformation between 
-                      the lidar sensor and the camera coordinate systems. It is used to calculate the rotation
-                      around the Z-axis based on the ground truth camera data.
-    :param image_queue_lidar: Is the queue that holds a byte array that contains the raw lidar data.
+    :param lidar_data: Is the lidar measurement, with a byte array that contains the raw lidar data.
+    :param dtype: Type used to transform the points (np.float32 to use half of the memory).
     
-    :return: The function 'lidar_transformation' returns two values:
-    1. 'lidar_pcl': An Open3D PointCloud object that represents the transformed lidar point cloud.
-    2. 'center_lidar': A numpy array containing the coordinates of the origin of the lidar point cloud after transformation.
+    :return: Array (N, 3) with the lidar points in the ego frame, in the order of the measurement.
     """
     
-    lidar_pcl = o3d.geometry.PointCloud()
-    
-    lidar_data = image_queue_lidar.get()
-    raw_data = lidar_data.raw_data
-    
-    point_cloud_array = np.frombuffer(raw_data, dtype=np.float32)
-    point_cloud_array = np.reshape(point_cloud_array, (int(point_cloud_array.shape[0] / 4), 4))            
-    point_cloud_array = np.delete(point_cloud_array, 3, 1)
-    
-    
-# Fix the lidar point cloud transformation to world coordinates
-    yaw_90 = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]])   # Yaw = 90º
-    point_cloud_array = np.dot(point_cloud_array, yaw_90) 
-    
-    point_cloud_array[:, 2] = -point_cloud_array[:, 2]      # Z = -Z
-
-    
-    lidar_pcl.points = o3d.utility.Vector3dVector(point_cloud_array)
-    
-# Transform the point cloud to the camera coordinate system
-    # Rotation of 180 in the X axis
-    x_180 = np.array([[1,  0,  0],
-                      [0, -1,  0],
-                      [0,  0, -1]])
-    lidar_pcl.rotate(x_180, center=(0, 0, 0)) 
-    
-    # Rotation of 180 in the Y axis
-    y_180 = np.array([[-1,  0,  0],
-                      [ 0, -1,  0],
-                      [ 0,  0,  1]])
-    lidar_pcl.rotate(y_180, center=(0, 0, 0)) 
-    
-    # Rotation of (Extract rotation around Z-axis of the ground truth camera) in the Z axis
-    theta_z = np.arctan2(extrinsic[1, 0], extrinsic[0, 0])
-    z_rotation = np.array([
-        [np.cos(theta_z), -np.sin(theta_z), 0],
-        [np.sin(theta_z), np.cos(theta_z),  0],
-        [0,               0,                1]
-    ])
-    lidar_pcl.rotate(z_rotation, center=(0, 0, 0))
+    point_cloud_array = np.frombuffer(lidar_data.raw_data, dtype=np.float32)
+    point_cloud_array = np.reshape(point_cloud_array, (int(point_cloud_array.shape[0] / 4), 4))
     
-
-    point_cloud_color = np.full((len(lidar_pcl.points),3), np.array([0,0,255]))  # All points are BLUE
-    point_cloud_array = np.vstack([np.array(lidar_pcl.points), [0, 0, 0]])       # Add point 0,0,0 (origin)
-    point_cloud_color = np.vstack([point_cloud_color, [255, 0, 0]])              # The (0,0,0) point is RED
-    
-    # Put the center of the point cloud in the origin
-    centroid = np.mean(np.array(point_cloud_array), axis=0)
-    point_cloud_array = point_cloud_array - centroid
-    
-    lidar_pcl.points = o3d.utility.Vector3dVector(point_cloud_array)
-    lidar_pcl.colors = o3d.utility.Vector3dVector(point_cloud_color)
-        
-    center_lidar = point_cloud_array[-1] # Get the origin coordinates of the lidar point cloud
+    # The lidar of CARLA has the Y axis to the right (left-handed), the ego frame has it to the left
+    points = point_cloud_array[:, :3].astype(dtype)    # Without the intensity
+    points[:, 1] *= -1
     
-    return lidar_pcl, center_lidar
+    return points
         
         
 """ def update_image(vis, image):
@@ -149,154 +139,166 @@ def lidar_transformation(extrinsic, image_queue_lidar):
 
     return False """
         
-def get_ground_truth(queue_list, depth_camera_list):
+def get_ground_truth(queue_list, depth_camera_list, display=True, dtype=np.float64, workspace=None, roi=None, ego_matrix=None):
     """
     The function 'get_ground_truth' processes depth images from multiple cameras to generate a point cloud.
     
     :param queue_list: Dictionary containing queues for different types of depth images.
     :param depth_camera_list: Dictionary containing depth camera objects for front, right, left, and back cameras.
+    :param display: If True, show the output of the front RGB camera.
+    :param dtype: Type of the points and colors (np.float32 to use half of the memory).
+    :param workspace: Dictionary with the buffers reused between frames (see 'ground_truth.get_buffer'),
+                      if given the points and colors returned are overwritten in the next frame.
+    :param roi: Region of interest around the cameras (see 'region_of_interest.create_roi'), the pixels outside are culled.
+    :param ego_matrix: Pose (4x4) of the ego frame in the world (see 'ground_truth.get_sensor_matrices'), the pose of
+                       the lidar in main_dataset.py. If None, the ego frame is in the front camera (axes of the vehicle).
     
     :return: The function `ground_truth` returns three values:
-    1. `points`: A numpy array containing the 3D points in the world space for all four cameras.
+    1. `points`: A numpy array containing the 3D points in the ego frame for all four cameras.
     2. `colors`: A numpy array containing the color information (RGB) corresponding to each 3D point.
-    3. `front_extrinsic_matrix`: The extrinsic matrix corresponding to the front camera.
+    3. `front_to_ego`: The matrix (4x4) from the front camera to the ego frame (the origin of the cameras is its translation).
     """
+    cameras = ["front", "right", "left", "back"]
         
-    front_depth_image = queue_list['image_queue_depth_front'].get()
-    right_depth_image = queue_list['image_queue_depth_right'].get()
-    left_depth_image = queue_list['image_queue_depth_left'].get()
-    back_depth_image = queue_list['image_queue_depth_back'].get()
+    with stage_timer.stage("queue_wait"):
+        depth_images = {camera: queue_list[f'image_queue_depth_{camera}'].get() for camera in cameras}
+        front_rbg_image = queue_list['image_queue_rgb_front'].get()
     
     # Show the RGB image
-    front_rbg_image = queue_list['image_queue_rgb_front'].get()
-    front_rbg_image = np.reshape(np.copy(front_rbg_image.raw_data), (front_rbg_image.height, front_rbg_image.width, 4))
-    cv2.imshow('RGB Camera Front Output', front_rbg_image)
+    if display:
+        front_rbg_image = np.reshape(np.copy(front_rbg_image.raw_data), (front_rbg_image.height, front_rbg_image.width, 4))
+        cv2.imshow('RGB Camera Front Output', front_rbg_image)
 
     """ update_image(vis, front_rbg_image)
     vis.poll_events()
     vis.update_renderer() """
 
-    # Get the intrinsic and extrinsic matrix of the 4 cameras
-    front_intrinsic_matrix, front_extrinsic_matrix = ground_truth.get_intrinsic_extrinsic_matrix(depth_camera_list['front_depth_camera'], front_depth_image)
-    right_intrinsic_matrix, right_extrinsic_matrix = ground_truth.get_intrinsic_extrinsic_matrix(depth_camera_list['right_depth_camera'], right_depth_image)
-    left_intrinsic_matrix, left_extrinsic_matrix = ground_truth.get_intrinsic_extrinsic_matrix(depth_camera_list['left_depth_camera'], left_depth_image)
-    back_intrinsic_matrix, back_extrinsic_matrix = ground_truth.get_intrinsic_extrinsic_matrix(depth_camera_list['back_depth_camera'], back_depth_image)
-
-    # Get the points [[X...], [Y...], [Z...]] and the colors [[R...], [G...], [B...]]
-    front_points_3D, front_color = ground_truth.point2D_to_point3D(front_depth_image, front_intrinsic_matrix)
-    right_points_3D, right_color = ground_truth.point2D_to_point3D(right_depth_image, right_intrinsic_matrix)
-    left_points_3D, left_color = ground_truth.point2D_to_point3D(left_depth_image, left_intrinsic_matrix)
-    back_points_3D, back_color = ground_truth.point2D_to_point3D(back_depth_image, back_intrinsic_matrix)
-    
-    # To multiply by the extrinsic matrix (same shape as the extrinsic_matrix matrix)
-    front_p3d = np.concatenate((front_points_3D, np.ones((1, front_points_3D.shape[1]))))
-    right_p3d = np.concatenate((right_points_3D, np.ones((1, right_points_3D.shape[1]))))
-    left_p3d = np.concatenate((left_points_3D, np.ones((1, left_points_3D.shape[1]))))
-    back_p3d = np.concatenate((back_points_3D, np.ones((1, back_points_3D.shape[1]))))
-
-    # Get the 3D points in the world
-    front_p3d_world = np.dot(front_extrinsic_matrix, front_p3d)[:3]
-    right_p3d_world = np.dot(right_extrinsic_matrix, right_p3d)[:3]
-    left_p3d_world = np.dot(left_extrinsic_matrix, left_p3d)[:3]
-    back_p3d_world = np.dot(back_extrinsic_matrix, back_p3d)[:3]
-
-    # Reshape the array to (height * width, 3) -> X, Y and Z for each point
-    front_p3d_world = np.transpose(front_p3d_world)
-    right_p3d_world = np.transpose(right_p3d_world)
-    left_p3d_world = np.transpose(left_p3d_world)
-    back_p3d_world = np.transpose(back_p3d_world)
-    
-    points = np.concatenate((front_p3d_world, right_p3d_world, left_p3d_world, back_p3d_world))
-    colors = np.concatenate((front_color, right_color, left_color, back_color))
-    
-    # Put the center of the point cloud in the origin
-    centroid = np.mean(points, axis=0)
-    points = points - centroid
+    # Get the intrinsic and extrinsic matrix of the 4 cameras, with the pose of each camera saved in its image
+    with stage_timer.stage("camera_pose"):
+        transforms = [ground_truth.get_camera_transform(depth_camera_list[f'{camera}_depth_camera'], depth_images[camera]) for camera in cameras]
+        extrinsic_matrices = ground_truth.get_extrinsic_matrices(transforms)
+        if ego_matrix is None:
+            ego_matrix = extrinsic_matrices[0] @ ground_truth.CAMERA_TO_VEHICLE.T
+        
+        # Cameras to the ego frame (the inverse of the pose of the ego frame times the extrinsic matrix of each camera)
+        camera_to_ego = ground_truth.invert_pose(ego_matrix) @ extrinsic_matrices
+        matrices = {camera: (ground_truth.get_intrinsic_matrix(depth_images[camera].width, depth_images[camera].height, getattr(depth_images[camera], 'fov', 90.0)),
+                             camera_to_ego[i]) for i, camera in enumerate(cameras)}
+
+    # Back-projection of the depth images to 3D points in the ego frame
+    with stage_timer.stage("back_projection"):
+        # Buffers with space for all the pixels of the 4 cameras
+        max_points = sum(image.width * image.height for image in depth_images.values())
+        points = ground_truth.get_buffer(workspace, "points", (max_points, 3), dtype)
+        colors = ground_truth.get_buffer(workspace, "colors", (max_points, 3), dtype)
+        
+        n_points = 0
+        for camera in cameras:
+            intrinsic_matrix, camera_matrix = matrices[camera]
+            
+            # Get the points [[X...], [Y...], [Z...]] and the colors [[R...], [G...], [B...]]
+            points_3D, color = ground_truth.point2D_to_point3D(depth_images[camera], intrinsic_matrix, dtype, roi, camera_matrix[:3, :3])
+            camera_points = points[n_points:n_points + points_3D.shape[1]]
+            
+            # Get the 3D points in the ego frame (rotation + translation of the camera), written directly
+            # in the point cloud with shape (height * width, 3) -> X, Y and Z for each point
+            np.matmul(points_3D.T, camera_matrix[:3, :3].T.astype(dtype), out=camera_points)
+            camera_points += camera_matrix[:3, 3].astype(dtype)
+            colors[n_points:n_points + points_3D.shape[1]] = color
+            
+            n_points += points_3D.shape[1]
+        
+        points = points[:n_points]
+        colors = colors[:n_points]
     
-    return points, colors, front_extrinsic_matrix
+    return points, colors, matrices["front"][1]
 
 
-def occupancy_grid_map(points, voxel_size=0.4, max_range_X_Y=40, min_range_Z=-4, max_range_Z=2.4):
+def capture_route(client, world, blueprint_library, traffic_manager, args):
     """
-    A function that generates an occupancy grid map based on the input points, voxel size, and grid dimensions. 
-    It initializes the grid, converts the point cloud to voxel coordinates, and marks the occupied voxels.
-    
-    Parameters:
-    - points: numpy array, representing the input points
-    - voxel_size: float, the size of each voxel
-    - max_range_X_Y: int, the maximum range in X and Y axes
-    - min_range_Z: int, the minimum range in the Z axis
-    - max_range_Z: float, the maximum range in the Z axis
-    
-    Returns:
-    - occupancy_grid: numpy array, the final occupancy grid map
+    The function 'capture_route' drives the vehicle through one route of the current map, with the
+    weather 'args.weather' (changed in place, without reloading the map), and saves the RGB, depth,
+    lidar and ground truth data of 'args.frames' frames in 'args.out_dir'.
+    With the keyframe options ('args.kf_*'), the ticks where the vehicle didn't move or turn enough
+    are skipped (no ground truth is computed and nothing is saved).
+    All the actors spawned are destroyed at the end, so the same world can be used for the next route.
+    
+    :param client: The CARLA client, the traffic is spawned and all the actors destroyed with batches of commands.
+    :param world: The CARLA world, already with the map 'args.map' loaded.
+    :param blueprint_library: The blueprint library of the world.
+    :param traffic_manager: The traffic manager of the server.
+    :param args: Namespace with the options of 'parser'.
+    
+    :return: Dictionary with the summary of the run (number of frames saved, ticks, skipped ticks and ticks per second of the server).
     """
-    
-    
-    
-    # 80 meters in X and Y and 6.4 meters in Z
-    min_bound = np.array([-max_range_X_Y, -max_range_X_Y, min_range_Z])
-    max_bound = np.array([max_range_X_Y, max_range_X_Y, max_range_Z])
-    
-    # Compute the grid dimensions
-    grid_size = np.ceil((max_bound - min_bound) / voxel_size).astype(int)
-    
-    # Initialize the occupancy grid
-    occupancy_grid = np.zeros(grid_size, dtype=np.int8)
-    
-    # Convert point cloud to voxel coordinates
-    voxel_indices = np.floor((points - min_bound) / voxel_size).astype(int)
-    
-    # Mark the voxels as occupied
-    for idx in voxel_indices:
-        # verify if the point is inside the grid
-        if (idx[0] >= 0) and (idx[0] < grid_size[0]) and (idx[1] >= 0) and (idx[1] < grid_size[1]) and (idx[2] >= 0) and (idx[2] < grid_size[2]):
-            occupancy_grid[tuple(idx)] = 1
-            
-    return occupancy_grid
-
-
-    
-def main():
     actor_list = []
+    controllers_list = []
     pcl_downsampled = o3d.geometry.PointCloud()
+    lidar_pcl = o3d.geometry.PointCloud()
     cc = carla.ColorConverter.LogarithmicDepth
-    
-    # "Town01_Opt" | "Town02_Opt"
-    map = args.map
+    out_dir = args.out_dir
     
     # "ROUTES_TOWN1" -> (route_1, route_2, route_3, route_4)
     # "ROUTES_TOWN2" -> (route_1, route_2, route_3, route_4)
-    route_town = ROUTES_TOWN1 if map == "Town01_Opt" else ROUTES_TOWN2
+    route_town = ROUTES_TOWN1 if args.map == "Town01_Opt" else ROUTES_TOWN2
     route = args.route
 
     # Options: "DayClear" | "DayCloudy" | "DayRain" | "NightCloudy"
-    weather_type = "NightCloudy"
+    weather_type = args.weather
+    
+    extra_folders = []
+    if args.accumulate:
+        extra_folders.append("ground_truth_map")
+    if args.free_space:
+        extra_folders.append("ground_truth_labels")
+    if args.lidar_voxel:
+        extra_folders.append("lidar_voxel")
+    if args.range_image:
+        extra_folders.append("lidar_range")
+    # The raw RGB stream in its own folder, the readers of "rgb" match one file per sample with the other folders
+    rgb_folder = rgb_writer.RAW_FOLDER if args.rgb_codec == "raw" else "rgb"
+    create_out_folders(out_dir, extra_folders + [rgb_folder], skip_folders=("rgb",))
+    if args.profile or args.profile_memory:
+        stage_timer.enable_profiling(memory=bool(args.profile_memory))
+
+    # Precision of the point clouds and buffers reused between frames (only with float32)
+    dtype = np.float32 if args.float32 else np.float64
+    workspace = {} if args.float32 else None
+    roi = region_of_interest.create_roi(args.roi, args.roi_xy, args.roi_z)
+    # Map of the ground truth accumulated over the frames of the route
+    ground_truth_map = voxel_map.create_voxel_map(args.map_voxel_size, args.map_distance) if args.accumulate else None
+    # The RGB images are encoded and saved by a pool of threads
+    rgb_images = rgb_writer.create_rgb_writer(f'{out_dir}/{rgb_folder}', args.rgb_codec, args.png_level, args.rgb_quality, args.rgb_workers)
 
     try:
-        world, blueprint_library, traffic_manager = setup_world.setup_carla(map)
         environment.weather_environment(weather_type, world)
         
         vehicle, spawn_point = spawn_vehicle.spawn_vehicle_route(world, blueprint_library, traffic_manager, route_town, route, weather_type)
+        actor_list.append(vehicle)
         
         # Gennerate traffic
-        if args.traffic:
-            vehicles_list = gennerate_traffic.gennerate_vehicles(world, traffic_manager, blueprint_library, spawn_point)
-            pedestrians_list, controllers_list = gennerate_traffic.gennerate_pedestrians(world, blueprint_library)
+        traffic = None
+        if args.traffic and args.traffic_radius > 0:
+            # Traffic only around the route, the actors left behind are moved ahead of the vehicle
+            traffic = route_traffic.create_route_traffic(client, world, traffic_manager, blueprint_library, spawn_point,
+                                                         route_town[route], args.traffic_radius)
+            controllers_list = traffic['controllers']
+            actor_list += traffic['vehicles'] + traffic['pedestrians']
+        elif args.traffic:
+            traffic_manager.set_hybrid_physics_mode(False)
+            vehicles_list = gennerate_traffic.gennerate_vehicles(client, world, traffic_manager, blueprint_library, spawn_point)
+            pedestrians_list, controllers_list = gennerate_traffic.gennerate_pedestrians(client, world, blueprint_library)
+            actor_list += vehicles_list + pedestrians_list
 
         # Spawn RGB, Depth and Lidar sensors
         camera_rgb = spawn_sensor.spawn_sensores('sensor.camera.rgb', world, blueprint_library, vehicle, camera_attributes)
         camera_depth = spawn_sensor.spawn_sensores('sensor.camera.depth', world, blueprint_library, vehicle, camera_attributes)
         camera_lidar = spawn_sensor.spawn_sensores('sensor.lidar.ray_cast', world, blueprint_library, vehicle, lidar_attributes)
+        actor_list.extend([camera_rgb, camera_depth, camera_lidar])
         # Spawn cameras to get the ground truth
         front_depth_camera, front_rgb_camera, right_depth_camera, left_depth_camera, back_depth_camera = ground_truth.spawn_cameras(world, blueprint_library, vehicle, 1280, 960)
+        actor_list.extend([front_depth_camera, front_rgb_camera, right_depth_camera, left_depth_camera, back_depth_camera])
         print("Sensors spawned!")
-                
-        # Add the actors to the list
-        actor_list.extend([vehicle, camera_rgb, camera_depth, camera_lidar, front_depth_camera, front_rgb_camera, right_depth_camera, left_depth_camera, back_depth_camera])
-        actor_list.extend([vehicle, camera_rgb, camera_depth])
-        if args.traffic:
-            actor_list += vehicles_list + pedestrians_list
 
     # Queues to get the data
         image_queue_rgb = queue.Queue()
@@ -319,18 +321,46 @@ def main():
         left_depth_camera.listen(image_queue_depth_left.put)
         back_depth_camera.listen(image_queue_depth_back.put)
         
+        sensor_queues = [image_queue_rgb, image_queue_depth, image_queue_lidar, image_queue_rgb_front,
+                         image_queue_depth_front, image_queue_depth_right, image_queue_depth_left, image_queue_depth_back]
+        
+        keyframe_policy = keyframe.create_keyframe_policy(args.kf_distance, args.kf_yaw, args.kf_interval)
+        
 
         #vis = o3d.visualization.Visualizer()
         #vis.create_window()
 
         frame = 0
-        while cv2.waitKey(1) != ord('q'):
-        #while True:
+        ticks = 0
+        skipped = 0
+        tick_time = 0.0
+        while True:
+            
+            if args.display and cv2.waitKey(1) == ord('q'):
+                break
                         
             if frame == args.frames:
                 break
                             
-            world.tick()
+            ticks += 1
+            stage_timer.set_frame(ticks)
+            with stage_timer.stage("tick"):
+                tick_start = time.perf_counter()
+                world.tick()
+                tick_time += time.perf_counter() - tick_start
+            
+            if traffic is not None:
+                with stage_timer.stage("traffic"):
+                    route_traffic.update_route_traffic(client, traffic, vehicle)
+            
+            # Skip the frames where the vehicle is (almost) in the same pose of the last saved frame
+            if not keyframe.is_keyframe(keyframe_policy, vehicle.get_transform()):
+                with stage_timer.stage("queue_wait"):
+                    for sensor_queue in sensor_queues:
+                        sensor_queue.get()  # Discard the data of this tick to keep the queues in sync
+                skipped += 1
+                continue
+            
             frame += 1
 
         # GROUND TRUTH
@@ -341,76 +371,141 @@ def main():
             depth_camera_list = {"front_depth_camera": front_depth_camera, "right_depth_camera": right_depth_camera, 
                                  "left_depth_camera": left_depth_camera, "back_depth_camera": back_depth_camera}
             
-            points, colors, extrinsic = get_ground_truth(queue_list, depth_camera_list)           
+            # The ego frame is the frame of the lidar, with its pose saved in the measurement (same tick of the cameras)
+            with stage_timer.stage("queue_wait"):
+                lidar_data = image_queue_lidar.get()
+            with stage_timer.stage("camera_pose"):
+                ego_matrix = ground_truth.get_sensor_matrices([lidar_data.transform])[0]
+            
+            points, colors, front_to_ego = get_ground_truth(queue_list, depth_camera_list, args.display, dtype, workspace, roi, ego_matrix)
 
 
         # DOWNSAMPLING
-            downsampled_points, downsampled_colors = ground_truth.downsample(points, colors, args.leaf_size)
-            
-            
-            # Get the center of the 4 ground truth cameras (Red points)                   
-            red_indices = np.where(downsampled_colors[:, 0] == 255)[0]
-            red_center_points = downsampled_points[red_indices]
-            # Get the center of the red points (Coords of the cameras)
-            groundtruth_center = np.mean(red_center_points, axis=0)
-            
-            # Add the center of the point cloud (RED)
-            pcl_downsampled.points = o3d.utility.Vector3dVector(np.vstack([downsampled_points, groundtruth_center]))
-            pcl_downsampled.colors = o3d.utility.Vector3dVector(np.vstack([downsampled_colors, [255, 0, 0]]))
+            with stage_timer.stage("downsample"):
+                downsampled_points, downsampled_colors = ground_truth.downsample(points, colors, args.leaf_size, workspace, args.downsample_kernel)
 
 
         # LIDAR TRANSFORMATION
-            lidar_pcl, center_lidar = lidar_transformation(extrinsic, image_queue_lidar)
+            with stage_timer.stage("lidar_transform"):
+                lidar_points = lidar_transformation(lidar_data, dtype)
+
+
+        # Voxel occupancy grid
+            with stage_timer.stage("voxelization"):
+                voxel_occupancy_grid = ground_truth.occupancy_grid_map(downsampled_points)
             
-            # Fit the lidar point cloud to the ground truth point cloud
-            translation_to_center = center_lidar - groundtruth_center
-            pcl_downsampled.points = o3d.utility.Vector3dVector(np.array(pcl_downsampled.points) + translation_to_center)
+            if args.free_space:
+                # Rays from the cameras (the translation of the front camera in the ego frame) to the points
+                with stage_timer.stage("free_space"):
+                    voxel_labels = free_space.label_free_space(downsampled_points, front_to_ego[:3, 3])
             
+            if args.lidar_voxel:
+                with stage_timer.stage("lidar_voxelization"):
+                    # The lidar points keep the order of the measurement
+                    lidar_intensity = np.frombuffer(lidar_data.raw_data, dtype=np.float32)[3::4]
+                    lidar_features = lidar_voxel.voxelize_lidar(lidar_points, lidar_intensity)
             
-        # DELETE THE RED POINTS
-            ground_truth_red_indices = np.where(np.asarray(pcl_downsampled.colors)[:, 0] == 255)[0]
-            ground_truth_points = np.delete(np.asarray(pcl_downsampled.points), ground_truth_red_indices, axis=0)
-            pcl_downsampled.points = o3d.utility.Vector3dVector(ground_truth_points)
-            pcl_downsampled.colors = o3d.utility.Vector3dVector([])
+            if args.range_image:
+                with stage_timer.stage("range_image"):
+                    # The raw points of the measurement, in the frame of the lidar
+                    channels, width = range_image.range_image_shape(lidar_attributes["real_lidar"])
+                    lidar_range = range_image.measurement_range_image(lidar_data, channels, width, float(lidar_attributes["real_lidar"]['upper_fov']), float(lidar_attributes["real_lidar"]['lower_fov']))
             
-            lidar_red_indices = np.where(np.asarray(lidar_pcl.colors)[:, 0] == 255)[0]
-            lidar_points = np.delete(np.asarray(lidar_pcl.points), lidar_red_indices, axis=0)
-            lidar_pcl.points = o3d.utility.Vector3dVector(lidar_points)
-            lidar_pcl.colors = o3d.utility.Vector3dVector([])
-
-
-        # Voxel occupancy grid
-            voxel_occupancy_grid = occupancy_grid_map(np.array(pcl_downsampled.points))
+            if ground_truth_map is not None:
+                # The downsampled points in the world, with the pose of the ego frame
+                with stage_timer.stage("map_update"):
+                    world_points = downsampled_points @ ego_matrix[:3, :3].T + ego_matrix[:3, 3]
+                    voxel_map.integrate(ground_truth_map, world_points)
+                    voxel_map.evict(ground_truth_map, ego_matrix[:3, 3])
+                # Same origin and axes of the voxel occupancy grid of the frame
+                with stage_timer.stage("map_grid"):
+                    map_occupancy_grid = voxel_map.extract_grid(ground_truth_map, ego_matrix[:3, 3], ego_matrix[:3, :3])
 
 
     # SAVE THE DATA
             print(f"\nSaving data...")
+            with stage_timer.stage("queue_wait"):
+                image_rgb = image_queue_rgb.get()
+                image = image_queue_depth.get()
         # Save the RGB image
-            image = image_queue_rgb.get()
-            image.save_to_disk('_out/rgb/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.png')
+            with stage_timer.stage("write_rgb"):
+                rgb_writer.submit_rgb(rgb_images, image_rgb, time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image_rgb.frame)
         # Save the Depth image
-            image = image_queue_depth.get()
-            image.save_to_disk('_out/depth/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.png', cc)
+            with stage_timer.stage("write_depth"):
+                if args.depth_format == "png":
+                    image.save_to_disk(f'{out_dir}/depth/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.png', cc)
+                else:
+                    depth_storage.save_depth(f'{out_dir}/depth/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', depth_storage.depth_meters(image), args.depth_format)
         # Save the Lidar point cloud
-            o3d.io.write_point_cloud(f'./_out/lidar/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.ply', lidar_pcl) # To save the point cloud file (unreliable points)
-            np.savez_compressed('_out/lidar_points/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', np.asarray(lidar_pcl.points)) # Save as compressed .npz
+            with stage_timer.stage("write_lidar_ply"):
+                lidar_pcl.points = o3d.utility.Vector3dVector(lidar_points)
+                o3d.io.write_point_cloud(f'{out_dir}/lidar/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.ply', lidar_pcl) # To save the point cloud file (unreliable points)
+            with stage_timer.stage("write_lidar_points"):
+                if args.lidar_format == "float64":
+                    np.savez_compressed(f'{out_dir}/lidar_points/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', lidar_points) # Save as compressed .npz
+                else:
+                    # Same order of the points of the measurement
+                    lidar_intensity = np.frombuffer(lidar_data.raw_data, dtype=np.float32)[3::4]
+                    lidar_storage.save_lidar(f'{out_dir}/lidar_points/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', lidar_points, lidar_intensity, args.lidar_format)
         # Save the Ground Truth voxel occupancy grid
-            o3d.io.write_point_cloud(f'./_out/ground_truth/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.ply', pcl_downsampled) # To save the point cloud file (unreliable points)
-            np.savez_compressed('_out/ground_truth_voxel/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', voxel_occupancy_grid) # Save as compressed .npz
+            with stage_timer.stage("write_ground_truth_ply"):
+                pcl_downsampled.points = o3d.utility.Vector3dVector(downsampled_points)
+                o3d.io.write_point_cloud(f'{out_dir}/ground_truth/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.ply', pcl_downsampled) # To save the point cloud file (unreliable points)
+            with stage_timer.stage("write_ground_truth_voxel"):
+                if args.pyramid_levels > 1:
+                    # The levels of the pyramid are max pooled from the grid of the frame (no other voxelization)
+                    occupancy_pyramid.save_pyramid(f'{out_dir}/ground_truth_voxel/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz',
+                                                   occupancy_pyramid.build_pyramid(voxel_occupancy_grid, args.pyramid_levels))
+                else:
+                    np.savez_compressed(f'{out_dir}/ground_truth_voxel/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', voxel_occupancy_grid) # Save as compressed .npz
+            if args.lidar_voxel:
+                with stage_timer.stage("write_lidar_voxel"):
+                    lidar_voxel.save_lidar_voxel(f'{out_dir}/lidar_voxel/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', lidar_features)
+            if args.range_image:
+                with stage_timer.stage("write_range_image"):
+                    range_image.save_range_image(f'{out_dir}/lidar_range/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', lidar_range)
+            if args.free_space:
+                with stage_timer.stage("write_ground_truth_labels"):
+                    np.savez_compressed(f'{out_dir}/ground_truth_labels/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', voxel_labels)
+            if ground_truth_map is not None:
+                with stage_timer.stage("write_ground_truth_map"):
+                    np.savez_compressed(f'{out_dir}/ground_truth_map/' + time.strftime('%Y%m%d_%H%M%S') + '_%06d' % image.frame + '.npz', map_occupancy_grid)
             print(f"Data saved!")
 
     finally:
 
         #vis.close()
 
-        for actor in actor_list:
-            actor.destroy()
-            
-        for controller in controllers_list:
-            if controller.is_alive:
-                controller.stop()
+        # The controllers are destroyed before their pedestrians
+        gennerate_traffic.destroy_actors(client, controllers_list + actor_list)
             
         print(f"All cleaned up!")
+        
+        # Wait for the RGB images still being encoded
+        rgb_saved, rgb_bytes = rgb_writer.close_rgb_writer(rgb_images)
+        print(f"RGB images saved: {rgb_saved} ({rgb_bytes / 2**20:.1f} MB, {args.rgb_codec})")
+        
+        if args.profile or args.profile_memory:
+            stage_timer.disable_profiling()
+            stage_timer.export_profile(f"{out_dir}/profile")
+            stage_timer.print_summary()
+    
+    ticks_per_second = ticks / tick_time if tick_time > 0 else 0.0
+    print(f"Ticks: {ticks} ({ticks_per_second:.1f} ticks/s) | Frames saved: {frame} | Skipped ticks: {skipped}")
+    if traffic is not None:
+        print(f"Traffic actors moved ahead of the vehicle: {traffic['recycled']}")
+    
+    return {"frames": frame, "ticks": ticks, "skipped": skipped, "ticks_per_second": ticks_per_second}
+
+
+def main(args):
+    
+    # "Town01_Opt" | "Town02_Opt"
+    client = setup_world.connect_client(port=args.port)
+    world, blueprint_library, traffic_manager = setup_world.setup_carla(args.map, client, args.tm_port)
+    
+    summary = capture_route(client, world, blueprint_library, traffic_manager, args)
+    print(f"Frames saved: {summary['frames']} | Skipped ticks: {summary['skipped']}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(parser.parse_args())
\ No newline at end of file
@@ -1,7 +1,17 @@
 from utils.setup import setup_world
 from utils.spawn import spawn_vehicle, spawn_sensor
+from utils.lidar import semantic_lidar
+import argparse
 import queue
-import open3d as o3d
+import numpy as np
+import os
+
+parser = argparse.ArgumentParser(description="Carla semantic lidar")
+parser.add_argument('-m', '--map', type=str, help='Map', default="Town01_Opt")
+parser.add_argument('-p', '--port', type=int, help='Port of the CARLA server', default=2000)
+parser.add_argument('--tm_port', type=int, help='Port of the traffic manager', default=8000)
+parser.add_argument('-o', '--out_dir', type=str, help='Folder to save the data', default="_out")
+parser.add_argument('-v', '--voxel', type=int, help='Also save the semantic occupancy grid (in OUT_DIR/lidarSegm_voxel)', default=0)
 
 lidar_attributes = {
     "real_lidar": {
@@ -15,11 +25,16 @@ lidar_attributes = {
 }
 
 
-def main():
+def main(args):
     actor_list = []
+    out_dir = args.out_dir
+    os.makedirs(f'{out_dir}/lidarSegm', exist_ok=True)
+    if args.voxel:
+        os.makedirs(f'{out_dir}/lidarSegm_voxel', exist_ok=True)
 
     try:
-        world, blueprint_library, traffic_manager = setup_world.setup_carla()
+        client = setup_world.connect_client(port=args.port)
+        world, blueprint_library, traffic_manager = setup_world.setup_carla(args.map, client, args.tm_port)
         settings = world.get_settings()
         
         settings.fixed_delta_seconds = 0.05
@@ -29,7 +44,7 @@ def main():
 
             
     # Vehicle
-        vehicle = spawn_vehicle.spawn_vehicle(world, blueprint_library)
+        vehicle = spawn_vehicle.spawn_vehicle(world, blueprint_library, traffic_manager)
         actor_list.append(vehicle)
         print(f"Vehicle: {vehicle}")
         
@@ -50,8 +65,15 @@ def main():
         while True:
             world.tick()
             
-            image = image_queue_lidar_segm.get()            
-            image.save_to_disk('_out/lidarSegm/%06d' % image.frame + '.ply')
+            image = image_queue_lidar_segm.get()
+            
+            # Binary file with the points of the measurement (no copies and no ASCII .ply)
+            points = semantic_lidar.semantic_points(image)
+            semantic_lidar.save_semantic_lidar(f'{out_dir}/lidarSegm/' + '%06d' % image.frame + '.npy', points)
+            
+            if args.voxel:
+                voxel_labels = semantic_lidar.semantic_occupancy_grid(semantic_lidar.ego_points(points), points['semantic_tag'])
+                np.savez_compressed(f'{out_dir}/lidarSegm_voxel/' + '%06d' % image.frame + '.npz', voxel_labels)
 
             
             """ # read the total lines of the file
@@ -67,4 +89,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(parser.parse_args())
\ No newline at end of file
@@ -0,0 +1,349 @@
+from utils.ground_truth import ground_truth, region_of_interest, free_space, occupancy_pyramid
+from utils.lidar import lidar_voxel, lidar_storage, range_image
+from utils.capture import depth_storage
+import main_dataset
+import argparse
+import carla
+import json
+import os
+import platform
+import queue
+import time
+import tracemalloc
+import numpy as np
+from types import SimpleNamespace
+
+parser = argparse.ArgumentParser(description="Benchmark of the geometry of the ground truth and lidar with synthetic data")
+parser.add_argument('-r', '--repeats', type=int, help='Number of times each benchmark is run (the median is used)', default=5)
+parser.add_argument('-n', '--points', type=int, help='Number of points of the synthetic point clouds', default=2_000_000)
+parser.add_argument('-l', '--leaf_size', type=float, help='Leaf size for downsampling', default=0.2)
+parser.add_argument('-b', '--baseline', type=str, help='JSON file with the baseline results', default="utils/benchmarks/baselines/geometry.json")
+parser.add_argument('-s', '--save', type=int, help='Save the results as the new baseline', default=0)
+parser.add_argument('-t', '--threshold', type=float, help='Maximum throughput regression allowed (0.2 = 20%% slower than the baseline)', default=0.2)
+parser.add_argument('-m', '--max_peak_mb', type=float, help='Maximum peak memory (MB) of a float32 frame, 0 to not check it', default=150)
+
+PCL_LIBRARY = ground_truth.PCL_LIBRARY
+NATIVE_LIBRARY = ground_truth.NATIVE_LIBRARY
+
+# Same sensors of main_dataset.py
+IMG_WIDTH, IMG_HEIGHT = 1280, 960
+LIDAR_CHANNELS = 128
+LIDAR_POINTS_PER_TICK = 2621440 // 20   # points_per_second / rotation_frequency -> 1 rotation per tick
+
+
+"""
+    Synthetic data (always the same for the same seed)
+"""
+
+def synthetic_depth_image(width=IMG_WIDTH, height=IMG_HEIGHT, seed=0):
+    """
+    Create a depth image with the CARLA encoding (BGRA, depth = (R + G*256 + B*256*256) / (256^3 - 1) * 1000 meters)
+    of a scene with the ground 2.5 meters below the camera, walls between 10 and 30 meters and the sky (1000 meters).
+
+    :return: Object with 'raw_data', 'width' and 'height' like a carla.Image.
+    """
+    rng = np.random.default_rng(seed)
+    focal_length = width / (2.0 * np.tan(np.pi / 4))    # FOV of 90º
+    v = np.arange(height, dtype=np.float64)[:, None]
+    u = np.arange(width, dtype=np.float64)[None, :]
+
+    depth = np.full((height, width), 1000.0)
+    # Ground (depth of the plane 2.5 meters below the camera)
+    depth = np.where(v > height / 2, 2.5 * focal_length / np.maximum(v - height / 2, 1e-6), depth)
+    # Walls, with a distance that changes with the column
+    walls = 20 + 10 * np.sin(u / 97.0) + rng.normal(0, 0.01, (1, width))
+    depth = np.where(v > height / 4, np.minimum(depth, walls), depth)
+
+    encoded = np.round(np.clip(depth / 1000, 0, 1) * 16777215).astype(np.uint32)
+    bgra = np.empty((height, width, 4), dtype=np.uint8)
+    bgra[..., 0] = encoded // 65536           # B
+    bgra[..., 1] = (encoded // 256) % 256     # G
+    bgra[..., 2] = encoded % 256              # R
+    bgra[..., 3] = 255                        # A
+
+    return SimpleNamespace(raw_data=bgra.tobytes(), width=width, height=height, frame=0)
+
+
+def synthetic_lidar_measurement(channels=LIDAR_CHANNELS, n_points=LIDAR_POINTS_PER_TICK, seed=0):
+    """
+    Create a lidar measurement (x, y, z, intensity as float32) of one rotation of a lidar with 'channels'
+    channels between -45º and 45º, with the ground 2.5 meters below the sensor and walls at 25 meters.
+
+    :return: Object with 'raw_data' like a carla.LidarMeasurement.
+    """
+    rng = np.random.default_rng(seed)
+    elevation = np.repeat(np.radians(np.linspace(-45, 45, channels)), n_points // channels)
+    azimuth = np.tile(np.linspace(0, 2 * np.pi, n_points // channels, endpoint=False), channels)
+
+    ground_range = 2.5 / np.maximum(np.sin(-elevation), 1e-6)
+    wall_range = 25.0 / np.maximum(np.cos(elevation), 1e-6)
+    ranges = np.where(elevation < 0, np.minimum(ground_range, wall_range), wall_range)
+    ranges += rng.normal(0, 0.01, ranges.shape)
+    valid = ranges < 75.0
+
+    points = np.empty((np.count_nonzero(valid), 4), dtype=np.float32)
+    points[:, 0] = ranges[valid] * np.cos(elevation[valid]) * np.cos(azimuth[valid])
+    points[:, 1] = ranges[valid] * np.cos(elevation[valid]) * np.sin(azimuth[valid])
+    points[:, 2] = ranges[valid] * np.sin(elevation[valid])
+    points[:, 3] = np.exp(-0.004 * ranges[valid])    # Intensity with the atmosphere attenuation
+
+    # The lidar in the same location of the depth cameras (see 'synthetic_depth_cameras')
+    return SimpleNamespace(raw_data=points.tobytes(), frame=0, transform=carla.Transform(carla.Location(x=10.0, y=20.0, z=2.5)))
+
+
+def synthetic_point_cloud(n_points, seed=0):
+    """Create a point cloud with 'n_points' uniform in a box of +-40 meters in X and Y and [-4, 2.4] in Z, and its colors."""
+
+    rng = np.random.default_rng(seed)
+    points = rng.uniform([-40, -40, -4], [40, 40, 2.4], (n_points, 3))
+    colors = np.full((n_points, 3), np.array([0, 255, 0]))
+
+    return points, colors
+
+
+def synthetic_depth_cameras():
+    """Objects like the 4 depth cameras of the ground truth (only 'get_transform' is used)."""
+
+    cameras = {}
+    for name, yaw in (("front", 0.0), ("right", 90.0), ("left", -90.0), ("back", 180.0)):
+        transform = carla.Transform(carla.Location(x=10.0, y=20.0, z=2.5), carla.Rotation(yaw=yaw))
+        cameras[f"{name}_depth_camera"] = SimpleNamespace(get_transform=lambda transform=transform: transform)
+
+    return cameras
+
+
+"""
+    Benchmarks
+"""
+
+def run_benchmark(function, repeats):
+    """Run 'function' once to warm up and then 'repeats' times, and return the median time in seconds."""
+
+    function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times))
+
+
+def depth_queues(depth_images):
+    """Queues with the depth images of the 4 cameras, like the queues of the sensors in main_dataset.py."""
+
+    queue_list = {}
+    for name, image in depth_images.items():
+        queue_list[f"image_queue_depth_{name}"] = queue.Queue()
+        queue_list[f"image_queue_depth_{name}"].put(image)
+    queue_list["image_queue_rgb_front"] = queue.Queue()
+    queue_list["image_queue_rgb_front"].put(depth_images["front"])
+
+    return queue_list
+
+
+def full_frame(depth_images, lidar_measurement, depth_cameras, leaf_size, dtype=np.float64, workspace=None, kernel="pcl"):
+    """Process one frame like the loop of main_dataset.py: ground truth, downsampling, lidar and voxel grid."""
+
+    ego_matrix = ground_truth.get_sensor_matrices([lidar_measurement.transform])[0]
+    points, colors, _ = main_dataset.get_ground_truth(depth_queues(depth_images), depth_cameras, False, dtype, workspace, ego_matrix=ego_matrix)
+    downsampled_points, _ = ground_truth.downsample(points, colors, leaf_size, workspace, kernel)
+    main_dataset.lidar_transformation(lidar_measurement, dtype)
+    ground_truth.occupancy_grid_map(downsampled_points)
+
+
+def compare_downsample(points, colors, leaf_size):
+    """
+    Downsample the same float32 cloud with PCL and with the native kernel, which must give the same voxels in
+    the same order (the centroids differ only by the rounding, the colors also by the uint8 colors of PCL).
+
+    :return: Dictionary with the number of points of each kernel and the maximum difference of the points and colors.
+    """
+    points = points.astype(np.float32)
+    colors = colors.astype(np.float32)
+    pcl_points, pcl_colors = ground_truth.downsample(points, colors, leaf_size, kernel="pcl")
+    native_points, native_colors = ground_truth.downsample(points, colors, leaf_size, kernel="native")
+
+    comparison = {"pcl_points": len(pcl_points), "native_points": len(native_points)}
+    if len(pcl_points) == len(native_points):
+        comparison["max_point_difference"] = float(np.abs(pcl_points - native_points).max(initial=0))
+        comparison["max_color_difference"] = float(np.abs(pcl_colors - native_colors).max(initial=0))
+    print(f"downsample pcl vs native: {comparison}")
+
+    return comparison
+
+
+def check_lidar_storage(lidar_measurement, lidar_formats=("cm", "float16")):
+    """
+    Encode and decode the points and intensity of a lidar measurement with each compact format of 'lidar_storage',
+    which must be within the error bound of the format ('check_error_bound' raises AssertionError if not).
+
+    :return: Dictionary {format: {"points_error": meters, "intensity_error": error}}
+    """
+    raw = np.frombuffer(lidar_measurement.raw_data, dtype=np.float32).reshape(-1, 4)
+    points = main_dataset.lidar_transformation(lidar_measurement)
+    intensity = raw[:, 3].astype(np.float64)
+
+    errors = {}
+    for lidar_format in lidar_formats:
+        points_error, intensity_error = lidar_storage.check_error_bound(points, intensity, lidar_format)
+        errors[lidar_format] = {"points_error": points_error, "intensity_error": intensity_error}
+        print(f"lidar storage {lidar_format:<8} max error {points_error * 1000:.2f} mm, intensity {intensity_error:.5f}")
+
+    return errors
+
+
+def peak_memory(function):
+    """Run 'function' (already warmed up) and return the peak memory allocated by numpy and Python in MB."""
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1e6
+
+
+def run_benchmarks(args):
+    """
+    Run all the benchmarks.
+
+    :return: Dictionary {benchmark: {"time": seconds, "throughput": items per second, "unit": items}}
+    """
+    has_pcl = os.path.exists(PCL_LIBRARY)
+    has_native = os.path.exists(NATIVE_LIBRARY)
+    depth_image = synthetic_depth_image()
+    depth_images = {name: synthetic_depth_image(seed=i) for i, name in enumerate(("front", "right", "left", "back"))}
+    depth_cameras = synthetic_depth_cameras()
+    lidar_measurement = synthetic_lidar_measurement()
+    points, colors = synthetic_point_cloud(args.points)
+    intensity = np.random.default_rng(1).random(args.points)
+    intrinsic_matrix, _ = ground_truth.get_intrinsic_extrinsic_matrix(depth_cameras["front_depth_camera"], depth_image)
+    n_pixels = IMG_WIDTH * IMG_HEIGHT
+    n_lidar_points = len(lidar_measurement.raw_data) // 16
+    # Box of the voxel occupancy grid, seen by the front camera
+    roi = region_of_interest.create_roi("box")
+    front_rotation = ground_truth.CAMERA_TO_VEHICLE[:3, :3]
+    # Rays of the ground truth of the 4 cameras (from the origin of the cameras in the ego frame)
+    gt_points, _, front_to_ego = main_dataset.get_ground_truth(depth_queues(depth_images), depth_cameras, display=False)
+    cameras_origin = front_to_ego[:3, 3]
+
+    lidar_range = range_image.measurement_range_image(lidar_measurement)
+    encoded_lidar = lidar_storage.encode_lidar(points, intensity, "cm")
+
+    benchmarks = {
+        "camera_poses": (lambda: ground_truth.get_extrinsic_matrices([camera.get_transform() for camera in depth_cameras.values()]), len(depth_cameras), "cameras"),
+        "_depth_to_array": (lambda: ground_truth._depth_to_array(depth_image), n_pixels, "pixels"),
+        "depth_to_mm": (lambda: depth_storage.encode_depth(depth_storage.depth_meters(depth_image), "mm"), n_pixels, "pixels"),
+        "point2D_to_point3D": (lambda: ground_truth.point2D_to_point3D(depth_image, intrinsic_matrix), n_pixels, "pixels"),
+        "point2D_to_point3D_roi": (lambda: ground_truth.point2D_to_point3D(depth_image, intrinsic_matrix, np.float64, roi, front_rotation), n_pixels, "pixels"),
+        "lidar_transformation": (lambda: main_dataset.lidar_transformation(lidar_measurement), n_lidar_points, "points"),
+        "range_image": (lambda: range_image.measurement_range_image(lidar_measurement), n_lidar_points, "points"),
+        "range_image_to_points": (lambda: range_image.range_image_to_points(lidar_range), n_lidar_points, "points"),
+        "occupancy_grid_map": (lambda: ground_truth.occupancy_grid_map(points), args.points, "points"),
+        "occupancy_pyramid": (lambda: occupancy_pyramid.build_pyramid(ground_truth.occupancy_grid_map(points), 3), args.points, "points"),
+        "occupancy_3_voxel_sizes": (lambda: [ground_truth.occupancy_grid_map(points, voxel_size) for voxel_size in (0.4, 0.8, 1.6)], args.points, "points"),
+        "voxelize_lidar": (lambda: lidar_voxel.voxelize_lidar(points, intensity), args.points, "points"),
+        "encode_lidar_cm": (lambda: lidar_storage.encode_lidar(points, intensity, "cm"), args.points, "points"),
+        "decode_lidar_cm": (lambda: lidar_storage.decode_lidar(encoded_lidar), args.points, "points"),
+        "label_free_space": (lambda: free_space.label_free_space(gt_points, cameras_origin), len(gt_points), "rays"),
+    }
+    if has_pcl:
+        # Buffers reused between the frames, like the loop of main_dataset.py with --float32 1
+        workspace = {}
+        benchmarks["downsample"] = (lambda: ground_truth.downsample(points, colors, args.leaf_size), args.points, "points")
+        benchmarks["full_frame"] = (lambda: full_frame(depth_images, lidar_measurement, depth_cameras, args.leaf_size), 1, "frames")
+        benchmarks["full_frame_float32"] = (lambda: full_frame(depth_images, lidar_measurement, depth_cameras, args.leaf_size,
+                                                                np.float32, workspace), 1, "frames")
+    else:
+        print(f"{PCL_LIBRARY} not found (build the c++ code), skipping 'downsample' and 'full_frame'")
+    if has_native:
+        # Same cloud of 'downsample' in float32 (the arrays read by the kernel without copies) and the buffers reused
+        native_workspace, native_frame_workspace = {}, {}
+        points_float32, colors_float32 = points.astype(np.float32), colors.astype(np.float32)
+        benchmarks["downsample_native"] = (lambda: ground_truth.downsample(points_float32, colors_float32, args.leaf_size, native_workspace, "native"),
+                                           args.points, "points")
+        benchmarks["full_frame_native"] = (lambda: full_frame(depth_images, lidar_measurement, depth_cameras, args.leaf_size,
+                                                               np.float32, native_frame_workspace, "native"), 1, "frames")
+        if has_pcl:
+            benchmarks["downsample_pcl_float32"] = (lambda: ground_truth.downsample(points_float32, colors_float32, args.leaf_size, native_workspace, "pcl"),
+                                                    args.points, "points")
+    else:
+        print(f"{NATIVE_LIBRARY} not found (build the c++ code), skipping 'downsample_native' and 'full_frame_native'")
+    if has_pcl and has_native:
+        compare_downsample(points, colors, args.leaf_size)
+
+    results = {}
+    for name, (function, n_items, unit) in benchmarks.items():
+        median_time = run_benchmark(function, args.repeats)
+        results[name] = {"time": median_time, "throughput": n_items / median_time, "unit": unit}
+        print(f"{name:<24}{median_time * 1000:>12.2f} ms{n_items / median_time:>16.0f} {unit}/s")
+
+    # Peak memory of a whole frame (the buffers of the workspace are already allocated by the warm up)
+    for name in ("full_frame", "full_frame_float32", "full_frame_native"):
+        if name in benchmarks:
+            results[name]["peak_mb"] = peak_memory(benchmarks[name][0])
+            print(f"{name:<24}{results[name]['peak_mb']:>12.1f} MB peak memory")
+
+    return results
+
+
+def compare_baseline(results, baseline, threshold):
+    """
+    Compare the throughput of each benchmark with the baseline.
+
+    :return: List with the names of the benchmarks slower than the baseline by more than 'threshold'.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['throughput'] / baseline[name]['throughput']
+        status = "REGRESSION" if ratio < 1 - threshold else "ok"
+        print(f"{name:<24}{ratio:>10.2f}x baseline  {status}")
+        if status == "REGRESSION":
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    print(f"Repeats: {args.repeats} | Points: {args.points} | Leaf size: {args.leaf_size}\n")
+
+    results = run_benchmarks(args)
+
+    peak_mb = results.get("full_frame_float32", {}).get("peak_mb")
+    if args.max_peak_mb > 0 and peak_mb is not None and peak_mb > args.max_peak_mb:
+        raise SystemExit(f"Peak memory of a float32 frame: {peak_mb:.1f} MB > {args.max_peak_mb:.1f} MB")
+
+    # Error of the compact lidar formats on the 128 channels rotation
+    try:
+        check_lidar_storage(synthetic_lidar_measurement())
+    except AssertionError as error:
+        raise SystemExit(f"Lidar storage: {error}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({"machine": platform.node(), "points": args.points, "leaf_size": args.leaf_size, "results": results}, f, indent=4)
+        print(f"\nBaseline saved in {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline in {args.baseline} (run with -s 1 to save one)")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f"\nBaseline: {args.baseline} (machine {baseline['machine']})")
+    regressions = compare_baseline(results, baseline['results'], args.threshold)
+
+    if regressions:
+        raise SystemExit(f"Throughput regression in: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+from utils.capture import rgb_writer
+import argparse
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+from types import SimpleNamespace
+
+parser = argparse.ArgumentParser(description="Benchmark of the codecs of the RGB images")
+parser.add_argument('-i', '--image', type=str, help='RGB image to encode (default = synthetic image)', default=None)
+parser.add_argument('-r', '--repeats', type=int, help='Number of times each image is encoded (the median is used)', default=5)
+parser.add_argument('-f', '--frames', type=int, help='Number of frames saved by the writer with each codec', default=40)
+parser.add_argument('-w', '--workers', type=int, help='Number of threads of the writer', default=2)
+
+# Same ego RGB camera of main_dataset.py
+IMG_WIDTH, IMG_HEIGHT = 1280, 720
+
+# (codec, PNG level, JPEG/WebP quality)
+CODECS = [
+    ("png", 1, None), ("png", 3, None), ("png", 6, None), ("png", 9, None),
+    ("jpeg", None, 75), ("jpeg", None, 90), ("jpeg", None, 95),
+    ("webp", None, 75), ("webp", None, 90),
+    ("raw", None, None),
+]
+
+
+def synthetic_rgb_image(width=IMG_WIDTH, height=IMG_HEIGHT, seed=0):
+    """
+    Create an image like the RGB camera (sky gradient, textured road and buildings with sensor noise).
+
+    :return: Object with 'raw_data' (BGRA), 'width' and 'height' like a carla.Image.
+    """
+    rng = np.random.default_rng(seed)
+    v = np.arange(height, dtype=np.float32)[:, None, None]
+    u = np.arange(width, dtype=np.float32)[None, :, None]
+
+    # Sky above the horizon and road below
+    sky = np.array([235, 190, 140], dtype=np.float32) - v * 0.1
+    road = np.array([90, 90, 95], dtype=np.float32) + 20 * np.sin(u / 7.0) * np.sin(v / 5.0)
+    bgr = np.where(v < height / 2, sky, road) + np.zeros((height, width, 3), dtype=np.float32)
+
+    # Buildings with windows
+    for _ in range(12):
+        x0 = rng.integers(0, width - 100)
+        w, h = rng.integers(60, 200), rng.integers(80, height // 2)
+        color = rng.uniform(40, 200, 3)
+        windows = ((np.arange(w)[None, :] // 8) % 2) * ((np.arange(h)[:, None] // 10) % 2)
+        bgr[height // 2 - h:height // 2, x0:x0 + w] = color * (1 - 0.4 * windows[:, :, None])
+
+    bgr += rng.normal(0, 2.0, bgr.shape)    # Noise of the sensor
+    bgra = np.empty((height, width, 4), dtype=np.uint8)
+    bgra[:, :, :3] = np.clip(bgr, 0, 255)
+    bgra[:, :, 3] = 255
+
+    return SimpleNamespace(raw_data=bgra.tobytes(), width=width, height=height)
+
+
+def load_rgb_image(path):
+    """Object like a carla.Image with the pixels of an image file."""
+
+    bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+    bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
+
+    return SimpleNamespace(raw_data=bgra.tobytes(), width=bgra.shape[1], height=bgra.shape[0])
+
+
+def benchmark_codec(image, bgr, codec, level, quality, repeats, frames, workers):
+    """
+    Encode time of one image (in the calling thread) and throughput of the writer (pool of threads, with the disk).
+
+    :return: Dictionary with the results.
+    """
+    if codec == "raw":
+        encode_time = 0.0
+        size = bgr.nbytes
+    else:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            data = rgb_writer.encode_image(bgr, codec, level, quality)
+            times.append(time.perf_counter() - start)
+        encode_time = float(np.median(times))
+        size = len(data)
+
+    out_dir = tempfile.mkdtemp(prefix="benchmark_rgb_")
+    try:
+        writer = rgb_writer.create_rgb_writer(out_dir, codec, level or 3, quality or 90, workers)
+        start = time.perf_counter()
+        submit_time = 0.0
+        for frame in range(frames):
+            submit_start = time.perf_counter()
+            rgb_writer.submit_rgb(writer, image, '%06d' % frame)
+            submit_time += time.perf_counter() - submit_start
+        rgb_writer.close_rgb_writer(writer)
+        writer_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return {
+        "encode_ms": encode_time * 1000,
+        "size_kb": size / 1024,
+        "ratio": bgr.nbytes / size,
+        "writer_fps": frames / writer_time,
+        "loop_ms": submit_time / frames * 1000,     # Time of the loop of the simulation for each image
+    }
+
+
+def main():
+    args = parser.parse_args()
+    image = load_rgb_image(args.image) if args.image else synthetic_rgb_image()
+    bgr = rgb_writer.image_to_bgr(image)
+    print(f"Image: {args.image or 'synthetic'} {image.width}x{image.height} | Repeats: {args.repeats} | Frames: {args.frames} | Workers: {args.workers}\n")
+
+    print(f"{'codec':<16}{'encode ms':>10}{'MB/s':>9}{'size KB':>10}{'ratio':>8}{'writer fps':>12}{'loop ms':>9}")
+    for codec, level, quality in CODECS:
+        result = benchmark_codec(image, bgr, codec, level, quality, args.repeats, args.frames, args.workers)
+        name = codec + (f" {level}" if level is not None else "") + (f" q{quality}" if quality is not None else "")
+        throughput = bgr.nbytes / 2**20 / (result['encode_ms'] / 1000) if result['encode_ms'] > 0 else float('inf')
+        print(f"{name:<16}{result['encode_ms']:>10.1f}{throughput:>9.0f}{result['size_kb']:>10.0f}{result['ratio']:>8.1f}"
+              f"{result['writer_fps']:>12.1f}{result['loop_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
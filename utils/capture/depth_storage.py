@@ -0,0 +1,136 @@
+import argparse
+import multiprocessing
+import os
+import cv2
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Convert the logarithmic depth PNGs of the captures to metric depth")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder with the captures (all the "depth" folders inside are converted)', default="_out")
+parser.add_argument('-f', '--format', type=str, help='Format of the metric depth', default="mm", choices=["mm", "float16"])
+parser.add_argument('-w', '--workers', type=int, help='Number of processes (0 = number of CPUs)', default=0)
+parser.add_argument('--overwrite', type=int, help='Convert again the images already converted', default=0)
+
+
+"""
+    Metric depth of the depth camera, instead of the logarithmic PNG of CARLA (8 bits, lossy and slow to convert back).
+
+    The depth is saved in a compressed .npz file with the array "depth" and its "scale" (meters per unit):
+    - "mm": uint16 millimeters (exact to 1 mm up to 65.534 m, the farther pixels and the sky are saved as 65.535 m).
+    - "float16": float16 meters (relative error < 0.05%, up to the 1000 m of the camera).
+    Decoding it is only a multiplication ('load_depth').
+
+    The logarithmic PNGs already captured are converted with a lookup table of the 256 values of the PNG
+    (they keep the precision of the PNG, only the new captures have the full precision).
+"""
+
+DEPTH_FORMATS = ("png", "mm", "float16")
+
+FAR_PLANE = 1000.0              # Maximum depth of the CARLA depth camera in meters
+_LOG_DEPTH_SCALE = 5.70378      # CARLA LogarithmicDepth: value = 1 + log(depth / FAR_PLANE) / 5.70378
+
+# Depth in meters of each value of the logarithmic PNG
+LOG_DEPTH_TABLE = (np.exp((np.arange(256) / 255.0 - 1.0) * _LOG_DEPTH_SCALE) * FAR_PLANE).astype(np.float32)
+
+
+def depth_meters(image, dtype=np.float32):
+    """
+    Depth in meters (H, W) of a carla.Image of a depth camera, with all the 24 bits of the raw depth
+    (R + G * 256 + B * 256 * 256, in integers like 'ground_truth._depth_to_array').
+    """
+    bgra = np.frombuffer(image.raw_data, dtype=np.uint8).reshape(image.height, image.width, 4)
+    depth = bgra[:, :, 2].astype(np.int32)
+    depth |= bgra[:, :, 1].astype(np.int32) << 8
+    depth |= bgra[:, :, 0].astype(np.int32) << 16
+
+    return depth.astype(dtype) * dtype(FAR_PLANE / 16777215.0)
+
+
+def encode_depth(depth, depth_format="mm"):
+    """
+    Encode a depth in meters in the format of the file.
+
+    :return: Array with the encoded depth and scale (meters per unit).
+    """
+    if depth_format == "mm":
+        millimeters = np.rint(np.asarray(depth, dtype=np.float32) * np.float32(1000.0))
+        return np.clip(millimeters, 0, np.iinfo(np.uint16).max, out=millimeters).astype(np.uint16), 0.001
+    if depth_format == "float16":
+        return np.asarray(depth).astype(np.float16), 1.0
+
+    raise ValueError(f"Unknown depth format '{depth_format}', must be one of {DEPTH_FORMATS[1:]}")
+
+
+def save_depth(path, depth, depth_format="mm"):
+    """Save a depth in meters (H, W) in a compressed .npz file (see the formats in the docstring of the module)."""
+
+    encoded, scale = encode_depth(depth, depth_format)
+    np.savez_compressed(path, depth=encoded, scale=np.float32(scale))
+
+
+def decode_depth(encoded, scale, dtype=np.float32):
+    """Depth in meters of an encoded depth."""
+
+    depth = encoded.astype(dtype)
+    if scale != 1.0:
+        depth *= dtype(scale)
+
+    return depth
+
+
+def load_depth(path, dtype=np.float32):
+    """Load a depth of 'save_depth' in meters (H, W)."""
+
+    with np.load(path) as data:
+        return decode_depth(data["depth"], float(data["scale"]), dtype)
+
+
+def log_png_to_meters(image):
+    """
+    Depth in meters of a logarithmic depth PNG of CARLA (inverse of the LogarithmicDepth color converter).
+
+    :param image: Array (H, W) or (H, W, C) uint8 of the PNG (the channels are the same).
+    """
+    if image.ndim == 3:
+        image = image[:, :, 0]
+
+    return LOG_DEPTH_TABLE[image]
+
+
+def _convert_file(task):
+    """Task of the pool: convert one logarithmic PNG to metric depth."""
+
+    png_path, out_path, depth_format = task
+    image = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return f"Failed to read {png_path}"
+    save_depth(out_path, log_png_to_meters(image), depth_format)
+
+    return None
+
+
+def main(args):
+
+    # The depth folders of the captures, the metric depth is saved in "depth_<format>" next to them
+    tasks = []
+    for root, dirs, _ in os.walk(args.in_dir):
+        if "depth" not in dirs:
+            continue
+        out_folder = os.path.join(root, f"depth_{args.format}")
+        os.makedirs(out_folder, exist_ok=True)
+        for name in sorted(os.listdir(os.path.join(root, "depth"))):
+            out_path = os.path.join(out_folder, os.path.splitext(name)[0] + ".npz")
+            if name.endswith(".png") and (args.overwrite or not os.path.exists(out_path)):
+                tasks.append((os.path.join(root, "depth", name), out_path, args.format))
+        dirs.remove("depth")
+
+    print(f"Converting {len(tasks)} depth images to {args.format}...")
+    with multiprocessing.Pool(args.workers or os.cpu_count()) as pool:
+        for done, error in enumerate(pool.imap_unordered(_convert_file, tasks, chunksize=8), 1):
+            if error is not None:
+                print(error)
+            if done % 100 == 0 or done == len(tasks):
+                print(f"{done}/{len(tasks)}")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
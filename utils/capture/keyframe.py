@@ -0,0 +1,57 @@
+import math as mt
+
+
+def create_keyframe_policy(min_distance=0.0, min_yaw=0.0, max_interval=0):
+    """
+    Create the state of a keyframe policy, used to save only the frames where the vehicle moved
+    or turned enough since the last saved frame (keyframe).
+    If 'min_distance' and 'min_yaw' are both 0, the policy is disabled and every tick is a keyframe.
+
+    :param min_distance: Distance in meters the vehicle must travel to have a new keyframe (0 to ignore).
+    :param min_yaw: Rotation in degrees (yaw) the vehicle must turn to have a new keyframe (0 to ignore).
+    :param max_interval: Maximum number of ticks between keyframes, even if the vehicle is stopped (0 to ignore).
+
+    :return: Dictionary with the thresholds and the pose of the last keyframe.
+    """
+    return {
+        "min_distance": min_distance,
+        "min_yaw": min_yaw,
+        "max_interval": max_interval,
+        "last_location": None,      # (x, y, z) of the vehicle in the last keyframe
+        "last_yaw": None,           # Yaw of the vehicle in the last keyframe
+        "ticks_since_keyframe": 0,
+    }
+
+
+def is_keyframe(policy, transform):
+    """
+    The function 'is_keyframe' decides if the current tick is a keyframe based on the movement of the
+    vehicle since the last keyframe, and updates the state of the policy.
+
+    :param policy: Dictionary created by 'create_keyframe_policy'.
+    :param transform: The carla.Transform of the vehicle in the current tick.
+
+    :return: True if the frame of this tick must be processed and saved.
+    """
+    policy['ticks_since_keyframe'] += 1
+    location = (transform.location.x, transform.location.y, transform.location.z)
+    yaw = transform.rotation.yaw
+
+    if policy['last_location'] is None or (policy['min_distance'] <= 0 and policy['min_yaw'] <= 0):
+        keyframe = True
+    else:
+        distance = mt.dist(location, policy['last_location'])
+        # Smallest difference between the 2 angles [0, 180]
+        yaw_difference = abs((yaw - policy['last_yaw'] + 180) % 360 - 180)
+
+        moved = policy['min_distance'] > 0 and distance >= policy['min_distance']
+        turned = policy['min_yaw'] > 0 and yaw_difference >= policy['min_yaw']
+        timeout = policy['max_interval'] > 0 and policy['ticks_since_keyframe'] >= policy['max_interval']
+        keyframe = moved or turned or timeout
+
+    if keyframe:
+        policy['last_location'] = location
+        policy['last_yaw'] = yaw
+        policy['ticks_since_keyframe'] = 0
+
+    return keyframe
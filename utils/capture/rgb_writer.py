@@ -0,0 +1,164 @@
+import collections
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+
+"""
+    Saving of the RGB images out of the loop of the simulation.
+
+    The BGRA buffer of the carla.Image is copied (without the alpha channel) in the loop and encoded by a pool of
+    threads (OpenCV releases the GIL while encoding), so the next tick doesn't wait for the compression.
+    Codecs: "png" (lossless, 'level' 0-9), "jpeg" and "webp" ('quality' 0-100), or "raw": the uint8 images appended
+    to only one file per route, read as a memory mapped array (N, H, W, 3) with 'load_raw_rgb'. The raw stream is
+    saved in its own folder (RAW_FOLDER), the "rgb" folder only has one file per image like the other sensors.
+"""
+
+RGB_CODECS = ("png", "jpeg", "webp", "raw")
+
+RAW_FOLDER = "rgb_raw"
+RAW_FILE = "rgb.u8"
+RAW_INDEX = "rgb_index.json"
+
+
+def encode_params(codec, level=3, quality=90):
+    """Extension of the file and parameters of cv2.imencode of a codec."""
+
+    if codec == "png":
+        return ".png", [cv2.IMWRITE_PNG_COMPRESSION, int(level)]
+    if codec == "jpeg":
+        return ".jpg", [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    if codec == "webp":
+        return ".webp", [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+
+    raise ValueError(f"Unknown codec '{codec}', must be one of {RGB_CODECS}")
+
+
+def image_to_bgr(image):
+    """Copy of the BGR pixels (H, W, 3) of a carla.Image (the raw BGRA buffer without the alpha channel)."""
+
+    bgra = np.frombuffer(image.raw_data, dtype=np.uint8).reshape(image.height, image.width, 4)
+    return np.ascontiguousarray(bgra[:, :, :3])
+
+
+def encode_image(bgr, codec="png", level=3, quality=90):
+    """Encode a BGR image, the bytes of the file."""
+
+    extension, params = encode_params(codec, level, quality)
+    ok, encoded = cv2.imencode(extension, bgr, params)
+    if not ok:
+        raise IOError(f"Failed to encode the image with {codec}")
+
+    return encoded.tobytes()
+
+
+def create_rgb_writer(out_dir, codec="png", level=3, quality=90, workers=2, max_pending=8):
+    """
+    Create a writer of the RGB images of a route in 'out_dir'.
+
+    :param workers: Number of threads encoding the images (the raw images are written by only one, in order).
+    :param max_pending: Maximum number of images waiting to be saved (the loop waits for the oldest one, so the
+                        memory doesn't grow if the disk is slower than the simulation).
+
+    :return: Dictionary with the state of the writer (see 'submit_rgb' and 'close_rgb_writer').
+    """
+    if codec not in RGB_CODECS:
+        raise ValueError(f"Unknown codec '{codec}', must be one of {RGB_CODECS}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    writer = {
+        "out_dir": out_dir,
+        "codec": codec,
+        "level": level,
+        "quality": quality,
+        "max_pending": max_pending,
+        "pending": collections.deque(),
+        "executor": ThreadPoolExecutor(max_workers=1 if codec == "raw" else workers),
+        "saved": 0,
+        "bytes": 0,
+    }
+    if codec == "raw":
+        # Appended to the images of the route already saved (same shape)
+        index_path = os.path.join(out_dir, RAW_INDEX)
+        writer["index"] = _load_index(out_dir) if os.path.exists(index_path) else {"shape": None, "dtype": "uint8", "names": []}
+        writer["raw_file"] = open(os.path.join(out_dir, RAW_FILE), 'ab')
+
+    return writer
+
+
+def _load_index(out_dir):
+    with open(os.path.join(out_dir, RAW_INDEX)) as file:
+        return json.load(file)
+
+
+def _save_image(writer, bgr, name):
+    """Task of the pool: encode and write one image, the number of bytes written."""
+
+    if writer["codec"] == "raw":
+        writer["raw_file"].write(bgr.data)
+        writer["index"]["names"].append(name)
+        return bgr.nbytes
+
+    data = encode_image(bgr, writer["codec"], writer["level"], writer["quality"])
+    extension, _ = encode_params(writer["codec"])
+    with open(os.path.join(writer["out_dir"], name + extension), 'wb') as file:
+        file.write(data)
+
+    return len(data)
+
+
+def _wait_oldest(writer):
+    writer["bytes"] += writer["pending"].popleft().result()     # Raises the errors of the pool in the loop
+    writer["saved"] += 1
+
+
+def submit_rgb(writer, image, name):
+    """
+    Save an image in the background.
+
+    :param image: carla.Image of the RGB camera (only its pixels are copied, so the image can be released).
+    :param name: Name of the file without the extension.
+    """
+    bgr = image_to_bgr(image)
+    if writer["codec"] == "raw":
+        if writer["index"]["shape"] is None:
+            writer["index"]["shape"] = list(bgr.shape)
+        elif list(bgr.shape) != writer["index"]["shape"]:
+            raise ValueError(f"The raw RGB images of a route must have the same shape {writer['index']['shape']}, not {list(bgr.shape)}")
+
+    while len(writer["pending"]) >= writer["max_pending"]:
+        _wait_oldest(writer)
+    writer["pending"].append(writer["executor"].submit(_save_image, writer, bgr, name))
+
+
+def close_rgb_writer(writer):
+    """
+    Wait for the images still being saved and close the files.
+
+    :return: Number of images saved and bytes written.
+    """
+    try:
+        while writer["pending"]:
+            _wait_oldest(writer)
+    finally:
+        writer["executor"].shutdown(wait=True)
+        if writer["codec"] == "raw":
+            writer["raw_file"].close()
+            with open(os.path.join(writer["out_dir"], RAW_INDEX), 'w') as file:
+                json.dump(writer["index"], file)
+
+    return writer["saved"], writer["bytes"]
+
+
+def load_raw_rgb(out_dir):
+    """
+    Memory mapped array (N, H, W, 3) BGR of the raw images of a route and the names of the images.
+    """
+    index = _load_index(out_dir)
+    shape = (len(index["names"]),) + tuple(index["shape"] or (0, 0, 3))
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=np.uint8), []
+
+    return np.memmap(os.path.join(out_dir, RAW_FILE), dtype=index["dtype"], mode='r', shape=shape), index["names"]
@@ -0,0 +1,325 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import time
+import zipfile
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Statistics of a dataset")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder with the captures (OUT_DIR of main_dataset.py or OUT_ROOT of batch_dataset.py)', default="_out")
+parser.add_argument('-w', '--workers', type=int, help='Number of processes (0 = number of CPUs)', default=0)
+parser.add_argument('-c', '--chunk_size', type=int, help='Number of frames processed by each task', default=32)
+parser.add_argument('--cache', type=str, help='File of the cache of the statistics (default = IN_DIR/dataset_stats.pkl)', default=None)
+parser.add_argument('--no_cache', type=int, help='Process all the frames again', default=0)
+
+
+"""
+    Statistics of the frames of a dataset, grouped by the weather, town and route of each capture:
+    occupied voxels ratio per frame, frequency of occupation of each voxel, lidar points per frame and
+    balance of the classes (occupied/empty and, with --free_space, unknown/occupied/free).
+
+    The statistics of each chunk of frames are computed by a pool of processes as partial results that are
+    merged (sums, not means), so the statistics of each group are cached with the list of its files and
+    running again only processes the new (or changed) frames.
+"""
+
+CACHE_VERSION = 1
+
+_FRAME_NUMBER = re.compile(r'_?(\d+)\.\w+$')
+_CAPTURE_NAME = re.compile(r'^T(\d+)R(\d+)_(\d+)_([A-Za-z]+)')
+
+
+def capture_group(capture_dir):
+    """
+    Group of a capture from the name of its folder, with the format of 'batch_dataset.job_name'
+    (e.g. "T1R1_750_DayClear"), or the name of the folder if it has another format.
+
+    :return: Dictionary {"weather", "town", "route", "traffic"}.
+    """
+    name = os.path.basename(os.path.normpath(capture_dir))
+    match = _CAPTURE_NAME.match(name)
+    if match is None:
+        return {"weather": name, "town": "unknown", "route": "unknown", "traffic": 0}
+
+    town, route, _, weather = match.groups()
+    return {"weather": weather, "town": f"Town{int(town):02d}", "route": f"route_{route}", "traffic": int(name.endswith("_traffic"))}
+
+
+def find_frames(in_dir):
+    """
+    Find the frames of all the captures in 'in_dir' (the folders with a 'ground_truth_voxel' folder),
+    with the files of the other data of each frame matched by the frame number.
+
+    :return: Dictionary {capture folder: [{"voxel": path, "lidar": path or None, "labels": path or None}]}.
+    """
+    captures = {}
+    for root, dirs, _ in os.walk(in_dir):
+        if "ground_truth_voxel" not in dirs:
+            continue
+        dirs[:] = []    # Don't look for captures in the folders of the data
+
+        files = {}
+        for folder in ("ground_truth_voxel", "lidar_points", "ground_truth_labels"):
+            files[folder] = {}
+            if os.path.isdir(os.path.join(root, folder)):
+                for name in os.listdir(os.path.join(root, folder)):
+                    match = _FRAME_NUMBER.search(name)
+                    if match and name.endswith(".npz"):
+                        files[folder][int(match.group(1))] = os.path.join(root, folder, name)
+
+        captures[root] = [{"voxel": path, "lidar": files["lidar_points"].get(number), "labels": files["ground_truth_labels"].get(number)}
+                          for number, path in sorted(files["ground_truth_voxel"].items())]
+
+    return captures
+
+
+def _npz_shape(path, name="arr_0"):
+    """Shape of an array of a .npz file, reading only the header of the array (without decompressing the data)."""
+
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(name + ".npy") as file:
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(file)
+
+    return shape
+
+
+def create_partial():
+    """Empty partial statistics (all the values are sums, so the partials are merged by adding them)."""
+
+    return {
+        "frames": 0,
+        "voxels": 0,                            # Number of voxels of all the frames
+        "occupied": 0,                          # Number of occupied voxels of all the frames
+        "ratio_sum": 0.0,                       # Sum and sum of squares of the occupied ratio of each frame
+        "ratio_sq_sum": 0.0,
+        "ratio_min": np.inf,
+        "ratio_max": -np.inf,
+        "lidar_frames": 0,
+        "lidar_points": 0,                      # Sum and sum of squares of the lidar points of each frame
+        "lidar_points_sq": 0,
+        "labels": np.zeros(3, dtype=np.int64),  # Number of unknown, occupied and free voxels (--free_space)
+        "labels_frames": 0,
+        "voxel_frequency": None,                # Number of frames where each voxel is occupied (shape of the grid)
+    }
+
+
+def merge_partials(a, b):
+    """Merge 2 partial statistics (a new dictionary is returned)."""
+
+    merged = {}
+    for key, value in a.items():
+        other = b[key]
+        if key == "ratio_min":
+            merged[key] = min(value, other)
+        elif key == "ratio_max":
+            merged[key] = max(value, other)
+        elif key == "voxel_frequency":
+            if value is None or other is None:
+                merged[key] = other if value is None else value.copy()
+            else:
+                merged[key] = value + other
+        else:
+            merged[key] = value + other
+
+    return merged
+
+
+def frame_stats(frame):
+    """Partial statistics of only one frame."""
+
+    grid = np.load(frame["voxel"])['arr_0']
+    occupied = grid != 0
+    n_occupied = int(np.count_nonzero(occupied))
+    ratio = n_occupied / grid.size
+
+    partial = create_partial()
+    partial.update({
+        "frames": 1,
+        "voxels": grid.size,
+        "occupied": n_occupied,
+        "ratio_sum": ratio,
+        "ratio_sq_sum": ratio * ratio,
+        "ratio_min": ratio,
+        "ratio_max": ratio,
+        "voxel_frequency": occupied.astype(np.int64),
+    })
+
+    if frame["lidar"] is not None:
+        with zipfile.ZipFile(frame["lidar"]) as archive:
+            name = "points" if "points.npy" in archive.namelist() else "arr_0"     # Files of lidar_storage or only the points
+        n_points = int(_npz_shape(frame["lidar"], name)[0])
+        partial.update({"lidar_frames": 1, "lidar_points": n_points, "lidar_points_sq": n_points * n_points})
+
+    if frame["labels"] is not None:
+        labels = np.load(frame["labels"])['arr_0']
+        partial["labels"] = np.bincount(labels.ravel().astype(np.int64), minlength=3)[:3]
+        partial["labels_frames"] = 1
+
+    return partial
+
+
+def _process_chunk(task):
+    """Task of the pool: partial statistics of a chunk of frames of the same capture."""
+
+    capture, frames = task
+    partial = create_partial()
+    for frame in frames:
+        partial = merge_partials(partial, frame_stats(frame))
+
+    return capture, partial
+
+
+def _file_signature(frame):
+    """Files of a frame with their size and modification time, to find the frames that changed."""
+
+    signature = []
+    for path in frame.values():
+        if path is not None:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+
+    return tuple(signature)
+
+
+def load_cache(path):
+    """Load the cache of the statistics ({capture: {"frames": {signature}, "partial": partial}})."""
+
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as file:
+        cache = pickle.load(file)
+
+    return cache["captures"] if cache.get("version") == CACHE_VERSION else {}
+
+
+def save_cache(path, captures):
+    """Save the cache of the statistics (in a temporary file first, so it is never left half written)."""
+
+    with open(path + ".tmp", 'wb') as file:
+        pickle.dump({"version": CACHE_VERSION, "captures": captures}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def compute_stats(in_dir, workers=0, chunk_size=32, cache_path=None):
+    """
+    Compute the statistics of every capture of 'in_dir', only processing the frames that are not in the cache.
+    If a frame of a capture changed or was removed, the whole capture is processed again.
+
+    :return: Dictionary {capture: partial statistics} and number of frames processed.
+    """
+    cached = load_cache(cache_path)
+    captures = {}
+    tasks = []
+    for capture, frames in find_frames(in_dir).items():
+        signatures = {_file_signature(frame): frame for frame in frames}
+        entry = cached.get(capture)
+        if entry is None or not entry["frames"] <= signatures.keys():
+            entry = {"frames": set(), "partial": create_partial()}
+
+        new_frames = [frame for signature, frame in signatures.items() if signature not in entry["frames"]]
+        entry["frames"] = set(signatures.keys())
+        captures[capture] = entry
+        tasks += [(capture, new_frames[i:i + chunk_size]) for i in range(0, len(new_frames), chunk_size)]
+
+    n_frames = sum(len(frames) for _, frames in tasks)
+    if tasks:
+        with multiprocessing.Pool(workers or os.cpu_count()) as pool:
+            for capture, partial in pool.imap_unordered(_process_chunk, tasks):
+                captures[capture]["partial"] = merge_partials(captures[capture]["partial"], partial)
+
+    if cache_path is not None:
+        save_cache(cache_path, captures)
+
+    return {capture: entry["partial"] for capture, entry in captures.items()}, n_frames
+
+
+def summarize(partial):
+    """Means, standard deviations and ratios of a partial statistics (JSON serializable)."""
+
+    frames = max(partial["frames"], 1)
+    ratio_mean = partial["ratio_sum"] / frames
+    lidar_frames = max(partial["lidar_frames"], 1)
+    lidar_mean = partial["lidar_points"] / lidar_frames
+    summary = {
+        "frames": partial["frames"],
+        "occupied_ratio_mean": ratio_mean,
+        "occupied_ratio_std": float(np.sqrt(max(partial["ratio_sq_sum"] / frames - ratio_mean ** 2, 0))),
+        "occupied_ratio_min": partial["ratio_min"] if partial["frames"] else 0.0,
+        "occupied_ratio_max": partial["ratio_max"] if partial["frames"] else 0.0,
+        "empty_to_occupied": (partial["voxels"] - partial["occupied"]) / max(partial["occupied"], 1),
+        "lidar_points_mean": lidar_mean,
+        "lidar_points_std": float(np.sqrt(max(partial["lidar_points_sq"] / lidar_frames - lidar_mean ** 2, 0))),
+    }
+    if partial["labels_frames"]:
+        unknown, occupied, free = (partial["labels"] / max(partial["labels"].sum(), 1)).tolist()
+        summary.update({"unknown_ratio": unknown, "occupied_label_ratio": occupied, "free_ratio": free})
+    if partial["voxel_frequency"] is not None:
+        frequency = partial["voxel_frequency"] / frames
+        summary["never_occupied_ratio"] = float(np.mean(frequency == 0))
+        summary["occupancy_by_height"] = frequency.mean(axis=(0, 1)).round(5).tolist()   # Mean frequency of each Z level
+
+    return summary
+
+
+def build_report(captures):
+    """Statistics of all the dataset and of each weather, town and route (merging the partials of the captures)."""
+
+    groups = {"weather": {}, "town": {}, "route": {}}
+    total = create_partial()
+    for capture, partial in captures.items():
+        group = capture_group(capture)
+        for key in groups:
+            name = group[key] if key != "route" else f"{group['town']}_{group['route']}"
+            groups[key][name] = merge_partials(groups[key].get(name, create_partial()), partial)
+        total = merge_partials(total, partial)
+
+    report = {"total": summarize(total)}
+    for key, partials in groups.items():
+        report[key] = {name: summarize(partial) for name, partial in sorted(partials.items())}
+
+    return report, total
+
+
+def print_report(report):
+    """Print the report as tables."""
+
+    for key in ("weather", "town", "route"):
+        print(f"\n{key.upper():<24}{'frames':>8}{'occupied %':>12}{'std %':>8}{'empty/occ':>11}{'lidar pts':>12}{'free %':>8}{'unknown %':>11}")
+        for name, summary in list(report[key].items()) + [("TOTAL", report["total"])]:
+            free = f"{100 * summary['free_ratio']:.1f}" if "free_ratio" in summary else "-"
+            unknown = f"{100 * summary['unknown_ratio']:.1f}" if "unknown_ratio" in summary else "-"
+            print(f"{name:<24}{summary['frames']:>8}{100 * summary['occupied_ratio_mean']:>12.3f}{100 * summary['occupied_ratio_std']:>8.3f}"
+                  f"{summary['empty_to_occupied']:>11.1f}{summary['lidar_points_mean']:>12.0f}{free:>8}{unknown:>11}")
+
+
+def main(args):
+
+    cache_path = None if args.no_cache else (args.cache or os.path.join(args.in_dir, "dataset_stats.pkl"))
+    start = time.perf_counter()
+    captures, n_frames = compute_stats(args.in_dir, args.workers, args.chunk_size, cache_path)
+    if not captures:
+        print(f"No captures (folders with ground_truth_voxel) in {args.in_dir}")
+        return
+
+    report, total = build_report(captures)
+    print_report(report)
+
+    # Report in JSON and the frequency of each voxel of all the dataset
+    with open(os.path.join(args.in_dir, "dataset_stats.json"), 'w') as file:
+        json.dump(report, file, indent=4)
+    if total["voxel_frequency"] is not None:
+        np.savez_compressed(os.path.join(args.in_dir, "dataset_stats_voxel_frequency.npz"), total["voxel_frequency"] / max(total["frames"], 1))
+
+    cached = report["total"]["frames"] - n_frames
+    print(f"\n{n_frames} frames processed and {cached} from the cache in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
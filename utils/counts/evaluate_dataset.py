@@ -0,0 +1,387 @@
+from utils.counts.dataset_stats import capture_group
+from utils.lidar import lidar_storage
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+import numpy as np
+import open3d as o3d
+
+parser = argparse.ArgumentParser(description="Evaluation of the predicted voxel grids and of the lidar against the ground truth")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder with the captures (OUT_DIR of main_dataset.py or OUT_ROOT of batch_dataset.py)', default="_out")
+parser.add_argument('-p', '--prediction', type=str, help='Folder of each capture with the predicted grids (.npz of voxel grids or of lidar_voxel)', default="lidar_voxel")
+parser.add_argument('--pred_dir', type=str, help='Root of the predictions with the same folders of the captures of IN_DIR (default = IN_DIR)', default=None)
+parser.add_argument('--points', type=int, help='Also the distance of the lidar points to the nearest point of the ground truth (.ply)', default=1)
+parser.add_argument('--bands', type=float, nargs='+', help='Limits of the height bands in meters (Z of the ego frame, the ground is about -2.5)', default=[-4, -2, 0, 2.4])
+parser.add_argument('--voxel_size', type=float, help='Voxel size of the grids (for the height bands)', default=0.4)
+parser.add_argument('--min_z', type=float, help='Minimum Z of the grids (for the height bands)', default=-4)
+parser.add_argument('-w', '--workers', type=int, help='Number of processes (0 = number of CPUs)', default=0)
+parser.add_argument('-c', '--chunk_size', type=int, help='Number of frames processed by each task', default=16)
+parser.add_argument('-o', '--output', type=str, help='JSON file of the report (default = IN_DIR/evaluation.json)', default=None)
+
+
+"""
+    Evaluation of the frames of a dataset, grouped by the weather, town and route of each capture (like dataset_stats):
+    - Predicted grids vs 'ground_truth_voxel': IoU, precision and recall of the occupied voxels, of all the grid and
+      of each height band. The grids are packed in bits (one row of bits per Z level), so the true positives,
+      false positives and false negatives of each level are the popcount of an AND of the packed rows.
+    - Lidar vs ground truth point cloud: distance of each lidar point (inside the grid) to the nearest point of the
+      ground truth (.ply), with the KD-tree of open3d. It measures the alignment of the lidar and the ground truth.
+
+    The frames are streamed in chunks to a pool of processes and each chunk returns partial results (counts and
+    histograms, not means), merged by capture and then by group.
+"""
+
+GRID_MIN = np.array([-40, -40, -4])     # Bounds of 'ground_truth.occupancy_grid_map', the lidar points outside are not evaluated
+GRID_MAX = np.array([40, 40, 2.4])
+
+DISTANCE_BIN = 0.01                     # Histogram of the distances: bins of 1 cm up to 10 m (the last one has the farther ones)
+DISTANCE_BINS = 1000
+DISTANCE_THRESHOLDS = (0.1, 0.2, 0.4)   # Ratio of the lidar points nearer than each distance to the ground truth
+
+_FRAME_NUMBER = re.compile(r'_?(\d+)\.\w+$')
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+"""
+    Bit-packed occupancy
+"""
+
+def pack_occupancy(occupied):
+    """
+    Occupancy grid (X, Y, Z) packed in bits by height level.
+
+    :return: Array (Z, ceil(X * Y / 8)) uint8, the bits of each row are the voxels of one Z level.
+    """
+    levels = np.ascontiguousarray(np.moveaxis(occupied, 2, 0)).reshape(occupied.shape[2], -1)
+
+    return np.packbits(levels, axis=1)
+
+
+def popcount(packed):
+    """Number of bits set in each row of a packed array (np.bitwise_count of numpy 2 or a table of the 256 bytes)."""
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed).sum(axis=-1, dtype=np.int64)
+
+    return _POPCOUNT[packed].sum(axis=-1, dtype=np.int64)
+
+
+def confusion_by_level(predicted, ground_truth):
+    """
+    True positives, false positives and false negatives of each Z level of 2 packed grids (see 'pack_occupancy').
+
+    :return: Arrays (Z,) int64 with the TP, FP and FN of each level.
+    """
+    true_positives = popcount(predicted & ground_truth)
+    # The padding bits of the rows are 0 in both grids, so the ANDs with a NOT never count them
+    false_positives = popcount(predicted & ~ground_truth)
+    false_negatives = popcount(~predicted & ground_truth)
+
+    return true_positives, false_positives, false_negatives
+
+
+def load_occupancy(path):
+    """
+    Occupied voxels (X, Y, Z) bool of a grid: a voxel grid (arr_0, also the base level of the pyramids) or the
+    sparse voxels of 'lidar_voxel' (only the indices of the occupied voxels are read).
+    """
+    with np.load(path) as data:
+        if "voxels" in data.files:
+            grid_size = tuple(int(size) for size in data["grid_size"])
+            occupied = np.zeros(int(np.prod(grid_size)), dtype=bool)
+            occupied[data["voxels"]] = True
+            return occupied.reshape(grid_size)
+        return data["arr_0"] != 0
+
+
+def band_levels(bands, n_levels, voxel_size=0.4, min_z=-4):
+    """
+    Z levels of each height band (a level is in the band of its center).
+
+    :return: Dictionary {"<min>_<max>": (first level, last level + 1)}.
+    """
+    centers = min_z + (np.arange(n_levels) + 0.5) * voxel_size
+    levels = {}
+    for low, high in zip(bands[:-1], bands[1:]):
+        inside = np.flatnonzero((centers >= low) & (centers < high))
+        if len(inside):
+            levels[f"{low:g}_{high:g}"] = (int(inside[0]), int(inside[-1]) + 1)
+
+    return levels
+
+
+"""
+    Lidar vs ground truth point clouds
+"""
+
+def nearest_distances(points, reference):
+    """Distance of each point to the nearest point of 'reference' (KD-tree of open3d)."""
+
+    cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64)))
+    reference_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(reference, dtype=np.float64)))
+
+    return np.asarray(cloud.compute_point_cloud_distance(reference_cloud))
+
+
+def inside_grid(points):
+    """Points inside the bounds of the voxel grid."""
+
+    return points[np.all((points >= GRID_MIN) & (points < GRID_MAX), axis=1)]
+
+
+"""
+    Partial results
+"""
+
+def create_partial(n_levels=0):
+    """Empty partial results (all the values are sums, so the partials are merged by adding them)."""
+
+    return {
+        "frames": 0,
+        "true_positives": np.zeros(n_levels, dtype=np.int64),      # Of each Z level
+        "false_positives": np.zeros(n_levels, dtype=np.int64),
+        "false_negatives": np.zeros(n_levels, dtype=np.int64),
+        "iou_sum": 0.0,                                             # Sum of the IoU of each frame (mean of the frames)
+        "lidar_frames": 0,
+        "distance_count": 0,
+        "distance_sum": 0.0,
+        "distance_sq_sum": 0.0,
+        "distance_max": 0.0,
+        "distance_histogram": np.zeros(DISTANCE_BINS + 1, dtype=np.int64),
+    }
+
+
+def merge_partials(a, b):
+    """Merge 2 partial results (a new dictionary is returned)."""
+
+    merged = {}
+    for key, value in a.items():
+        other = b[key]
+        if key == "distance_max":
+            merged[key] = max(value, other)
+        elif isinstance(value, np.ndarray) and value.shape != other.shape:
+            if value.size and other.size:
+                raise ValueError(f"Grids with a different number of levels: {value.shape} and {other.shape}")
+            merged[key] = (other if value.size == 0 else value).copy()     # The empty partials have no levels
+        else:
+            merged[key] = value + other
+
+    return merged
+
+
+def frame_partial(frame, evaluate_points=True):
+    """Partial results of only one frame."""
+
+    ground_truth = load_occupancy(frame["voxel"])
+    partial = create_partial(ground_truth.shape[2])
+
+    if frame["prediction"] is not None:
+        predicted = load_occupancy(frame["prediction"])
+        if predicted.shape != ground_truth.shape:
+            raise ValueError(f"The grid of {frame['prediction']} {predicted.shape} is not the grid of the ground truth {ground_truth.shape}")
+        true_positives, false_positives, false_negatives = confusion_by_level(pack_occupancy(predicted), pack_occupancy(ground_truth))
+        union = int(true_positives.sum() + false_positives.sum() + false_negatives.sum())
+        partial.update({
+            "frames": 1,
+            "true_positives": true_positives,
+            "false_positives": false_positives,
+            "false_negatives": false_negatives,
+            "iou_sum": true_positives.sum() / union if union else 1.0,
+        })
+
+    if evaluate_points and frame["lidar"] is not None and frame["points"] is not None:
+        lidar_points, _ = lidar_storage.load_lidar(frame["lidar"])
+        lidar_points = inside_grid(lidar_points)
+        reference = np.asarray(o3d.io.read_point_cloud(frame["points"]).points)
+        if len(lidar_points) and len(reference):
+            distances = nearest_distances(lidar_points, reference)
+            bins = np.minimum((distances * (1.0 / DISTANCE_BIN)).astype(np.int64), DISTANCE_BINS)
+            partial.update({
+                "lidar_frames": 1,
+                "distance_count": len(distances),
+                "distance_sum": float(distances.sum()),
+                "distance_sq_sum": float(np.dot(distances, distances)),
+                "distance_max": float(distances.max()),
+                "distance_histogram": np.bincount(bins, minlength=DISTANCE_BINS + 1),
+            })
+
+    return partial
+
+
+def _process_chunk(task):
+    """Task of the pool: partial results of a chunk of frames of the same capture."""
+
+    capture, frames, evaluate_points = task
+    partial = create_partial()
+    for frame in frames:
+        partial = merge_partials(partial, frame_partial(frame, evaluate_points))
+
+    return capture, partial
+
+
+def _files_by_number(folder, extension):
+    """Files of a folder by their frame number ({} if the folder doesn't exist)."""
+
+    files = {}
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            match = _FRAME_NUMBER.search(name)
+            if match and name.endswith(extension):
+                files[int(match.group(1))] = os.path.join(folder, name)
+
+    return files
+
+
+def find_frames(in_dir, prediction="lidar_voxel", pred_dir=None):
+    """
+    Find the frames of all the captures in 'in_dir' (the folders with a 'ground_truth_voxel' folder), with the
+    prediction, lidar points and ground truth point cloud of each frame matched by the frame number.
+
+    :param pred_dir: Root of the predictions, with the same relative folders of the captures (None = 'in_dir').
+
+    :return: Dictionary {capture folder: [{"voxel", "prediction", "lidar", "points"}]} (None if a file is missing).
+    """
+    captures = {}
+    for root, dirs, _ in os.walk(in_dir):
+        if "ground_truth_voxel" not in dirs:
+            continue
+        dirs[:] = []    # Don't look for captures in the folders of the data
+
+        prediction_root = root if pred_dir is None else os.path.join(pred_dir, os.path.relpath(root, in_dir))
+        predictions = _files_by_number(os.path.join(prediction_root, prediction), ".npz")
+        lidar = _files_by_number(os.path.join(root, "lidar_points"), ".npz")
+        points = _files_by_number(os.path.join(root, "ground_truth"), ".ply")
+
+        captures[root] = [{"voxel": path, "prediction": predictions.get(number), "lidar": lidar.get(number), "points": points.get(number)}
+                          for number, path in sorted(_files_by_number(os.path.join(root, "ground_truth_voxel"), ".npz").items())]
+
+    return captures
+
+
+def evaluate(in_dir, prediction="lidar_voxel", pred_dir=None, evaluate_points=True, workers=0, chunk_size=16):
+    """
+    Evaluate every capture of 'in_dir', streaming chunks of frames to a pool of processes.
+
+    :return: Dictionary {capture: partial results}.
+    """
+    tasks = []
+    for capture, frames in find_frames(in_dir, prediction, pred_dir).items():
+        tasks += [(capture, frames[i:i + chunk_size], evaluate_points) for i in range(0, len(frames), chunk_size)]
+
+    captures = {}
+    if tasks:
+        with multiprocessing.Pool(workers or os.cpu_count()) as pool:
+            for capture, partial in pool.imap_unordered(_process_chunk, tasks):
+                captures[capture] = merge_partials(captures.get(capture, create_partial()), partial)
+
+    return captures
+
+
+"""
+    Report
+"""
+
+def scores(true_positives, false_positives, false_negatives):
+    """IoU, precision and recall of the counts of the voxels (1 if there are no voxels to count)."""
+
+    union = true_positives + false_positives + false_negatives
+    predicted = true_positives + false_positives
+    occupied = true_positives + false_negatives
+
+    return {
+        "iou": true_positives / union if union else 1.0,
+        "precision": true_positives / predicted if predicted else 1.0,
+        "recall": true_positives / occupied if occupied else 1.0,
+    }
+
+
+def summarize(partial, bands, voxel_size=0.4, min_z=-4):
+    """Scores and statistics of the distances of a partial results (JSON serializable)."""
+
+    summary = {"frames": partial["frames"], "lidar_frames": partial["lidar_frames"]}
+    if partial["frames"]:
+        true_positives, false_positives, false_negatives = (partial[key] for key in ("true_positives", "false_positives", "false_negatives"))
+        summary.update(scores(int(true_positives.sum()), int(false_positives.sum()), int(false_negatives.sum())))
+        summary["iou_frame_mean"] = partial["iou_sum"] / partial["frames"]
+        summary["bands"] = {band: scores(int(true_positives[first:last].sum()), int(false_positives[first:last].sum()), int(false_negatives[first:last].sum()))
+                            for band, (first, last) in band_levels(bands, len(true_positives), voxel_size, min_z).items()}
+
+    count = partial["distance_count"]
+    if count:
+        mean = partial["distance_sum"] / count
+        cumulative = np.cumsum(partial["distance_histogram"])
+        # Percentiles with the resolution of the histogram (upper edge of the bin)
+        percentile = lambda q: float(min(np.searchsorted(cumulative, q * count) + 1, DISTANCE_BINS) * DISTANCE_BIN)
+        summary["distance"] = {
+            "points": count,
+            "mean": mean,
+            "std": float(np.sqrt(max(partial["distance_sq_sum"] / count - mean ** 2, 0))),
+            "median": percentile(0.5),
+            "p90": percentile(0.9),
+            "p95": percentile(0.95),
+            "max": partial["distance_max"],
+        }
+        for threshold in DISTANCE_THRESHOLDS:
+            summary["distance"][f"within_{threshold:g}"] = float(cumulative[int(round(threshold / DISTANCE_BIN)) - 1] / count)
+
+    return summary
+
+
+def build_report(captures, bands, voxel_size=0.4, min_z=-4):
+    """Results of all the dataset and of each weather, town and route (merging the partials of the captures)."""
+
+    groups = {"weather": {}, "town": {}, "route": {}}
+    total = create_partial()
+    for capture, partial in captures.items():
+        group = capture_group(capture)
+        for key in groups:
+            name = group[key] if key != "route" else f"{group['town']}_{group['route']}"
+            groups[key][name] = merge_partials(groups[key].get(name, create_partial()), partial)
+        total = merge_partials(total, partial)
+
+    report = {"total": summarize(total, bands, voxel_size, min_z)}
+    for key, partials in groups.items():
+        report[key] = {name: summarize(partial, bands, voxel_size, min_z) for name, partial in sorted(partials.items())}
+
+    return report
+
+
+def print_report(report):
+    """Print the report as tables (the IoU of each height band after the scores of all the grid)."""
+
+    band_names = list(report["total"].get("bands", {}))
+    for key in ("weather", "town", "route"):
+        header = "".join(f"{'IoU ' + band:>14}" for band in band_names)
+        print(f"\n{key.upper():<24}{'frames':>8}{'IoU':>8}{'prec':>8}{'recall':>8}{header}{'dist mean':>11}{'median':>8}{'p95':>8}")
+        for name, summary in list(report[key].items()) + [("TOTAL", report["total"])]:
+            grid = "".join(f"{summary[score]:>8.3f}" for score in ("iou", "precision", "recall")) if "iou" in summary else f"{'-':>8}" * 3
+            band_scores = "".join(f"{summary['bands'][band]['iou']:>14.3f}" if band in summary.get("bands", {}) else f"{'-':>14}" for band in band_names)
+            distance = summary.get("distance")
+            distances = f"{distance['mean']:>11.3f}{distance['median']:>8.2f}{distance['p95']:>8.2f}" if distance else f"{'-':>11}{'-':>8}{'-':>8}"
+            print(f"{name:<24}{summary['frames']:>8}{grid}{band_scores}{distances}")
+
+
+def main(args):
+
+    start = time.perf_counter()
+    captures = evaluate(args.in_dir, args.prediction, args.pred_dir, args.points, args.workers, args.chunk_size)
+    if not captures:
+        print(f"No captures (folders with ground_truth_voxel) in {args.in_dir}")
+        return
+
+    report = build_report(captures, args.bands, args.voxel_size, args.min_z)
+    print_report(report)
+
+    output = args.output or os.path.join(args.in_dir, "evaluation.json")
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    print(f"\n{report['total']['frames']} frames with prediction ({report['total']['lidar_frames']} with lidar distances) "
+          f"in {time.perf_counter() - start:.2f} s, report saved in {output}")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,375 @@
+from utils.ground_truth import ground_truth
+from utils.lidar import lidar_storage, lidar_voxel
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import zipfile
+import numpy as np
+import open3d as o3d
+
+parser = argparse.ArgumentParser(description="Derive the products of the captures with other parameters, reusing the results already computed")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder with the captures (OUT_DIR of main_dataset.py or OUT_ROOT of batch_dataset.py)', default="_out")
+parser.add_argument('-c', '--cache_dir', type=str, help='Folder of the cache (shared by all the jobs)', default="_cache")
+parser.add_argument('-p', '--products', type=str, nargs='+', help='Products to derive', default=["occupancy"], choices=["downsampled", "occupancy", "lidar_grid", "bev"])
+parser.add_argument('-l', '--leaf_size', type=float, help='Leaf size of the downsampling of the ground truth (0 = the points saved). The .ply of the captures are already downsampled, so it can\'t be smaller than --capture_leaf_size', default=0.2)
+parser.add_argument('--capture_leaf_size', type=float, help='Leaf size used by main_dataset.py to save the ground truth (.ply) of the captures', default=0.2)
+parser.add_argument('-v', '--voxel_size', type=float, help='Voxel size of the grids', default=0.4)
+parser.add_argument('--max_range_xy', type=float, help='Half of the size of the grids in X and Y (meters)', default=40)
+parser.add_argument('--range_z', type=float, nargs=2, help='Minimum and maximum height of the grids (meters)', default=[-4, 2.4])
+parser.add_argument('--max_gb', type=float, help='Maximum size of the cache in GB (the least recently used entries are evicted)', default=20)
+parser.add_argument('-w', '--workers', type=int, help='Number of processes (0 = number of CPUs)', default=0)
+parser.add_argument('--export', type=int, help='Also save the products in each capture, in a folder with the name of the product and parameters', default=0)
+
+
+"""
+    Content-addressed cache of the products derived from the frames of the captures: downsampled ground truth,
+    occupancy grid, lidar grid and bird's eye view (BEV).
+
+    Each entry is keyed by the hash of its source (the content of the file of the frame, or the key of the product
+    it is derived from) and of the exact parameters and version of the code of the product, so any job with the same
+    frame and parameters reuses it and the jobs with other parameters only compute what changed (another voxel size
+    reuses the downsampled ground truth). The entries are .npz files named by their key, written atomically, so
+    several processes can share the cache. When the cache is bigger than 'max_bytes' the least recently used
+    entries are evicted (the access time is the modification time of the file, updated in each hit) down to 90% of
+    'max_bytes', so the next misses don't scan the cache again. The processes of a job don't evict (they don't know
+    the size of the cache), the job evicts once at the end.
+
+    The source of the ground truth is the .ply of the captures, already downsampled by main_dataset.py (0.2 m by
+    default), so the products can't be derived with a smaller leaf size (see 'check_leaf_size').
+"""
+
+# Version of the code of each product, increment it when the code changes (the old entries are not used anymore)
+CODE_VERSIONS = {
+    "downsampled": 1,
+    "occupancy": 1,
+    "lidar_grid": 1,
+    "bev": 1,
+}
+
+CAPTURE_LEAF_SIZE = 0.2         # Default leaf size of the ground truth saved by main_dataset.py
+
+_HASH_CHUNK = 1 << 20
+_LOW_WATER = 0.9                # The eviction leaves the cache at this ratio of 'max_bytes'
+
+_worker_cache = None            # Cache of each process of the pool (see '_init_worker')
+
+
+def create_cache(cache_dir, max_bytes=20 * 2**30):
+    """
+    Open (or create) the cache in 'cache_dir'.
+
+    :param max_bytes: Maximum size of the cache, None to never evict (the size is not computed, no scan of the cache).
+
+    :return: Dictionary with the state of the cache (hits and misses of this process).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return {
+        "dir": cache_dir,
+        "max_bytes": max_bytes,
+        "size": cache_size(cache_dir) if max_bytes is not None else 0,
+        "hits": 0,
+        "misses": 0,
+        "file_digests": {},         # Hash of the source files already read {(path, size, mtime): digest}
+    }
+
+
+def _entries(cache_dir):
+    """Path, size and access time of all the entries of the cache."""
+
+    entries = []
+    for folder in os.listdir(cache_dir):
+        folder_path = os.path.join(cache_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for name in os.listdir(folder_path):
+            if name.endswith(".npz"):
+                stat = os.stat(os.path.join(folder_path, name))
+                entries.append((os.path.join(folder_path, name), stat.st_size, stat.st_mtime))
+
+    return entries
+
+
+def cache_size(cache_dir):
+    """Size in bytes of the entries of the cache."""
+
+    return sum(size for _, size, _ in _entries(cache_dir))
+
+
+def evict(cache):
+    """
+    Remove the least recently used entries until the cache is smaller than 90% of 'max_bytes'.
+
+    :return: Number of entries removed.
+    """
+    entries = sorted(_entries(cache["dir"]), key=lambda entry: entry[2])
+    size = sum(entry[1] for entry in entries)
+    removed = 0
+    for path, entry_size, _ in entries:
+        if size <= cache["max_bytes"] * _LOW_WATER:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass                    # Already removed by another process
+        size -= entry_size
+        removed += 1
+    cache["size"] = size
+
+    return removed
+
+
+def file_digest(cache, path):
+    """Hash of the content of a source file (computed once for each version of the file)."""
+
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if signature not in cache["file_digests"]:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(_HASH_CHUNK), b""):
+                digest.update(chunk)
+        cache["file_digests"][signature] = digest.hexdigest()
+
+    return cache["file_digests"][signature]
+
+
+def artifact_key(product, source, params):
+    """Key of a product: hash of the product, the version of its code, its source and parameters."""
+
+    description = json.dumps({"product": product, "version": CODE_VERSIONS[product], "source": source, "params": params},
+                             sort_keys=True)
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+def _entry_path(cache, key):
+    return os.path.join(cache["dir"], key[:2], key + ".npz")
+
+
+def get_or_compute(cache, product, source, params, compute):
+    """
+    Get a product from the cache, or compute it and save it in the cache.
+
+    :param source: Hash of the source (see 'file_digest' or the key of another product).
+    :param params: Dictionary with the parameters of the product (JSON types).
+    :param compute: Function without arguments that returns the product (dictionary of arrays).
+
+    :return: Key of the product and its arrays.
+    """
+    key = artifact_key(product, source, params)
+    path = _entry_path(cache, key)
+    try:
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        arrays = None               # Not in the cache (or evicted by another process), computed again
+    if arrays is not None:
+        try:
+            os.utime(path)          # Most recently used
+        except FileNotFoundError:
+            pass
+        cache["hits"] += 1
+        return key, arrays
+
+    arrays = compute()
+    cache["misses"] += 1
+
+    # Written in a temporary file and renamed, so the other processes never read a partial entry
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    file, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(file, 'wb') as temp_file:
+        np.savez_compressed(temp_file, **arrays)
+    os.replace(temp_path, path)
+
+    cache["size"] += os.path.getsize(path)
+    if cache["max_bytes"] is not None and cache["size"] > cache["max_bytes"]:
+        evict(cache)
+
+    return key, arrays
+
+
+"""
+    Products
+"""
+
+def grid_params(voxel_size=0.4, max_range_X_Y=40, min_range_Z=-4, max_range_Z=2.4):
+    """Parameters of the grids (the options of 'ground_truth.occupancy_grid_map')."""
+
+    return {"voxel_size": float(voxel_size), "max_range_X_Y": float(max_range_X_Y),
+            "min_range_Z": float(min_range_Z), "max_range_Z": float(max_range_Z)}
+
+
+def check_leaf_size(leaf_size, capture_leaf_size=CAPTURE_LEAF_SIZE):
+    """Raise a ValueError if 'leaf_size' is smaller than the leaf size of the ground truth saved in the captures."""
+
+    if 0 < leaf_size < capture_leaf_size:
+        raise ValueError(f"The ground truth of the captures is already downsampled with a leaf size of {capture_leaf_size} m, "
+                         f"it can't be downsampled with {leaf_size} m (use 0 for the points saved)")
+
+
+def downsampled_cloud(cache, ground_truth_path, leaf_size):
+    """
+    Ground truth of a frame (.ply of main_dataset.py) downsampled with 'leaf_size' (0 = the points saved).
+    The .ply is already downsampled (see 'check_leaf_size'), a smaller leaf size gives the points of the capture.
+
+    :return: Key of the product and its arrays ("points" (N, 3) float32).
+    """
+    def compute():
+        points = np.asarray(o3d.io.read_point_cloud(ground_truth_path).points, dtype=np.float32)
+        if leaf_size > 0:
+            points, _ = ground_truth.downsample(points, np.zeros_like(points), leaf_size)
+        return {"points": np.array(points, dtype=np.float32)}
+
+    return get_or_compute(cache, "downsampled", file_digest(cache, ground_truth_path), {"leaf_size": float(leaf_size)}, compute)
+
+
+def occupancy(cache, ground_truth_path, leaf_size, grid):
+    """
+    Occupancy grid of the ground truth of a frame, with the grid 'grid' (see 'grid_params').
+    The downsampled ground truth is only read if the grid is not in the cache (its key doesn't need the points).
+
+    :return: Key of the product and its arrays ("grid" (X, Y, Z) int8).
+    """
+    source = artifact_key("downsampled", file_digest(cache, ground_truth_path), {"leaf_size": float(leaf_size)})
+
+    def compute():
+        _, cloud = downsampled_cloud(cache, ground_truth_path, leaf_size)
+        return {"grid": ground_truth.occupancy_grid_map(cloud["points"], **grid)}
+
+    return get_or_compute(cache, "occupancy", source, grid, compute)
+
+
+def lidar_grid(cache, lidar_path, grid):
+    """
+    Lidar grid of a frame (see 'lidar_voxel.voxelize_lidar'), from the lidar points of main_dataset.py.
+
+    :return: Key of the product and its arrays (the sparse features of 'voxelize_lidar').
+    """
+    def compute():
+        points, intensity = lidar_storage.load_lidar(lidar_path)
+        return lidar_voxel.voxelize_lidar(points, intensity, **grid)
+
+    return get_or_compute(cache, "lidar_grid", file_digest(cache, lidar_path), grid, compute)
+
+
+def bev(cache, ground_truth_path, leaf_size, grid):
+    """
+    Bird's eye view of the occupancy grid of a frame: occupied columns and the height of their highest occupied voxel.
+
+    :return: Key of the product and its arrays ("occupied" (X, Y) uint8 and "height" (X, Y) float32 meters, NaN if empty).
+    """
+    source = artifact_key("occupancy", artifact_key("downsampled", file_digest(cache, ground_truth_path), {"leaf_size": float(leaf_size)}), grid)
+
+    def compute():
+        _, occupancy_grid = occupancy(cache, ground_truth_path, leaf_size, grid)
+        occupied = occupancy_grid["grid"].astype(bool)
+        top = occupied.shape[2] - 1 - np.argmax(occupied[:, :, ::-1], axis=2)     # Highest occupied voxel of each column
+        column_occupied = occupied.any(axis=2)
+        height = grid["min_range_Z"] + (top + 1) * grid["voxel_size"]
+        return {"occupied": column_occupied.astype(np.uint8),
+                "height": np.where(column_occupied, height, np.nan).astype(np.float32)}
+
+    return get_or_compute(cache, "bev", source, {}, compute)
+
+
+def product_folder(product, leaf_size, grid):
+    """Name of the folder of the exported products with their parameters, e.g. 'occupancy_leaf0.2_voxel0.4'."""
+
+    name = product
+    if product != "lidar_grid":
+        name += f"_leaf{leaf_size:g}"
+    if product != "downsampled":
+        name += f"_voxel{grid['voxel_size']:g}"
+        if (grid["max_range_X_Y"], grid["min_range_Z"], grid["max_range_Z"]) != (40, -4, 2.4):
+            name += f"_xy{grid['max_range_X_Y']:g}_z{grid['min_range_Z']:g}_{grid['max_range_Z']:g}"
+
+    return name
+
+
+"""
+    Jobs
+"""
+
+def find_frames(in_dir):
+    """Captures with their ground truth (.ply) and lidar points (.npz) of each frame, matched by the name of the file."""
+
+    frames = []
+    for root, dirs, _ in os.walk(in_dir):
+        if "ground_truth" not in dirs:
+            continue
+        dirs[:] = []
+        lidar_dir = os.path.join(root, "lidar_points")
+        for name in sorted(os.listdir(os.path.join(root, "ground_truth"))):
+            if not name.endswith(".ply"):
+                continue
+            lidar_path = os.path.join(lidar_dir, os.path.splitext(name)[0] + ".npz")
+            frames.append({"capture": root, "name": os.path.splitext(name)[0],
+                           "ground_truth": os.path.join(root, "ground_truth", name),
+                           "lidar": lidar_path if os.path.exists(lidar_path) else None})
+
+    return frames
+
+
+def _init_worker(cache_dir):
+    """Initializer of the processes of the pool: open the cache once, without its size (no eviction in the processes)."""
+
+    global _worker_cache
+    _worker_cache = create_cache(cache_dir, max_bytes=None)
+
+
+def _process_chunk(task):
+    """Task of the pool: derive the products of some frames with the cache of the process."""
+
+    frames, products, leaf_size, grid, export = task
+    cache = _worker_cache
+    hits, misses = cache["hits"], cache["misses"]
+    for frame in frames:
+        for product in products:
+            if product == "lidar_grid":
+                if frame["lidar"] is None:
+                    continue
+                _, arrays = lidar_grid(cache, frame["lidar"], grid)
+            elif product == "downsampled":
+                _, arrays = downsampled_cloud(cache, frame["ground_truth"], leaf_size)
+            elif product == "occupancy":
+                _, arrays = occupancy(cache, frame["ground_truth"], leaf_size, grid)
+            else:
+                _, arrays = bev(cache, frame["ground_truth"], leaf_size, grid)
+
+            if export:
+                folder = os.path.join(frame["capture"], product_folder(product, leaf_size, grid))
+                os.makedirs(folder, exist_ok=True)
+                np.savez_compressed(os.path.join(folder, frame["name"] + ".npz"), **arrays)
+
+    return cache["hits"] - hits, cache["misses"] - misses
+
+
+def main(args):
+    check_leaf_size(args.leaf_size, args.capture_leaf_size)
+    frames = find_frames(args.in_dir)
+    grid = grid_params(args.voxel_size, args.max_range_xy, args.range_z[0], args.range_z[1])
+    max_bytes = int(args.max_gb * 2**30)
+    print(f"{len(frames)} frames | Products: {', '.join(args.products)} | Leaf size: {args.leaf_size} | Grid: {grid}")
+
+    # Chunks of consecutive frames, so the products of a frame are computed by the same process
+    chunk_size = 16
+    tasks = [(frames[start:start + chunk_size], args.products, args.leaf_size, grid, args.export)
+             for start in range(0, len(frames), chunk_size)]
+    hits = misses = 0
+    with multiprocessing.Pool(args.workers or os.cpu_count(), initializer=_init_worker, initargs=(args.cache_dir,)) as pool:
+        for done, (chunk_hits, chunk_misses) in enumerate(pool.imap_unordered(_process_chunk, tasks), 1):
+            hits += chunk_hits
+            misses += chunk_misses
+            print(f"{min(done * chunk_size, len(frames))}/{len(frames)}")
+
+    # The processes only add entries, the eviction is done once at the end (only if the cache is too big)
+    cache = create_cache(args.cache_dir, max_bytes)
+    removed = evict(cache) if cache["size"] > max_bytes else 0
+    print(f"Hits: {hits} | Misses: {misses} | Evicted: {removed} | Cache size: {cache['size'] / 2**30:.2f} GB")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,397 @@
+from utils.lidar import lidar_voxel, lidar_storage, range_image
+from utils.capture import depth_storage
+from utils.ground_truth import occupancy_pyramid
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import open3d as o3d
+
+parser = argparse.ArgumentParser(description="Batch loader of the final datasets")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder of a split (with the rgb, depth, lidar and ground_truth folders of create_final_dataset.py)', default="../DataSets_final/NightCloudy/train")
+parser.add_argument('-b', '--batch_size', type=int, help='Number of samples of each batch', default=8)
+parser.add_argument('-w', '--workers', type=int, help='Number of processes that load the batches', default=4)
+parser.add_argument('--prefetch', type=int, help='Number of batches loaded ahead (also the number of batch buffers)', default=4)
+parser.add_argument('--shuffle_buffer', type=int, help='Size of the shuffle buffer (0 = no shuffle, >= number of samples = full shuffle)', default=1000)
+parser.add_argument('--max_points', type=int, help='Maximum number of points of the point clouds (the batches are padded to this size)', default=131072)
+parser.add_argument('-n', '--n_batches', type=int, help='Number of batches of the benchmark', default=50)
+parser.add_argument('-r', '--repeats', type=int, help='Number of runs of each loader in the benchmark, alternated (the median is used)', default=3)
+
+
+"""
+    Batch loader of the splits of the final datasets (train, validation and test of 'create_final_dataset.py'),
+    without any deep learning framework: each batch is a dictionary of stacked NumPy arrays.
+
+    The batches are loaded by a pool of processes directly in a ring of batch buffers in shared memory, so the
+    main process doesn't copy (or unpickle) the data and the buffers are reused in all the batches. The order of the
+    samples is shuffled with a shuffle buffer over the sorted files, so consecutive samples are near in the disk.
+
+    The data of each modality is decoded by its file type:
+    - .png: RGB images (H, W, 3) uint8 and depth images (H, W) uint8 (logarithmic depth of main_dataset.py).
+    - .npz / .npy: arrays (voxel grids, lidar points), the lidar voxel grids of 'lidar_voxel' (dense) and
+      the metric depth of 'depth_storage' (H, W) float32 meters and the lidar range images of 'range_image'
+      (3, channels, width) float32 with the range, intensity and valid mask.
+    - .ply: point clouds.
+    A level of the pyramids of the voxel grids (see 'occupancy_pyramid') is a modality "<folder>@<level>", e.g.
+    "ground_truth@1" (only that level is read), several levels of the same folder can be loaded at the same time.
+    The point clouds have a different number of points in each sample, so they are padded with zeros to
+    'max_points' and the batch has the number of points of each sample in '<modality>_count'.
+"""
+
+MODALITIES = ("rgb", "depth", "lidar", "ground_truth")
+
+
+def list_samples(split_dir, modalities=MODALITIES):
+    """
+    Files of each sample of a split. The files of each modality are matched by their sorted order
+    (the same of 'create_final_dataset.py').
+
+    :return: List of dictionaries {modality: path}.
+    """
+    files = {}
+    for modality in modalities:
+        folder = os.path.join(split_dir, modality.split("@")[0])
+        files[modality] = [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+
+    n_samples = {modality: len(paths) for modality, paths in files.items()}
+    if len(set(n_samples.values())) > 1:
+        raise ValueError(f"The modalities of {split_dir} have a different number of files: {n_samples}")
+
+    return [dict(zip(files.keys(), paths)) for paths in zip(*files.values())]
+
+
+def load_file(path, modality):
+    """Decode one file of a sample (see the types in the docstring of the module)."""
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".png", ".jpg", ".jpeg", ".webp"):
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise IOError(f"Failed to read {path}")
+        if modality == "depth":
+            return image[:, :, 0] if image.ndim == 3 else image     # The 3 channels are the same
+        return cv2.cvtColor(image[:, :, :3], cv2.COLOR_BGR2RGB) if image.ndim == 3 else image
+    if extension == ".npz":
+        if "@" in modality:
+            return occupancy_pyramid.load_level(path, int(modality.split("@")[1]))
+        with np.load(path) as data:
+            if "voxels" in data.files:
+                return lidar_voxel.densify({key: data[key] for key in data.files})
+            if "range_scale" in data.files:
+                image = range_image.decode_range_image(data)
+                return np.stack([image["range"], image["intensity"], image["mask"]])
+            if "points" in data.files:
+                return lidar_storage.decode_lidar({key: data[key] for key in data.files})[0]
+            if "scale" in data.files:
+                return depth_storage.decode_depth(data["depth"], float(data["scale"]))
+            return data[data.files[0]]
+    if extension == ".npy":
+        return np.load(path)
+    if extension == ".ply":
+        return np.asarray(o3d.io.read_point_cloud(path).points, dtype=np.float32)
+
+    raise ValueError(f"Unknown type of file: {path}")
+
+
+def _is_point_cloud(array):
+    return array.ndim == 2 and array.shape[1] == 3
+
+
+def load_sample(sample):
+    """Decode all the files of a sample, {modality: array}."""
+
+    return {modality: load_file(path, modality) for modality, path in sample.items()}
+
+
+def batch_specs(sample, batch_size, max_points):
+    """
+    Shape and type of each array of a batch, from the first sample.
+
+    :return: Dictionary {name: (shape, dtype)}.
+    """
+    specs = {}
+    for modality, array in load_sample(sample).items():
+        if _is_point_cloud(array):
+            specs[modality] = ((batch_size, max_points, 3), array.dtype)
+            specs[modality + "_count"] = ((batch_size,), np.dtype(np.int64))
+        else:
+            specs[modality] = ((batch_size,) + array.shape, array.dtype)
+
+    return specs
+
+
+def _batch_views(buffers, specs):
+    """Arrays of a batch in the shared memory of its buffers."""
+
+    return {name: np.ndarray(shape, dtype=dtype, buffer=buffers[name].buf) for name, (shape, dtype) in specs.items()}
+
+
+def fill_batch(batch, samples):
+    """
+    Decode the samples directly in the arrays of a batch (the last batch can have less samples than the batch size).
+
+    :return: Number of samples of the batch.
+    """
+    for i, sample in enumerate(samples):
+        for modality, path in sample.items():
+            array = load_file(path, modality)
+            if modality + "_count" in batch:
+                n_points = min(len(array), batch[modality].shape[1])
+                batch[modality][i, :n_points] = array[:n_points]
+                batch[modality][i, n_points:] = 0
+                batch[modality + "_count"][i] = n_points
+            else:
+                batch[modality][i] = array
+
+    return len(samples)
+
+
+def _worker(samples, buffer_names, specs, tasks, done):
+    """Process of the pool: load the batches of the tasks (slot, batch index, sample indices) in the buffers of the slot."""
+
+    cv2.setNumThreads(1)
+    buffers = [{name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in slot.items()} for slot in buffer_names]
+    batches = [_batch_views(slot, specs) for slot in buffers]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, batch_index, indices = task
+            try:
+                n_samples = fill_batch(batches[slot], [samples[i] for i in indices])
+                done.put((slot, batch_index, n_samples, None))
+            except Exception as error:
+                done.put((slot, batch_index, 0, f"{type(error).__name__}: {error}"))
+    finally:
+        del batches
+        for slot in buffers:
+            for shm in slot.values():
+                shm.close()
+
+
+def shuffle_buffer_order(n_samples, buffer_size, rng):
+    """
+    Order of the samples with a shuffle buffer: the samples are read in order into a buffer of 'buffer_size'
+    samples and each next sample is taken at random from the buffer.
+    """
+    if buffer_size <= 1:
+        return np.arange(n_samples)
+    if buffer_size >= n_samples:
+        return rng.permutation(n_samples)
+
+    order = np.empty(n_samples, dtype=np.int64)
+    buffer = list(range(buffer_size))
+    for i in range(n_samples):
+        position = rng.integers(len(buffer))
+        order[i] = buffer[position]
+        if buffer_size + i < n_samples:
+            buffer[position] = buffer_size + i
+        else:
+            buffer[position] = buffer[-1]
+            buffer.pop()
+
+    return order
+
+
+def create_loader(split_dir, batch_size=8, workers=4, prefetch=4, shuffle_buffer=1000, max_points=131072, modalities=MODALITIES, seed=0, drop_last=False):
+    """
+    Create the loader of a split: the shared memory of the batch buffers and the processes of the pool.
+
+    :param prefetch: Number of batches loaded ahead of the one used (each one has its buffers).
+    :param shuffle_buffer: Size of the shuffle buffer (0 = the order of the files).
+
+    :return: Dictionary with the state of the loader (see 'iterate_batches' and 'close_loader').
+    """
+    samples = list_samples(split_dir, modalities)
+    if not samples:
+        raise ValueError(f"No samples in {split_dir}")
+    specs = batch_specs(samples[0], batch_size, max_points)
+
+    # The ring of batch buffers: 'prefetch' batches being loaded and the one being used
+    n_slots = prefetch + 1
+    buffers = []
+    for _ in range(n_slots):
+        buffers.append({name: shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+                        for name, (shape, dtype) in specs.items()})
+    buffer_names = [{name: shm.name for name, shm in slot.items()} for slot in buffers]
+
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    tasks = context.Queue()
+    done = context.Queue()
+    processes = [context.Process(target=_worker, args=(samples, buffer_names, specs, tasks, done), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    return {
+        "samples": samples,
+        "specs": specs,
+        "batch_size": batch_size,
+        "prefetch": prefetch,
+        "shuffle_buffer": shuffle_buffer,
+        "drop_last": drop_last,
+        "rng": np.random.default_rng(seed),
+        "buffers": buffers,
+        "batches": [_batch_views(slot, specs) for slot in buffers],
+        "tasks": tasks,
+        "done": done,
+        "processes": processes,
+        "busy": False,
+    }
+
+
+def iterate_batches(loader, copy=False):
+    """
+    Iterate over the batches of one epoch (a new order of the samples in each epoch).
+
+    The arrays of each batch are in the shared memory of its buffers and are reused by the next batches
+    after the next iteration, use copy=True to keep them.
+
+    :return: Generator of dictionaries {name: stacked arrays}, with the number of samples in "size".
+    """
+    if loader["busy"]:
+        raise RuntimeError("The loader is already iterating (only one epoch at a time)")
+    loader["busy"] = True
+
+    batch_size = loader["batch_size"]
+    order = shuffle_buffer_order(len(loader["samples"]), loader["shuffle_buffer"], loader["rng"])
+    n_batches = len(order) // batch_size if loader["drop_last"] else -(-len(order) // batch_size)
+    free_slots = list(range(len(loader["buffers"])))
+    ready = {}
+    submitted = 0
+    in_flight = 0
+
+    def submit():
+        nonlocal submitted, in_flight
+        slot = free_slots.pop()
+        loader["tasks"].put((slot, submitted, order[submitted * batch_size:(submitted + 1) * batch_size].tolist()))
+        submitted += 1
+        in_flight += 1
+
+    try:
+        for batch_index in range(n_batches):
+            # Keep 'prefetch' batches loading (one buffer is the batch being used)
+            while submitted < n_batches and free_slots:
+                submit()
+
+            # The batches can finish out of order
+            while batch_index not in ready:
+                slot, index, n_samples, error = loader["done"].get()
+                in_flight -= 1
+                if error is not None:
+                    raise RuntimeError(f"Failed to load the batch {index}: {error}")
+                ready[index] = (slot, n_samples)
+            slot, n_samples = ready.pop(batch_index)
+
+            batch = {name: array[:n_samples] for name, array in loader["batches"][slot].items()}
+            if copy:
+                batch = {name: array.copy() for name, array in batch.items()}
+            batch["size"] = n_samples
+            yield batch
+
+            free_slots.append(slot)
+    finally:
+        # Wait for the batches still loading, so their buffers are not used by the next epoch while they are written
+        while in_flight > 0:
+            try:
+                loader["done"].get(timeout=30)
+            except queue.Empty:
+                break
+            in_flight -= 1
+        loader["busy"] = False
+
+
+def close_loader(loader):
+    """Stop the processes and free the shared memory."""
+
+    for _ in loader["processes"]:
+        loader["tasks"].put(None)
+    for process in loader["processes"]:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    loader["batches"] = None
+    for slot in loader["buffers"]:
+        for shm in slot.values():
+            shm.close()
+            shm.unlink()
+    loader["buffers"] = []
+
+
+def naive_batches(samples, batch_size, max_points):
+    """Batches loaded file by file in the main process and stacked with np.stack (the reference of the benchmark)."""
+
+    for start in range(0, len(samples), batch_size):
+        decoded = [load_sample(sample) for sample in samples[start:start + batch_size]]
+        batch = {}
+        for modality in decoded[0]:
+            arrays = [sample[modality] for sample in decoded]
+            if _is_point_cloud(arrays[0]):
+                padded = np.zeros((len(arrays), max_points, 3), dtype=arrays[0].dtype)
+                for i, array in enumerate(arrays):
+                    padded[i, :min(len(array), max_points)] = array[:max_points]
+                batch[modality] = padded
+            else:
+                batch[modality] = np.stack(arrays)
+        yield batch
+
+
+def _time_loader(loader, n_batches):
+    """Time to load 'n_batches' batches with a loader and the number of samples loaded."""
+
+    start = time.perf_counter()
+    loaded = 0
+    batches = iterate_batches(loader)
+    for i, batch in enumerate(batches):
+        loaded += batch["size"]
+        if i + 1 >= n_batches:
+            break
+    batches.close()     # Waits for the batches still loading, so the loader can iterate again
+
+    return time.perf_counter() - start, loaded
+
+
+def main(args):
+
+    samples = list_samples(args.in_dir)
+    n_batches = min(args.n_batches, -(-len(samples) // args.batch_size))
+    n_samples = min(n_batches * args.batch_size, len(samples))
+    print(f"{len(samples)} samples in {args.in_dir}, benchmark with {n_batches} batches of {args.batch_size}")
+
+    # The same samples in the same order (the loader without shuffle), the runs alternated so both read from the
+    # same page cache (the first run of the naive loader reads from the disk, the median is of the warm runs)
+    loader = create_loader(args.in_dir, args.batch_size, args.workers, args.prefetch, 0, args.max_points)
+    naive_times, loader_times = [], []
+    try:
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            for batch in naive_batches(samples[:n_samples], args.batch_size, args.max_points):
+                pass
+            naive_times.append(time.perf_counter() - start)
+
+            loader_time, loaded = _time_loader(loader, n_batches)
+            loader_times.append(loader_time)
+    finally:
+        close_loader(loader)
+    naive_time, loader_time = float(np.median(naive_times)), float(np.median(loader_times))
+    print(f"Naive:  {n_samples / naive_time:8.1f} samples/s")
+    print(f"Loader: {loaded / loader_time:8.1f} samples/s ({args.workers} workers, prefetch {args.prefetch}) | x{(loaded / loader_time) / (n_samples / naive_time):.2f}")
+
+    # Only for information: the loader with the shuffle buffer reads other samples in another order
+    if args.shuffle_buffer:
+        shuffled = create_loader(args.in_dir, args.batch_size, args.workers, args.prefetch, args.shuffle_buffer, args.max_points)
+        try:
+            shuffled_time, shuffled_loaded = _time_loader(shuffled, n_batches)
+        finally:
+            close_loader(shuffled)
+        print(f"Loader with shuffle buffer {args.shuffle_buffer}: {shuffled_loaded / shuffled_time:8.1f} samples/s (not comparable, other samples)")
+    print("Batch: " + ", ".join(f"{name} {tuple(shape)} {dtype}" for name, (shape, dtype) in loader["specs"].items()))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -1,90 +1,153 @@
 import carla
 import random
 
-def gennerate_vehicles(world, traffic_manager, blueprint_library, vehicle_spawn_point, number_of_vehicles=70):
+SpawnActor = carla.command.SpawnActor
+SetAutopilot = carla.command.SetAutopilot
+DestroyActor = carla.command.DestroyActor
+FutureActor = carla.command.FutureActor
+
+
+def apply_batch(client, batch, description, do_tick=False):
+    """
+    Run a batch of commands in only one request to the server and report the commands that failed.
+
+    :param client: The CARLA client.
+    :param batch: List of commands (carla.command.*).
+    :param description: What the commands do, to report the errors (e.g. "spawn vehicle").
+    :param do_tick: Tick the world after the batch (synchronous mode).
+
+    :return: List with the actor id of each command (None if it failed), in the same order of the batch.
+    """
+    actor_ids = []
+    for i, response in enumerate(client.apply_batch_sync(batch, do_tick)):
+        if response.error:
+            print(f"Failed to {description} {i}: {response.error}")
+            actor_ids.append(None)
+        else:
+            actor_ids.append(response.actor_id)
+
+    return actor_ids
+
+
+def gennerate_vehicles(client, world, traffic_manager, blueprint_library, vehicle_spawn_point, number_of_vehicles=70, max_batches=3, spawn_points=None):
+    """
+    Spawn the vehicles of the traffic with the autopilot of the traffic manager, with one batch of commands.
+    The spawn points that are blocked are replaced by other free spawn points in the next batch.
+
+    :param vehicle_spawn_point: Spawn point of the ego vehicle (not used for the traffic).
+    :param max_batches: Maximum number of batches to try to spawn all the vehicles.
+    :param spawn_points: Spawn points to use, if None all the spawn points of the map.
+    """
     vehicles_list = []
-    
-    spawn_points = world.get_map().get_spawn_points()
-
-    while len(vehicles_list) < number_of_vehicles:
-        #i = len(vehicles_list)
-        vehicle_bp = random.choice(blueprint_library.filter('vehicle.*'))
-        spawn_point = random.choice(spawn_points)
-        
-        if spawn_point != vehicle_spawn_point:
-
-            vehicle = world.try_spawn_actor(vehicle_bp, spawn_point)
-            vehicle.set_autopilot(True, traffic_manager.get_port())
-            traffic_manager.ignore_lights_percentage(vehicle, 80)  # Ignore all the red ligths
-            vehicles_list.append(vehicle)
-            #print(f"Spawned vehicle {i+1}/{number_of_vehicles}")
-            spawn_points.remove(spawn_point)
-            
-    print(f"Traffic vehicles spawned: {len(vehicles_list)}/{number_of_vehicles}")
-    
-    return vehicles_list
 
+    if spawn_points is None:
+        spawn_points = world.get_map().get_spawn_points()
+    spawn_points = [spawn_point for spawn_point in spawn_points if spawn_point != vehicle_spawn_point]
+    random.shuffle(spawn_points)
+    vehicle_blueprints = blueprint_library.filter('vehicle.*')
+    tm_port = traffic_manager.get_port()
 
-def gennerate_pedestrians(world, blueprint_library, number_of_pedestrians=50):
-    pedestrians_list = []
-    controllers_list = []
-    spawn_points = []
-    
-    # Retrieve pedestrian blueprints (filtered for walkers)
-    pedestrian_blueprints = blueprint_library.filter('walker.pedestrian.*')
-    
-    # Retrieve the pedestrian controller blueprint
-    walker_controller_bp = blueprint_library.find('controller.ai.walker')
+    for _ in range(max_batches):
+        n_spawn = min(number_of_vehicles - len(vehicles_list), len(spawn_points))
+        if n_spawn <= 0:
+            break
 
-    # Get the spawn points to pedestrians
-    while len(spawn_points) < number_of_pedestrians+50:
-        spawn_point = carla.Transform()
+        batch = []
+        for spawn_point in spawn_points[:n_spawn]:
+            vehicle_bp = random.choice(vehicle_blueprints)
+            batch.append(SpawnActor(vehicle_bp, spawn_point).then(SetAutopilot(FutureActor, True, tm_port)))
+        # Each spawn point is only tried once
+        spawn_points = spawn_points[n_spawn:]
 
-        loc = world.get_random_location_from_navigation()
-        if (loc != None):
-            spawn_point.location = loc
-            spawn_points.append(spawn_point)
+        actor_ids = [actor_id for actor_id in apply_batch(client, batch, "spawn vehicle") if actor_id is not None]
+        vehicles_list.extend(world.get_actors(actor_ids))
 
-    while len(pedestrians_list) < number_of_pedestrians:
-        #i = len(pedestrians_list)
-        # Choose a pedestrian blueprint and a spawn point randomly
-        pedestrian_bp = random.choice(pedestrian_blueprints)
-        spawn_point = random.choice(spawn_points)
+    for vehicle in vehicles_list:
+        traffic_manager.ignore_lights_percentage(vehicle, 80)  # Ignore the red ligths 80% of the times
 
-        # Spawn the pedestrian
-        pedestrian = world.try_spawn_actor(pedestrian_bp, spawn_point)
-        if pedestrian:
-            pedestrians_list.append(pedestrian)
-            #print(f"Spawned pedestrian {i+1}/{number_of_pedestrians}")
+    print(f"Traffic vehicles spawned: {len(vehicles_list)}/{number_of_vehicles}")
 
-            # Spawn the controller for the pedestrian
-            controller = world.try_spawn_actor(walker_controller_bp, carla.Transform(), pedestrian)
-            if controller:
-                controllers_list.append(controller)
+    return vehicles_list
 
-                world.tick()
 
-                controller.start()
+def gennerate_pedestrians(client, world, blueprint_library, number_of_pedestrians=50, max_batches=3, locations=None):
+    """
+    Spawn the pedestrians and their AI controllers, with one batch of commands for the pedestrians
+    and another one for the controllers (for each try). The world is only ticked once, before starting the controllers.
+
+    :param max_batches: Maximum number of batches to try to spawn all the pedestrians.
+    :param locations: Locations (carla.Location) to spawn the pedestrians (at most one per location) and where
+                      they walk to, if None random locations of the navigation mesh of the map.
+    """
+    if locations is None:
+        random_location = world.get_random_location_from_navigation
+        spawn_location = random_location
+    else:
+        random_location = lambda: random.choice(locations)
+        # The locations in random order, each one is only used once (also the ones of the failed spawns)
+        free_locations = random.sample(locations, len(locations))
+        spawn_location = lambda: free_locations.pop() if free_locations else None
 
-                # Get a random location for the pedestrian to walk to
-                target_location = world.get_random_location_from_navigation()
+    pedestrians_list = []
 
-                if target_location != None:
-                    # Validate the location is within bounds and reachable
-                    controller.go_to_location(target_location)
-                    controller.set_max_speed(1 + random.random())  # Random speed between 1 and 2 m/s
+    # Retrieve pedestrian blueprints (filtered for walkers)
+    pedestrian_blueprints = blueprint_library.filter('walker.pedestrian.*')
+
+    # Retrieve the pedestrian controller blueprint
+    walker_controller_bp = blueprint_library.find('controller.ai.walker')
 
-        # Remove used spawn point to avoid reusing it
-        spawn_points.remove(spawn_point)
+    for _ in range(max_batches):
+        n_spawn = number_of_pedestrians - len(pedestrians_list)
+        if n_spawn <= 0:
+            break
+
+        # Get the spawn points to pedestrians
+        spawn_points = []
+        while len(spawn_points) < n_spawn:
+            loc = spawn_location()
+            if (loc != None):
+                spawn_points.append(carla.Transform(loc))
+            elif locations is not None:
+                break   # All the locations are used
+        if not spawn_points:
+            break
+
+        batch = [SpawnActor(random.choice(pedestrian_blueprints), spawn_point) for spawn_point in spawn_points]
+        actor_ids = [actor_id for actor_id in apply_batch(client, batch, "spawn pedestrian") if actor_id is not None]
+        pedestrians_list.extend(world.get_actors(actor_ids))
+
+    # Spawn the controllers of all the pedestrians
+    batch = [SpawnActor(walker_controller_bp, carla.Transform(), pedestrian.id) for pedestrian in pedestrians_list]
+    actor_ids = [actor_id for actor_id in apply_batch(client, batch, "spawn pedestrian controller") if actor_id is not None]
+    controllers_list = list(world.get_actors(actor_ids))
+
+    # The controllers must be in the world before starting them
+    world.tick()
 
     world.set_pedestrians_cross_factor(0.0) # Percentage of pedestrians crossing the road
-    print(f"Pedestrians spawned: {len(pedestrians_list)}/{number_of_pedestrians}")
+    for controller in controllers_list:
+        controller.start()
 
-    return pedestrians_list, controllers_list
+        # Get a random location for the pedestrian to walk to
+        target_location = random_location()
 
+        if target_location != None:
+            controller.go_to_location(target_location)
+            controller.set_max_speed(1 + random.random())  # Random speed between 1 and 2 m/s
 
+    print(f"Pedestrians spawned: {len(pedestrians_list)}/{number_of_pedestrians}")
 
+    return pedestrians_list, controllers_list
 
 
+def destroy_actors(client, actors):
+    """
+    Destroy the actors with only one batch of commands (the AI controllers of the pedestrians are stopped before).
 
+    :param actors: List of actors (or actor ids).
+    """
+    for actor in actors:
+        if isinstance(actor, carla.Actor) and actor.type_id == 'controller.ai.walker' and actor.is_alive:
+            actor.stop()
 
+    apply_batch(client, [DestroyActor(actor) for actor in actors], "destroy actor")
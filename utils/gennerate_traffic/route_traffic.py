@@ -0,0 +1,278 @@
+from utils.gennerate_traffic import gennerate_traffic
+import carla
+import os
+import random
+import numpy as np
+
+ApplyTransform = carla.command.ApplyTransform
+
+
+"""
+    Traffic only around the route of the ego vehicle.
+
+    The vehicles and pedestrians are placed within 'radius' meters of the route and, while the ego vehicle
+    drives, the ones left behind (or too far from the route) are moved to free places ahead of the ego vehicle.
+    The traffic manager uses the hybrid physics mode, so the vehicles far from the ego vehicle don't use physics.
+    So the same traffic is seen by the sensors with much less actors simulated in each tick.
+
+    The AI controller of a pedestrian moves it every tick from the position it knows, so the controllers of the
+    pedestrians moved are stopped before the move and started again in the next tick (with the new position).
+    The locations of the sidewalks are sampled once per map and saved in 'SIDEWALK_CACHE_DIR'.
+"""
+
+SIDEWALK_CACHE_DIR = "_cache/sidewalks"
+
+
+def _road_path(carla_map, start, end, step):
+    """
+    Approximation of the path of the traffic manager between 2 locations, following the waypoints of the road
+    (at each junction the lane closer to 'end' is chosen).
+
+    :return: List of carla.Location every 'step' meters from 'start' to 'end'.
+    """
+    waypoint = carla_map.get_waypoint(start)
+    path = [start]
+    max_steps = int(3 * start.distance(end) / step) + 10
+    for _ in range(max_steps):
+        if waypoint.transform.location.distance(end) <= step:
+            break
+        next_waypoints = waypoint.next(step)
+        if not next_waypoints:
+            break
+        waypoint = min(next_waypoints, key=lambda next_waypoint: next_waypoint.transform.location.distance(end))
+        path.append(waypoint.transform.location)
+    path.append(end)
+
+    return path
+
+
+def route_path(carla_map, route_indices, step=2.0):
+    """
+    Get the path of a route (see 'ROUTES_TOWN1' of 'main_dataset.py') with a point every 'step' meters.
+
+    :return: Array (M, 3) with the points of the path and array (M,) with the distance along the route of each point.
+    """
+    spawn_points = carla_map.get_spawn_points()
+    locations = [spawn_points[i].location for i in route_indices]
+
+    path = [locations[0]]
+    for start, end in zip(locations[:-1], locations[1:]):
+        path += _road_path(carla_map, start, end, step)[1:]
+
+    points = np.array([[location.x, location.y, location.z] for location in path])
+    progress = np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))])
+
+    return points, progress
+
+
+def project_to_route(traffic, locations, min_progress=-np.inf, max_progress=np.inf):
+    """
+    Get the distance (in the XY plane) of each location to the route and the distance along the route of the
+    closest point of the route, only with the points of the route between 'min_progress' and 'max_progress'.
+
+    :param locations: Array (N, 3).
+    :return: Arrays (N,) with the distance to the route and the progress along the route.
+    """
+    window = (traffic['progress'] >= min_progress) & (traffic['progress'] <= max_progress)
+    route = traffic['route'][window]
+    progress = traffic['progress'][window]
+
+    distances = np.linalg.norm(locations[:, None, :2] - route[None, :, :2], axis=2)
+    closest = np.argmin(distances, axis=1)
+
+    return distances[np.arange(len(locations)), closest], progress[closest]
+
+
+def _locations_array(locations):
+    """Array (N, 3) with the X, Y and Z of a list of carla.Location."""
+
+    return np.array([[location.x, location.y, location.z] for location in locations]).reshape(-1, 3)
+
+
+def _snapshot_locations(snapshot, actors):
+    """Array (N, 3) with the location of the actors in a world snapshot (NaN if the actor is not in the snapshot)."""
+
+    locations = np.full((len(actors), 3), np.nan)
+    for i, actor in enumerate(actors):
+        actor_snapshot = snapshot.find(actor.id)
+        if actor_snapshot is not None:
+            location = actor_snapshot.get_transform().location
+            locations[i] = (location.x, location.y, location.z)
+
+    return locations
+
+
+def sidewalk_locations(world, n_locations=2000, cache_dir=SIDEWALK_CACHE_DIR):
+    """
+    Random locations of the navigation mesh (sidewalks) of the map. Each location is a request to the server,
+    so they are sampled only once per map and saved in 'cache_dir' for the next routes of the same map.
+
+    :return: Array (N, 3) with the locations.
+    """
+    path = os.path.join(cache_dir, os.path.basename(world.get_map().name) + ".npy")
+    if os.path.exists(path):
+        locations = np.load(path)
+        if len(locations) >= n_locations:
+            return locations[:n_locations]
+
+    # Some samples are None (no location found), they are sampled again so the cache has the 'n_locations'
+    samples = []
+    for _ in range(10 * n_locations):
+        if len(samples) == n_locations:
+            break
+        location = world.get_random_location_from_navigation()
+        if location is not None:
+            samples.append(location)
+    locations = _locations_array(samples)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path, locations)
+
+    return locations
+
+
+def create_route_traffic(client, world, traffic_manager, blueprint_library, ego_spawn_point, route_indices, radius,
+                         number_of_vehicles=70, number_of_pedestrians=50, recycle_interval=20, n_sidewalk_locations=2000):
+    """
+    Spawn the traffic (vehicles and pedestrians) within 'radius' meters of the route and of the ego vehicle,
+    and enable the hybrid physics of the traffic manager in the same radius.
+
+    :param ego_spawn_point: Spawn point of the ego vehicle (the start of the route).
+    :param route_indices: Indices of the spawn points of the route.
+    :param radius: Distance in meters to the route (and to the ego vehicle along the route) of the traffic.
+    :param recycle_interval: Number of ticks between the checks of the actors left behind.
+    :param n_sidewalk_locations: Number of random locations of the navigation mesh used to find the ones near the route
+                                 (sampled once per map, see 'sidewalk_locations').
+
+    :return: Dictionary with the state of the traffic, used by 'update_route_traffic'.
+    """
+    carla_map = world.get_map()
+    route, progress = route_path(carla_map, route_indices)
+    traffic = {
+        "world": world,
+        "route": route,                     # Points of the path of the route (M, 3)
+        "progress": progress,               # Distance along the route of each point (M,)
+        "radius": radius,
+        "recycle_interval": recycle_interval,
+        "ego_progress": 0.0,                # Distance along the route of the ego vehicle
+        "ticks": 0,
+        "recycled": 0,                      # Number of actors moved ahead of the ego vehicle
+        "stopped_controllers": [],          # Controllers of the pedestrians moved, started again in the next tick
+    }
+
+    # Physics only for the vehicles near the ego vehicle (the 'hero' of the traffic manager)
+    traffic_manager.set_hybrid_physics_mode(True)
+    traffic_manager.set_hybrid_physics_radius(radius)
+
+    # Spawn points of the map near the route
+    spawn_points = carla_map.get_spawn_points()
+    spawn_locations = _locations_array([spawn_point.location for spawn_point in spawn_points])
+    distance, spawn_progress = project_to_route(traffic, spawn_locations)
+    near_route = distance <= radius
+    traffic['spawn_points'] = [spawn_point for spawn_point, near in zip(spawn_points, near_route) if near]
+    traffic['spawn_locations'] = spawn_locations[near_route]
+    traffic['spawn_progress'] = spawn_progress[near_route]
+
+    # Locations of the sidewalks near the route
+    sidewalk_array = sidewalk_locations(world, n_sidewalk_locations)
+    distance, sidewalk_progress = project_to_route(traffic, sidewalk_array)
+    near_route = distance <= radius
+    traffic['sidewalk_array'] = sidewalk_array[near_route]
+    traffic['sidewalk_locations'] = [carla.Location(x=float(x), y=float(y), z=float(z)) for x, y, z in traffic['sidewalk_array']]
+    traffic['sidewalk_progress'] = sidewalk_progress[near_route]
+
+    # Spawn the traffic only near the start of the route
+    ego_array = _locations_array([ego_spawn_point.location])[0]
+    near_ego = np.linalg.norm(traffic['spawn_locations'] - ego_array, axis=1) <= radius
+    spawn_points = [spawn_point for spawn_point, near in zip(traffic['spawn_points'], near_ego) if near]
+    near_ego = np.linalg.norm(traffic['sidewalk_array'] - ego_array, axis=1) <= radius
+    locations = [location for location, near in zip(traffic['sidewalk_locations'], near_ego) if near]
+
+    traffic['vehicles'] = gennerate_traffic.gennerate_vehicles(client, world, traffic_manager, blueprint_library, ego_spawn_point,
+                                                               number_of_vehicles, spawn_points=spawn_points)
+    # Only the sidewalks near the start (not all the map), with at most one pedestrian per location
+    if len(locations) < number_of_pedestrians:
+        print(f"Only {len(locations)} sidewalk locations within {radius} m of the start, spawning {len(locations)}/{number_of_pedestrians} pedestrians")
+        number_of_pedestrians = len(locations)
+    traffic['pedestrians'], traffic['controllers'] = [], []
+    if number_of_pedestrians:
+        traffic['pedestrians'], traffic['controllers'] = gennerate_traffic.gennerate_pedestrians(client, world, blueprint_library,
+                                                                                                 number_of_pedestrians, locations=locations)
+    traffic['walker_controllers'] = {controller.parent.id: controller for controller in traffic['controllers'] if controller.parent is not None}
+    print(f"Route traffic: {len(traffic['spawn_points'])} spawn points and {len(traffic['sidewalk_locations'])} sidewalk locations within {radius} m of the route")
+
+    return traffic
+
+
+def _free_places(places, places_progress, ego_progress, radius, occupied, min_distance):
+    """Indices of the places ahead of the ego vehicle (up to 'radius' meters along the route) without actors closer than 'min_distance'."""
+
+    ahead = (places_progress > ego_progress) & (places_progress <= ego_progress + radius)
+    if len(occupied) and len(places):
+        distances = np.linalg.norm(places[:, None, :2] - occupied[None, :, :2], axis=2)
+        ahead &= np.all(distances >= min_distance, axis=1)
+
+    return list(np.flatnonzero(ahead))
+
+
+def update_route_traffic(client, traffic, ego_vehicle):
+    """
+    Every 'recycle_interval' ticks, move the vehicles and pedestrians left behind by the ego vehicle (more than
+    'radius' meters behind it along the route) or too far from the route to free places ahead of the ego vehicle,
+    with one batch of commands.
+
+    :return: Number of actors moved in this tick.
+    """
+    # The pedestrians moved in the last check walk to a new place near the route (the controllers know their new position)
+    if traffic['stopped_controllers'] and traffic['sidewalk_locations']:
+        for controller in traffic['stopped_controllers']:
+            if controller.is_alive:
+                controller.start()
+                controller.go_to_location(random.choice(traffic['sidewalk_locations']))
+                controller.set_max_speed(1 + random.random())
+    traffic['stopped_controllers'] = []
+
+    traffic['ticks'] += 1
+    if traffic['ticks'] % traffic['recycle_interval']:
+        return 0
+
+    radius = traffic['radius']
+    # The positions of all the actors from one snapshot of the world
+    snapshot = traffic['world'].get_snapshot()
+    ego_array = _snapshot_locations(snapshot, [ego_vehicle])
+    # Only look for the ego vehicle near its last position along the route (the route can cross itself)
+    _, ego_progress = project_to_route(traffic, ego_array, traffic['ego_progress'] - radius, traffic['ego_progress'] + 2 * radius)
+    traffic['ego_progress'] = max(traffic['ego_progress'], float(ego_progress[0]))
+
+    batch = []
+    for actors, places, places_progress, min_distance in ((traffic['vehicles'], traffic['spawn_locations'], traffic['spawn_progress'], 10.0),
+                                                          (traffic['pedestrians'], traffic['sidewalk_array'], traffic['sidewalk_progress'], 2.0)):
+        if not actors:
+            continue
+        locations = _snapshot_locations(snapshot, actors)
+        distance, progress = project_to_route(traffic, locations)
+        found = np.all(np.isfinite(locations), axis=1)      # The actors destroyed are not in the snapshot
+        left_behind = np.flatnonzero(found & ((distance > radius) | (progress < traffic['ego_progress'] - radius)))
+        if not len(left_behind):
+            continue
+
+        occupied = np.vstack([locations[found], ego_array])
+        free = _free_places(places, places_progress, traffic['ego_progress'], radius, occupied, min_distance)
+        random.shuffle(free)
+        for actor_index, place_index in zip(left_behind, free):
+            actor = actors[actor_index]
+            if actors is traffic['vehicles']:
+                transform = traffic['spawn_points'][place_index]
+            else:
+                transform = carla.Transform(traffic['sidewalk_locations'][place_index] + carla.Location(z=1.0))
+                # Stopped before the move, so the controller doesn't move the pedestrian back to its old position
+                controller = traffic['walker_controllers'].get(actor.id)
+                if controller is not None:
+                    controller.stop()
+                    traffic['stopped_controllers'].append(controller)
+            batch.append(ApplyTransform(actor.id, transform))
+
+    if batch:
+        gennerate_traffic.apply_batch(client, batch, "move actor")
+        traffic['recycled'] += len(batch)
+
+    return len(batch)
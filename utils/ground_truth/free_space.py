@@ -0,0 +1,96 @@
+import numpy as np
+
+
+"""
+    Labels of the voxel grid of the ground truth with 3 states: unknown, occupied and free.
+
+    A voxel is occupied if a point of the ground truth is inside it and free if a ray from the cameras
+    to a point crosses it before reaching the point. The voxels never crossed by a ray are unknown
+    (occluded or out of the view of the cameras).
+    The rays that end in the same voxel cross (almost) the same voxels, so only one ray per voxel is traversed,
+    sampling it every quarter of voxel in batches of samples.
+"""
+
+UNKNOWN = 0
+OCCUPIED = 1
+FREE = 2
+
+
+def label_free_space(points, origin, voxel_size=0.4, max_range_X_Y=40, min_range_Z=-4, max_range_Z=2.4, step=None, max_samples=4_000_000):
+    """
+    Label the voxels of the grid of 'ground_truth.occupancy_grid_map' (same size and coordinates) as
+    UNKNOWN, OCCUPIED or FREE, traversing the rays from 'origin' (the cameras) to each point.
+
+    :param points: Points (N, 3) of the ground truth, in the coordinates of the grid.
+    :param origin: Position (3,) of the cameras in the coordinates of the grid.
+    :param step: Distance in meters between the samples of each ray (default = a quarter of the voxel size).
+    :param max_samples: Maximum number of samples traversed at the same time (bounds the memory used).
+
+    :return: Grid (int8) with the label of each voxel.
+    """
+    min_bound = np.array([-max_range_X_Y, -max_range_X_Y, min_range_Z], dtype=np.float64)
+    max_bound = np.array([max_range_X_Y, max_range_X_Y, max_range_Z], dtype=np.float64)
+    grid_size = np.ceil((max_bound - min_bound) / voxel_size).astype(int)
+    step = voxel_size / 4 if step is None else step
+    origin = np.asarray(origin, dtype=np.float64)
+    points = np.asarray(points)
+
+    labels = np.full(grid_size, UNKNOWN, dtype=np.int8)
+    if len(points) == 0:
+        return labels
+
+    # Voxel of each point, the same of 'occupancy_grid_map' (in the type of the points)
+    voxel_indices = np.floor((points - min_bound.astype(points.dtype)) / points.dtype.type(voxel_size)).astype(np.int64)
+    hit = np.all((voxel_indices >= 0) & (voxel_indices < grid_size), axis=1)
+    ends = points.astype(np.float64)
+
+    # The rays of the points out of the grid end where they leave the grid (their last voxel is free)
+    if not np.all(hit):
+        directions = ends[~hit] - origin
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_exit = np.maximum((min_bound - origin) / directions, (max_bound - origin) / directions)
+        t_exit = np.nanmin(np.where(np.isfinite(t_exit), t_exit, np.inf), axis=1)
+        ends[~hit] = origin + directions * np.minimum(t_exit, 1.0)[:, None] * (1 - 1e-6)
+        voxel_indices[~hit] = np.clip(np.floor((ends[~hit] - min_bound) / voxel_size).astype(np.int64), 0, grid_size - 1)
+
+    # Only one ray for each voxel where the rays end (the rays hitting the voxel have priority)
+    flat_indices = np.ravel_multi_index(voxel_indices.T, grid_size)
+    order = np.argsort(~hit, kind='stable')
+    end_voxels, first = np.unique(flat_indices[order], return_index=True)
+    first = order[first]
+    end_hit = hit[first]
+
+    # Rays from the origin to one of the points of each voxel
+    directions = ends[first] - origin
+    lengths = np.linalg.norm(directions, axis=1)
+    directions /= np.maximum(lengths, 1e-9)[:, None]
+    n_samples = np.floor(lengths / step).astype(np.int64)
+
+    free = np.zeros(labels.size, dtype=bool)
+    free[end_voxels[~end_hit]] = True
+
+    # Traverse the rays in batches of at most 'max_samples' samples
+    cumulative_samples = np.cumsum(n_samples)
+    batch_ends = np.searchsorted(cumulative_samples, np.arange(max_samples, cumulative_samples[-1], max_samples), side='right')
+    batch_limits = np.unique(np.concatenate([[0], batch_ends, [len(n_samples)]]))
+    for start, end in zip(batch_limits[:-1], batch_limits[1:]):
+        if end <= start:
+            continue
+        counts = n_samples[start:end]
+        ray_ids = np.repeat(np.arange(start, end), counts)
+        first_sample = np.cumsum(counts) - counts
+        sample_ids = np.arange(len(ray_ids)) - np.repeat(first_sample, counts)
+
+        distances = ((sample_ids + 0.5) * step).astype(np.float32)
+        samples = directions[ray_ids].astype(np.float32) * distances[:, None]
+        samples += (origin - min_bound).astype(np.float32)
+        samples /= np.float32(voxel_size)
+        sample_voxels = np.floor(samples).astype(np.int64)
+
+        inside = np.all((sample_voxels >= 0) & (sample_voxels < grid_size), axis=1)
+        free[np.ravel_multi_index(sample_voxels[inside].T, grid_size)] = True
+
+    labels.ravel()[free] = FREE
+    labels.ravel()[end_voxels[end_hit]] = OCCUPIED
+
+    return labels
@@ -1,8 +1,21 @@
 import carla
 import numpy as np
 import math as mt
-from numpy.matlib import repmat
 import ctypes
+import functools
+from utils.profiling import stage_timer
+from utils.ground_truth import region_of_interest
+
+PCL_LIBRARY = "./utils/ground_truth/build/libpcl_downsample.so"
+NATIVE_LIBRARY = "./utils/ground_truth/build/libvoxel_downsample.so"
+DOWNSAMPLE_KERNELS = ("pcl", "native")
+
+_pcl_lib = None     # Shared library of the c++ code, loaded only once
+_native_lib = None  # Shared library of the voxel grid without PCL (voxel_downsample.cpp), loaded only once
+_rays_cache = {}    # Rays of the pixels of each camera {(width, height, intrinsic, dtype): rays}
+
+# Axes of the camera (rays of '_pixel_rays') to the axes of the vehicle
+CAMERA_TO_VEHICLE = np.array([[0, 0, 1, 0], [1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=np.float64)
 
 def spawn_camera(camera, world, blueprint_library, vehicle, img_width, img_height, camera_transform):
     camera_bp = blueprint_library.find(camera)
@@ -49,131 +62,355 @@ def get_intrinsic_extrinsic_matrix(camera_depth, image_depth):
     :param image_depth: The `image_depth` parameter typically refers to the depth information of an image.
     """
     
-    # -------- Extrinsic matrix
-    camera2vehicle_matrix = np.array([[0, 0, 1, 0], [1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=np.float64)
+    transform = get_camera_transform(camera_depth, image_depth)
+    
+    return get_intrinsic_matrix(image_depth.width, image_depth.height, getattr(image_depth, 'fov', 90.0)), get_extrinsic_matrices([transform])[0]
+
+
+def get_camera_transform(camera_depth, image_depth):
+    """
+    Get the transform of a camera when the image was captured: the transform saved in the measurement
+    (no request to the server and the same state of the world of the image) or, if the image doesn't
+    have it, the transform of the camera (only one request).
+    """
+    
+    transform = getattr(image_depth, 'transform', None)
+    if transform is None:
+        transform = camera_depth.get_transform()
+    
+    return transform
+
+
+@functools.lru_cache(maxsize=None)
+def get_intrinsic_matrix(width, height, fov=90.0):
+    """
+    Intrinsic matrix of a camera (computed only once for each size and field of view).
+    The array returned is read-only because it is shared by all the calls.
+    """
+    
+    focal_lengthX = width / (2.0 * mt.tan(fov * mt.pi / 360.0))
+    centerX = width / 2
+    centerY = height / 2
     
-    pitch = camera_depth.get_transform().rotation.pitch / 180.0 * mt.pi
-    yaw = camera_depth.get_transform().rotation.yaw / 180.0 * mt.pi
-    roll = camera_depth.get_transform().rotation.roll / 180.0 * mt.pi
-    loc_x = camera_depth.get_transform().location.x
-    loc_y = - camera_depth.get_transform().location.y
-    loc_z = camera_depth.get_transform().location.z
-    sin_y, sin_p, sin_r = mt.sin(yaw), mt.sin(pitch), mt.sin(roll)
-    cos_y, cos_p, cos_r = mt.cos(yaw), mt.cos(pitch), mt.cos(roll)
+    intrinsic_matrix = np.array([[focal_lengthX, 0, centerX],
+                                 [0, focal_lengthX, centerY],
+                                 [0, 0, 1]], dtype=np.float64)
+    intrinsic_matrix.flags.writeable = False
+    
+    return intrinsic_matrix
 
-    transform_matrix = np.array([
-        [cos_y * cos_p,   cos_y * sin_p * sin_r + sin_y * cos_r,   -cos_y * sin_p * cos_r + sin_y * sin_r, loc_x],
-        [-sin_y * cos_p,  -sin_y * sin_p * sin_r + cos_y * cos_r,  sin_y * sin_p * cos_r + cos_y * sin_r,  loc_y],
-        [sin_p,           -cos_p * sin_r,                          cos_p * cos_r,                          loc_z],
-        [0.0,             0.0,                                     0.0,                                    1.0  ]
-    ])
 
-    camera2world_matrix = transform_matrix @ camera2vehicle_matrix
+def get_extrinsic_matrices(transforms):
+    """
+    Get the extrinsic matrices (camera to world, with the Y axis of the world inverted) of several cameras at once.
+    
+    :param transforms: List with the carla.Transform of each camera.
+    
+    :return: Array (N, 4, 4) with the extrinsic matrix of each camera.
+    """
     
+    # Camera to world
+    return get_sensor_matrices(transforms) @ CAMERA_TO_VEHICLE
 
-    # -------- Intrinsics matrix
-    focal_lengthX = image_depth.width / (2.0 * mt.tan(90 * mt.pi / 360.0))
-    centerX = image_depth.width / 2
-    centerY = image_depth.height / 2
+
+def get_sensor_matrices(transforms):
+    """
+    Get the pose matrices (sensor to world, with the Y axis of the world inverted) of several sensors at once,
+    with the axes of the vehicle in the sensor (X forward, Y left and Z up, the lidar points with the Y axis inverted).
+    
+    :param transforms: List with the carla.Transform of each sensor.
+    
+    :return: Array (N, 4, 4) with the pose matrix of each sensor.
+    """
+    
+    rotations = np.radians([[t.rotation.pitch, t.rotation.yaw, t.rotation.roll] for t in transforms]).reshape(-1, 3)
+    sin_p, sin_y, sin_r = np.sin(rotations).T
+    cos_p, cos_y, cos_r = np.cos(rotations).T
     
-    intrinsic_matrix = [[focal_lengthX, 0, centerX],
-                        [0, focal_lengthX, centerY],
-                        [0, 0, 1]]
+    transform_matrix = np.zeros((len(rotations), 4, 4))
+    transform_matrix[:, 0, 0] = cos_y * cos_p
+    transform_matrix[:, 0, 1] = cos_y * sin_p * sin_r + sin_y * cos_r
+    transform_matrix[:, 0, 2] = -cos_y * sin_p * cos_r + sin_y * sin_r
+    transform_matrix[:, 1, 0] = -sin_y * cos_p
+    transform_matrix[:, 1, 1] = -sin_y * sin_p * sin_r + cos_y * cos_r
+    transform_matrix[:, 1, 2] = sin_y * sin_p * cos_r + cos_y * sin_r
+    transform_matrix[:, 2, 0] = sin_p
+    transform_matrix[:, 2, 1] = -cos_p * sin_r
+    transform_matrix[:, 2, 2] = cos_p * cos_r
+    transform_matrix[:, :3, 3] = [[t.location.x, -t.location.y, t.location.z] for t in transforms]
+    transform_matrix[:, 3, 3] = 1.0
     
-    return intrinsic_matrix, camera2world_matrix
+    return transform_matrix
+
+
+def invert_pose(matrix):
+    """Inverse of a pose matrix (4x4, rotation and translation), without a general matrix inversion."""
+    
+    inverse = np.eye(4)
+    inverse[:3, :3] = matrix[:3, :3].T
+    inverse[:3, 3] = -matrix[:3, :3].T @ matrix[:3, 3]
+    
+    return inverse
 
 
 def _to_bgra_array(image):
-    """Convert a CARLA raw image to a BGRA numpy array."""
+    """Convert a CARLA raw image (or any image with raw_data, width and height) to a BGRA numpy array."""
     
-    if not isinstance(image, carla.Image):
+    if not isinstance(image, carla.Image) and not hasattr(image, 'raw_data'):
         raise ValueError("Argument must be a carla.sensor.Image")
     array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
     array = np.reshape(array, (image.height, image.width, 4))
 
     return array
 
-def _depth_to_array(image):
+def _depth_to_array(image, dtype=np.float64):
     """
     Convert an image containing CARLA encoded depth-map to a 2D array containing
     the depth value of each pixel normalized between [0.0, 1.0].
+    With dtype=np.float32 all the operations are done in float32 (the 24 bits of the depth are exact in float32).
     """
     
     array = _to_bgra_array(image)
     array = array.astype(np.float32)
     # Apply (R + G * 256 + B * 256 * 256) / (256 * 256 * 256 - 1).
-    normalized_depth = np.dot(array[:, :, :3], [65536.0, 256.0, 1.0])
+    normalized_depth = np.dot(array[:, :, :3], np.array([65536.0, 256.0, 1.0], dtype=dtype))
     normalized_depth /= 16777215.0  # (256.0 * 256.0 * 256.0 - 1.0)
 
     return normalized_depth
 
-def point2D_to_point3D(image_depth, intrinsic_matrix):
+def _pixel_rays(width, height, intrinsic_matrix, dtype=np.float64):
+    """
+    Get the rays (inverse of the intrinsic matrix times [u, v, 1]) of all the pixels of a camera, with shape (3, height * width).
+    The rays are computed only once for each camera, multiplying them by the depth gives the 3D points.
+    """
+    
+    key = (width, height, tuple(np.ravel(intrinsic_matrix)), np.dtype(dtype).name)
+    if key not in _rays_cache:
+        # The pixels are in reverse order: u = [width-1 ... 0] for each row and v = [height-1 ... 0] for each column
+        u_coord = np.tile(np.arange(width - 1, -1, -1), height)
+        v_coord = np.repeat(np.arange(height - 1, -1, -1), width)
+        p2d = np.array([u_coord, v_coord, np.ones_like(u_coord)])
+        
+        _rays_cache[key] = np.dot(np.linalg.inv(intrinsic_matrix), p2d).astype(dtype)
+    
+    return _rays_cache[key]
+
+def point2D_to_point3D(image_depth, intrinsic_matrix, dtype=np.float64, roi=None, camera_rotation=None):
     """
     This function converts a 2D point to a 3D point using image depth, image RGB, and intrinsic matrix.
     
     :param image_depth: The `image_depth` is a 2D image representing the depth information of the scene.
     :param intrinsic_matrix: The intrinsic matrix is a 3x3 matrix to represents the internal parameters of the depth camera.
+    :param dtype: Type of the points and colors (np.float32 to use half of the memory).
+    :param roi: Region of interest (see 'region_of_interest.create_roi'), the pixels outside are culled.
+    :param camera_rotation: Rotation (3x3) from the camera to the ego frame, needed with 'roi'.
     """
     
-    intrinsic_matrix_inv = np.linalg.inv(intrinsic_matrix)
-    
     pixel_length = image_depth.width * image_depth.height
     
     # Return a array (height, width, 4) with the BGRA values of each pixel
-    normalized_depth = _depth_to_array(image_depth)
+    with stage_timer.stage("depth_decode"):
+        normalized_depth = _depth_to_array(image_depth, dtype)
     normalized_depth = np.reshape(normalized_depth, pixel_length)
-
-    u_coord = repmat(np.r_[image_depth.width-1:-1:-1],
-                     image_depth.height, 1).reshape(pixel_length)
-    v_coord = repmat(np.c_[image_depth.height-1:-1:-1],
-                     1, image_depth.width).reshape(pixel_length)
     
-    depth_in_meters = normalized_depth*1000
+    depth_in_meters = normalized_depth * 1000
     
     # get only the points with depth less than 90 meters
-    max_depth_indexes = np.where(depth_in_meters > 90)
+    valid_depth = depth_in_meters <= 90
+    
+    rays = _pixel_rays(image_depth.width, image_depth.height, intrinsic_matrix, dtype)
     
-    depth_in_meters = np.delete(depth_in_meters, max_depth_indexes)
-    u_coord = np.delete(u_coord, max_depth_indexes)
-    v_coord = np.delete(v_coord, max_depth_indexes)
+    # Cull the pixels outside the region of interest (the depth limits of the pixels are computed only once)
+    if roi is not None:
+        with stage_timer.stage("roi_culling"):
+            min_depth, max_depth = region_of_interest.depth_limits(roi, rays, camera_rotation, dtype)
+            valid_depth &= depth_in_meters >= min_depth
+            valid_depth &= depth_in_meters <= max_depth
     
     # Convert the 2D pixel coordinates to 3D points
-    p2d = np.array([u_coord, v_coord, np.ones_like(u_coord)])
-    p3d = np.dot(intrinsic_matrix_inv, p2d) * depth_in_meters
+    p3d = np.empty((3, np.count_nonzero(valid_depth)), dtype=dtype)
+    np.multiply(rays[:, valid_depth], depth_in_meters[valid_depth], out=p3d)
     
-    # Add the 0,0,0 point to the point cloud (90º) -> (4 red dots)
-    color = np.full((p3d.shape[1], 3), np.array([0,255,0])) # Green
-    p3d = np.hstack([p3d, [[0], [0], [0]]])
-    color = np.vstack([color, [255, 0, 0]]) # RED
+    color = np.empty((p3d.shape[1], 3), dtype=dtype)
+    color[:] = [0, 255, 0]  # Green
     
     # Return [[X...], [Y...], [Z...]] and [[R...], [G...], [B...]]
     return p3d, color
 
 
+def occupancy_grid_map(points, voxel_size=0.4, max_range_X_Y=40, min_range_Z=-4, max_range_Z=2.4):
+    """
+    A function that generates an occupancy grid map based on the input points, voxel size, and grid dimensions. 
+    It initializes the grid, converts the point cloud to voxel coordinates, and marks the occupied voxels.
+    
+    Parameters:
+    - points: numpy array, representing the input points (float32 or float64)
+    - voxel_size: float, the size of each voxel
+    - max_range_X_Y: int, the maximum range in X and Y axes
+    - min_range_Z: int, the minimum range in the Z axis
+    - max_range_Z: float, the maximum range in the Z axis
+    
+    Returns:
+    - occupancy_grid: numpy array, the final occupancy grid map
+    """
+    
+    
+    
+    # 80 meters in X and Y and 6.4 meters in Z
+    min_bound = np.array([-max_range_X_Y, -max_range_X_Y, min_range_Z])
+    max_bound = np.array([max_range_X_Y, max_range_X_Y, max_range_Z])
+    
+    # Compute the grid dimensions
+    grid_size = np.ceil((max_bound - min_bound) / voxel_size).astype(int)
+    
+    # Initialize the occupancy grid
+    occupancy_grid = np.zeros(grid_size, dtype=np.int8)
+    
+    # Convert point cloud to voxel coordinates (in the type of the points)
+    points = np.asarray(points)
+    voxel_indices = np.floor((points - min_bound.astype(points.dtype)) / points.dtype.type(voxel_size)).astype(np.int32)
+    
+    # Only the points inside the grid
+    inside = np.all((voxel_indices >= 0) & (voxel_indices < grid_size), axis=1)
+    voxel_indices = voxel_indices[inside]
+    
+    # Mark the voxels as occupied
+    occupancy_grid[voxel_indices[:, 0], voxel_indices[:, 1], voxel_indices[:, 2]] = 1
+            
+    return occupancy_grid
 
-def downsample(points, colors, leaf_size):
+
+def get_buffer(workspace, name, shape, dtype):
+    """
+    Get an array with 'shape' from a buffer of 'workspace' that is reused between frames, so the big arrays
+    of each frame are not allocated again. The buffer only grows, the array returned is a view of it and
+    is overwritten the next time the buffer is used. With workspace=None a new array is returned.
+    
+    :param workspace: Dictionary with the buffers {name: array} or None.
+    :param name: Name of the buffer.
+    :param shape: Shape of the array.
+    :param dtype: Type of the array.
+    """
+    
+    if workspace is None:
+        return np.empty(shape, dtype=dtype)
+    
+    size = int(np.prod(shape))
+    buffer = workspace.get(name)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = np.empty(size, dtype=dtype)
+        workspace[name] = buffer
+    
+    return buffer[:size].reshape(shape)
+
+
+def _load_pcl_lib():
+    """Load the shared library of the c++ code (only the first time) and define the prototypes of the functions."""
+    
+    global _pcl_lib
+    if _pcl_lib is None:
+        pcl_lib = ctypes.cdll.LoadLibrary(PCL_LIBRARY)
+        
+        # To pass the numpy array to the C function
+        ND_POINTER = np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags="C")
+        ND_POINTER_FLOAT = np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags="C")
+        
+        # Define the prototype of the functions
+        pcl_lib.pcl_downSample.argtypes = [ND_POINTER, ND_POINTER, ctypes.c_size_t, ctypes.c_float, ND_POINTER, ND_POINTER]
+        pcl_lib.pcl_downSample.restype = None
+        pcl_lib.pcl_downSample_float.argtypes = [ND_POINTER_FLOAT, ND_POINTER_FLOAT, ctypes.c_size_t, ctypes.c_float, ND_POINTER_FLOAT, ND_POINTER_FLOAT]
+        pcl_lib.pcl_downSample_float.restype = ctypes.c_size_t
+        
+        _pcl_lib = pcl_lib
+    
+    return _pcl_lib
+
+
+def _load_native_lib():
+    """Load the shared library of the voxel grid without PCL (only the first time) and define the prototype."""
+    
+    global _native_lib
+    if _native_lib is None:
+        native_lib = ctypes.cdll.LoadLibrary(NATIVE_LIBRARY)
+        
+        ND_POINTER_FLOAT = np.ctypeslib.ndpointer(dtype=np.float32, ndim=2, flags="C")
+        ND_POINTER_KEYS = np.ctypeslib.ndpointer(dtype=np.uint64, ndim=1, flags="C")
+        
+        native_lib.voxel_downsample.argtypes = [ND_POINTER_FLOAT, ND_POINTER_FLOAT, ctypes.c_size_t, ctypes.c_float,
+                                                ND_POINTER_FLOAT, ND_POINTER_FLOAT, ND_POINTER_KEYS, ctypes.c_int]
+        native_lib.voxel_downsample.restype = ctypes.c_int64
+        
+        _native_lib = native_lib
+    
+    return _native_lib
+
+
+def voxel_downsample(points, colors, leaf_size, workspace=None, n_threads=0):
+    """
+    Downsample with the native voxel grid (voxel_downsample.cpp): the same voxels and centroids of PCL, but
+    the float32 arrays are read and written in place by the C function (the points are grouped by voxel with a
+    radix sort in parallel with OpenMP), so there is no copy to a PCL point cloud.
+    
+    :param workspace: Dictionary with the buffers reused between frames (see 'get_buffer').
+    :param n_threads: Number of threads of OpenMP (0 = all, or OMP_NUM_THREADS).
+    
+    :return: Downsampled points and colors (float32, views of the buffers of 'workspace').
+    """
+    
+    native_lib = _load_native_lib()
+    
+    points = np.ascontiguousarray(points, dtype=np.float32)
+    colors = np.ascontiguousarray(colors, dtype=np.float32)
+    
+    output_points = get_buffer(workspace, "downsampled_points", points.shape, np.float32)
+    output_colors = get_buffer(workspace, "downsampled_colors", colors.shape, np.float32)
+    keys = get_buffer(workspace, "voxel_keys", (2 * points.shape[0],), np.uint64)
+    
+    n_points = native_lib.voxel_downsample(points, colors, ctypes.c_size_t(points.shape[0]), ctypes.c_float(float(leaf_size)),
+                                           output_points, output_colors, keys, ctypes.c_int(n_threads))
+    if n_points < 0:
+        raise ValueError(f"Too many voxels of {leaf_size} m to downsample the point cloud (the points are too far apart)")
+    
+    return output_points[:n_points], output_colors[:n_points]
+
+
+def downsample(points, colors, leaf_size, workspace=None, kernel="pcl"):
     """
     The function `downsample` takes in arrays of points and colors, passes them to a C function for
     downsampling, and returns the downsampled points and colors.
+    If the points are float32, the arrays are passed to the C function without any copy and the
+    output arrays are buffers of 'workspace' (reused in the next frames).
     
     :param points: Numpy array containing the coordinates of points in a point cloud.
                    Each row of the array represents a point in 3D space with its x, y, and z coordinates.
     :param colors: Numpy array containing the RGB of points in a point cloud.
                    Each row of the array represents a point in 3D space with its R, G, and B colors.
     :param leaf_size: Is the size of the leaf for the downsampling algorithm.
+    :param workspace: Dictionary with the buffers reused between frames (see 'get_buffer'), only used with float32.
+    :param kernel: "pcl" (pcl_downsample.cpp) or "native" (voxel_downsample.cpp, float32, see 'voxel_downsample').
     
     :return: 'output_points' and 'output_colors' which contain the downsampled points and colors 
              of the point cloud, respectively.
     """
     
-    pcl_lib = ctypes.cdll.LoadLibrary("./utils/ground_truth/build/libpcl_downsample.so")
+    if kernel == "native":
+        return voxel_downsample(points, colors, leaf_size, workspace)
+    if kernel != "pcl":
+        raise ValueError(f"Unknown downsample kernel '{kernel}', must be one of {DOWNSAMPLE_KERNELS}")
     
-    # To pass the numpy array to the C function
-    ND_POINTER = np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags="C")
+    pcl_lib = _load_pcl_lib()
     
-    # Define the prototype of the function
-    pcl_lib.pcl_downSample.argtypes = [ND_POINTER, ND_POINTER, ctypes.c_float, ctypes.c_size_t, ND_POINTER, ND_POINTER]
-    pcl_lib.pcl_downSample.restype = ctypes.c_int
+    if points.dtype == np.float32:
+        points = np.ascontiguousarray(points)
+        colors = np.ascontiguousarray(colors, dtype=np.float32)
+        
+        output_points = get_buffer(workspace, "downsampled_points", points.shape, np.float32)
+        output_colors = get_buffer(workspace, "downsampled_colors", colors.shape, np.float32)
+        
+        # The C function returns the number of points of the downsampled point cloud
+        n_points = pcl_lib.pcl_downSample_float(points, colors, ctypes.c_size_t(points.shape[0]), ctypes.c_float(float(leaf_size)), output_points, output_colors)
+        
+        return output_points[:n_points], output_colors[:n_points]
     
     # put the arrays in a contiguous memory to pass to the C function
     points = np.ascontiguousarray(points, dtype=np.float64)
@@ -184,23 +421,10 @@ def downsample(points, colors, leaf_size):
     output_colors = np.zeros((colors.shape[0], 3)).astype(np.float64)
     
     # Call the C function to downsample the point cloud
-    pcl_lib.pcl_downSample(points, colors, ctypes.c_float(float(leaf_size)), ctypes.c_size_t(points.size//3), output_points, output_colors)
+    pcl_lib.pcl_downSample(points, colors, ctypes.c_size_t(points.size//3), ctypes.c_float(float(leaf_size)), output_points, output_colors)
 
     # Delete the [0,0,0] points from the point cloud
     output_points = np.delete(output_points, np.where(np.all(output_points == [0,0,0], axis=1)), axis=0)
     output_colors = np.delete(output_colors, np.where(np.all(output_colors == [0,0,0], axis=1)), axis=0)
 
     return output_points, output_colors
-
-
-
-
-
-
-
-
-
-
-
-
-
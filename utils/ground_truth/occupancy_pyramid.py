@@ -0,0 +1,75 @@
+import numpy as np
+
+
+"""
+    Pyramid of resolutions of the voxel occupancy grid: each level is the max pooling (2x2x2) of the level below,
+    so a voxel is occupied if any of its 8 voxels is occupied (the same grid of 'ground_truth.occupancy_grid_map'
+    with twice the voxel size, without voxelizing the points again).
+
+    All the levels are saved in the same .npz file: the base grid in "arr_0" (like the grids of only one level, so
+    the old readers still work), the other levels in "level_1", "level_2"... and the metadata shared by all of them
+    (voxel size of the base grid and minimum bound). Each level is a separate array of the .npz, so reading one level
+    doesn't decompress the others.
+"""
+
+
+def level_key(level):
+    """Name of the array of a level in the .npz file."""
+
+    return "arr_0" if level == 0 else f"level_{level}"
+
+
+def max_pool(grid):
+    """Max pooling 2x2x2 of a grid (X, Y, Z), the odd sizes are padded with empty voxels."""
+
+    padding = [(0, size % 2) for size in grid.shape]
+    if any(pad for _, pad in padding):
+        grid = np.pad(grid, padding)
+
+    # Maximum of the pairs of voxels of each axis (the first one halves the contiguous axis, so the next ones read less)
+    grid = np.maximum(grid[:, :, 0::2], grid[:, :, 1::2])
+    grid = np.maximum(grid[:, 0::2], grid[:, 1::2])
+
+    return np.maximum(grid[0::2], grid[1::2])
+
+
+def build_pyramid(grid, levels=3):
+    """
+    Pyramid of 'levels' levels of an occupancy grid (the first level is the grid).
+
+    :return: List with the grid of each level.
+    """
+    pyramid = [grid]
+    for _ in range(levels - 1):
+        pyramid.append(max_pool(pyramid[-1]))
+
+    return pyramid
+
+
+def save_pyramid(path, pyramid, voxel_size=0.4, min_bound=(-40, -40, -4)):
+    """Save the levels of a pyramid and its metadata in a compressed .npz file."""
+
+    arrays = {level_key(level): grid for level, grid in enumerate(pyramid)}
+    np.savez_compressed(path, **arrays, levels=np.int32(len(pyramid)), voxel_size=np.float64(voxel_size),
+                        min_bound=np.asarray(min_bound, dtype=np.float64))
+
+
+def load_level(path, level=0):
+    """Load only one level of a file of 'save_pyramid' (the level 0 also of the files with only one grid)."""
+
+    with np.load(path) as data:
+        if level_key(level) not in data.files:
+            raise KeyError(f"{path} doesn't have the level {level} (levels: {int(data['levels']) if 'levels' in data.files else 1})")
+        return data[level_key(level)]
+
+
+def load_metadata(path):
+    """
+    Metadata of a file of 'save_pyramid'.
+
+    :return: Dictionary with the number of levels, the minimum bound and the voxel size of each level.
+    """
+    with np.load(path) as data:
+        levels = int(data["levels"])
+        voxel_size = float(data["voxel_size"])
+        return {"levels": levels, "min_bound": data["min_bound"], "voxel_sizes": [voxel_size * 2 ** level for level in range(levels)]}
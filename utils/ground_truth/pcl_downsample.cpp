@@ -25,7 +25,8 @@ extern "C"{
 
 
         // Fill the PointCloud with the points and colors from the input arrays
-        for (int i = 0; i < n_points; i++) {
+        cloud_XYZRGB->points.reserve(n_points);
+        for (size_t i = 0; i < n_points; i++) {
             pcl::PointXYZRGB point;
 
             point.x = array_points[i * cols + 0];   // x coordinate
@@ -41,18 +42,12 @@ extern "C"{
         // Convert to PCLPointCloud2 to apply the VoxelGrid filter
         pcl::toPCLPointCloud2(*cloud_XYZRGB, *cloud);
 
-        std::cout << "\nPointCloud before filtering: " << cloud->width * cloud->height << " data points (" << pcl::getFieldsList (*cloud) << ")." << std::endl;
-
-        std::cout << "Downsampling with leaf size of " << leaf_size << "... \n";
-
         // Downsample the point cloud
         pcl::VoxelGrid<pcl::PCLPointCloud2> sor;
         sor.setInputCloud (cloud);
         sor.setLeafSize (leaf_size, leaf_size, leaf_size);
         sor.filter (*cloud_filtered);
 
-        std::cout << "PointCloud after filtering: " << cloud_filtered->width * cloud_filtered->height << " data points (" << pcl::getFieldsList (*cloud_filtered) << ")." << std::endl;
-
         // Convert to PointCloud<pcl::PointXYZRGB> to get the points and colors of the downsampled point cloud
         pcl::fromPCLPointCloud2(*cloud_filtered, *downsampled_cloud);
 
@@ -69,4 +64,55 @@ extern "C"{
         }
 
     }
-}
+
+    size_t pcl_downSample_float(float *array_points, float *array_color, size_t n_points, float leaf_size, float *downsample_points, float *downsample_colors){
+        /* Same as `pcl_downSample` but with float32 arrays (the type used by PCL), so the arrays of the caller are read
+            without any copy in Python, and without the conversion to PCLPointCloud2.
+        - `array_points`: An array containing the x, y, z coordinates of the points in the point cloud.
+        - `array_color`: An array containing the RGB color values of the points in the point cloud.
+        - `n_points`: The number of points in the point cloud.
+        - `leaf_size`: The size of the leaf (voxel) in meters.
+        - `downsample_points`: An array (with space for `n_points`) to store the downsampled x, y, z coordinates of the points.
+        - `downsample_colors`: An array (with space for `n_points`) to store the downsampled RGB color values of the points.
+        Returns the number of points of the downsampled point cloud. */
+
+        pcl::PointCloud<pcl::PointXYZRGB>::Ptr cloud_XYZRGB(new pcl::PointCloud<pcl::PointXYZRGB>);
+        pcl::PointCloud<pcl::PointXYZRGB>::Ptr downsampled_cloud(new pcl::PointCloud<pcl::PointXYZRGB>);
+        int cols = 3;  // Dimensions (x, y, z) and (r, g, b)
+
+        // Fill the PointCloud with the points and colors from the input arrays
+        cloud_XYZRGB->points.resize(n_points);
+        cloud_XYZRGB->width = n_points;
+        cloud_XYZRGB->height = 1;
+        for (size_t i = 0; i < n_points; i++) {
+            pcl::PointXYZRGB &point = cloud_XYZRGB->points[i];
+
+            point.x = array_points[i * cols + 0];   // x coordinate
+            point.y = array_points[i * cols + 1];   // y coordinate
+            point.z = array_points[i * cols + 2];   // z coordinate
+            point.r = array_color[i * cols + 0];    // r color
+            point.g = array_color[i * cols + 1];    // g color
+            point.b = array_color[i * cols + 2];    // b color
+        }
+
+        // Downsample the point cloud
+        pcl::VoxelGrid<pcl::PointXYZRGB> sor;
+        sor.setInputCloud (cloud_XYZRGB);
+        sor.setLeafSize (leaf_size, leaf_size, leaf_size);
+        sor.filter (*downsampled_cloud);
+
+        size_t n_points_downsampled = downsampled_cloud->points.size();
+        // Fill the downsampled points and colors into the output arrays
+        for (size_t i = 0; i < n_points_downsampled; i++) {
+            const pcl::PointXYZRGB &point = downsampled_cloud->points[i];
+            downsample_points[i * cols + 0] = point.x;
+            downsample_points[i * cols + 1] = point.y;
+            downsample_points[i * cols + 2] = point.z;
+            downsample_colors[i * cols + 0] = point.r;
+            downsample_colors[i * cols + 1] = point.g;
+            downsample_colors[i * cols + 2] = point.b;
+        }
+
+        return n_points_downsampled;
+    }
+}
\ No newline at end of file
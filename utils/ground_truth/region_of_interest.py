@@ -0,0 +1,114 @@
+import numpy as np
+
+
+"""
+    Region of interest (ROI) of the ground truth, relative to the position of the sensors (ego frame:
+    X forward, Y left, Z up, with the rotation of the vehicle).
+
+    The ROI is convex and the cameras are in the origin of the ego frame, so the ray of each pixel is inside
+    the ROI between a minimum and a maximum depth. These limits are computed only once for each camera, and
+    culling the pixels outside the ROI is just comparing the depth of each pixel with its limits.
+"""
+
+roi_shapes = ("none", "box", "cylinder", "height")
+
+_limits_cache = {}      # Depth limits of the pixels of each camera {(roi, rays, rotation): (min_depth, max_depth)}
+_MAX_CACHE_SIZE = 64
+
+
+def create_roi(shape="none", xy=40.0, z=(-4.0, 2.4)):
+    """
+    Create a region of interest in the ego frame (meters). The default values are the limits of the
+    voxel occupancy grid, so only the points that can be in the grid are kept.
+
+    :param shape: "box" (|X| <= xy, |Y| <= xy and z[0] <= Z <= z[1]), "cylinder" (sqrt(X² + Y²) <= xy and
+                  z[0] <= Z <= z[1]), "height" (only z[0] <= Z <= z[1]) or "none".
+    :param xy: Half of the size of the box or radius of the cylinder.
+    :param z: Minimum and maximum height.
+
+    :return: Dictionary with the shape and limits of the ROI, or None if the shape is "none".
+    """
+    if shape not in roi_shapes:
+        raise ValueError(f"Unknown ROI shape '{shape}', must be one of {roi_shapes}")
+    if shape == "none":
+        return None
+
+    return {"shape": shape, "xy": float(xy), "z": (float(z[0]), float(z[1]))}
+
+
+def _slab_limits(directions, low, high):
+    """
+    Depths where the rays (starting in the origin) enter and leave the slab low <= coordinate <= high.
+
+    :param directions: Coordinate of the direction of each ray.
+    :return: Arrays (enter, leave), (-inf, inf) for the rays parallel and inside the slab and (inf, -inf) outside.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_low = low / directions
+        t_high = high / directions
+    enter = np.minimum(t_low, t_high)
+    leave = np.maximum(t_low, t_high)
+
+    parallel = directions == 0
+    inside = low <= 0 <= high
+    enter[parallel] = -np.inf if inside else np.inf
+    leave[parallel] = np.inf if inside else -np.inf
+
+    return enter, leave
+
+
+def depth_limits(roi, rays, camera_rotation, dtype=np.float64):
+    """
+    Get the minimum and maximum depth of each pixel of a camera to be inside the ROI (cached for each camera).
+    The pixels whose ray doesn't cross the ROI have min_depth > max_depth, so they are always culled.
+
+    :param roi: Dictionary created by 'create_roi'.
+    :param rays: Rays of the pixels of the camera with shape (3, N) (see 'ground_truth._pixel_rays'),
+                 the 3D point of a pixel is its ray times its depth.
+    :param camera_rotation: Rotation (3x3) from the camera to the ego frame.
+
+    :return: Arrays (min_depth, max_depth) with shape (N,).
+    """
+    key = (roi['shape'], roi['xy'], roi['z'], id(rays), rays.shape, np.round(camera_rotation, 6).tobytes(), np.dtype(dtype).name)
+    if key not in _limits_cache:
+        if len(_limits_cache) >= _MAX_CACHE_SIZE:
+            _limits_cache.clear()
+
+        # Direction of the rays in the ego frame
+        directions = np.asarray(camera_rotation, dtype=np.float64) @ rays.astype(np.float64)
+
+        min_depth, max_depth = _slab_limits(directions[2], roi['z'][0], roi['z'][1])
+
+        if roi['shape'] == "box":
+            for axis in (0, 1):
+                enter, leave = _slab_limits(directions[axis], -roi['xy'], roi['xy'])
+                np.maximum(min_depth, enter, out=min_depth)
+                np.minimum(max_depth, leave, out=max_depth)
+
+        elif roi['shape'] == "cylinder":
+            with np.errstate(divide='ignore'):
+                leave = roi['xy'] / np.hypot(directions[0], directions[1])
+            np.minimum(max_depth, leave, out=max_depth)
+
+        # The points are in front of the camera
+        np.maximum(min_depth, 0, out=min_depth)
+
+        _limits_cache[key] = (min_depth.astype(dtype), max_depth.astype(dtype))
+
+    return _limits_cache[key]
+
+
+def inside_roi(roi, points):
+    """
+    Check which points (already in the ego frame, with shape (N, 3)) are inside the ROI.
+
+    :return: Boolean array with shape (N,).
+    """
+    inside = (points[:, 2] >= roi['z'][0]) & (points[:, 2] <= roi['z'][1])
+
+    if roi['shape'] == "box":
+        inside &= (np.abs(points[:, 0]) <= roi['xy']) & (np.abs(points[:, 1]) <= roi['xy'])
+    elif roi['shape'] == "cylinder":
+        inside &= points[:, 0] ** 2 + points[:, 1] ** 2 <= roi['xy'] ** 2
+
+    return inside
@@ -0,0 +1,214 @@
+#include <algorithm>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <limits>
+#include <vector>
+#ifdef _OPENMP
+#include <omp.h>
+#else
+static int omp_get_thread_num() { return 0; }
+static int omp_get_num_threads() { return 1; }
+static int omp_get_max_threads() { return 1; }
+#endif
+
+
+/* Voxel grid downsampling without PCL: the centroid of the points (and the mean of the colors) of each voxel, the same
+    voxels and order of pcl::VoxelGrid. The float32 arrays of the caller are read and written directly (no copies and
+    no point cloud objects) and the points are grouped by voxel with a parallel radix sort of the keys (OpenMP). */
+
+namespace {
+
+const int RADIX_BITS = 11;
+const size_t RADIX_SIZE = size_t(1) << RADIX_BITS;
+const uint64_t INDEX_MASK = 0xFFFFFFFFull;
+const uint64_t INVALID_KEY = 0xFFFFFFFFull;        // Key of the points with NaN or infinite coordinates (sorted to the end)
+
+
+// Range [begin, end) of the items of a thread. The number of threads must be the one of the team (omp_get_num_threads),
+// OpenMP can start fewer threads than requested (OMP_THREAD_LIMIT, OMP_DYNAMIC, nested regions)
+inline void thread_range(size_t n, int n_threads, int thread, size_t &begin, size_t &end) {
+    begin = n * thread / n_threads;
+    end = n * (thread + 1) / n_threads;
+}
+
+
+/* LSD radix sort of the values (voxel key << 32 | point index) by the 'key_bits' bits of the key, stable, with the
+    histograms of each digit computed by each thread in its part of the values.
+    Returns the buffer with the sorted values ('values' or 'temp'). */
+uint64_t *radix_sort(uint64_t *values, uint64_t *temp, size_t n, int key_bits, int n_threads) {
+    // Up to 'n_threads' tables (the team can be smaller), only the ones of the threads of the team are used
+    std::vector<size_t> offsets(n_threads * RADIX_SIZE);
+
+    for (int shift = 32; shift < 32 + key_bits; shift += RADIX_BITS) {
+        std::fill(offsets.begin(), offsets.end(), 0);
+
+        #pragma omp parallel num_threads(n_threads)
+        {
+            const int team = omp_get_num_threads();
+            const int thread = omp_get_thread_num();
+            size_t begin, end;
+            thread_range(n, team, thread, begin, end);
+            size_t *thread_offsets = &offsets[thread * RADIX_SIZE];
+
+            for (size_t i = begin; i < end; i++)
+                thread_offsets[(values[i] >> shift) & (RADIX_SIZE - 1)]++;
+
+            #pragma omp barrier
+            #pragma omp single
+            {
+                // Position of the first value of each digit of each thread (digits in order, then threads in order)
+                size_t position = 0;
+                for (size_t digit = 0; digit < RADIX_SIZE; digit++) {
+                    for (int t = 0; t < team; t++) {
+                        size_t count = offsets[t * RADIX_SIZE + digit];
+                        offsets[t * RADIX_SIZE + digit] = position;
+                        position += count;
+                    }
+                }
+            }
+
+            for (size_t i = begin; i < end; i++)
+                temp[thread_offsets[(values[i] >> shift) & (RADIX_SIZE - 1)]++] = values[i];
+        }
+        std::swap(values, temp);
+    }
+
+    return values;
+}
+
+}
+
+
+extern "C"{
+    int64_t voxel_downsample(const float *points, const float *colors, size_t n_points, float leaf_size,
+                             float *downsample_points, float *downsample_colors, uint64_t *scratch, int n_threads){
+        /* Downsample a point cloud with a voxel grid of `leaf_size` meters.
+        - `points`: Array (n_points, 3) float32 with the x, y, z coordinates of the points.
+        - `colors`: Array (n_points, 3) float32 with the RGB color of the points.
+        - `n_points`: The number of points of the point cloud (less than 2^32).
+        - `downsample_points`: Array (with space for `n_points`) to store the centroid of each voxel.
+        - `downsample_colors`: Array (with space for `n_points`) to store the mean color of each voxel.
+        - `scratch`: Array of 2 * `n_points` uint64 used to sort the points (reused by the caller between frames).
+        - `n_threads`: Number of threads (0 = the number of OpenMP threads).
+        Returns the number of points of the downsampled point cloud, or -1 if the grid has too many voxels (2^32). */
+
+        if (n_points == 0)
+            return 0;
+        if (n_points > INDEX_MASK)
+            return -1;
+        if (n_threads <= 0)
+            n_threads = omp_get_max_threads();
+        const float inverse_leaf = 1.0f / leaf_size;
+        const int64_t n = static_cast<int64_t>(n_points);
+
+        // Bounds of the finite points
+        float min_x = std::numeric_limits<float>::max(), min_y = min_x, min_z = min_x;
+        float max_x = std::numeric_limits<float>::lowest(), max_y = max_x, max_z = max_x;
+        #pragma omp parallel for num_threads(n_threads) reduction(min: min_x, min_y, min_z) reduction(max: max_x, max_y, max_z)
+        for (int64_t i = 0; i < n; i++) {
+            const float *p = points + 3 * i;
+            if (!std::isfinite(p[0]) || !std::isfinite(p[1]) || !std::isfinite(p[2]))
+                continue;
+            min_x = std::min(min_x, p[0]); min_y = std::min(min_y, p[1]); min_z = std::min(min_z, p[2]);
+            max_x = std::max(max_x, p[0]); max_y = std::max(max_y, p[1]); max_z = std::max(max_z, p[2]);
+        }
+        if (min_x > max_x)
+            return 0;       // No finite points
+
+        // Voxels of the grid (the same of pcl::VoxelGrid: floor of the coordinates times the inverse of the leaf size)
+        const int64_t min_bx = static_cast<int64_t>(std::floor(min_x * inverse_leaf));
+        const int64_t min_by = static_cast<int64_t>(std::floor(min_y * inverse_leaf));
+        const int64_t min_bz = static_cast<int64_t>(std::floor(min_z * inverse_leaf));
+        const int64_t div_x = static_cast<int64_t>(std::floor(max_x * inverse_leaf)) - min_bx + 1;
+        const int64_t div_y = static_cast<int64_t>(std::floor(max_y * inverse_leaf)) - min_by + 1;
+        const int64_t div_z = static_cast<int64_t>(std::floor(max_z * inverse_leaf)) - min_bz + 1;
+        if (static_cast<double>(div_x) * div_y * div_z >= static_cast<double>(INVALID_KEY))
+            return -1;
+        // Only the bits of the keys of the grid are sorted (3 passes instead of 6 of the full 32 bits in most frames)
+        int key_bits = 1;
+        while ((uint64_t(1) << key_bits) < static_cast<uint64_t>(div_x * div_y * div_z))
+            key_bits++;
+
+        // Key of the voxel of each point with the index of the point
+        uint64_t *values = scratch;
+        uint64_t *temp = scratch + n_points;
+        bool has_invalid = false;
+        #pragma omp parallel for num_threads(n_threads) reduction(||: has_invalid)
+        for (int64_t i = 0; i < n; i++) {
+            const float *p = points + 3 * i;
+            uint64_t key = INVALID_KEY;
+            if (std::isfinite(p[0]) && std::isfinite(p[1]) && std::isfinite(p[2])) {
+                int64_t ix = static_cast<int64_t>(std::floor(p[0] * inverse_leaf)) - min_bx;
+                int64_t iy = static_cast<int64_t>(std::floor(p[1] * inverse_leaf)) - min_by;
+                int64_t iz = static_cast<int64_t>(std::floor(p[2] * inverse_leaf)) - min_bz;
+                key = static_cast<uint64_t>(ix + iy * div_x + iz * div_x * div_y);
+            } else {
+                has_invalid = true;
+            }
+            values[i] = (key << 32) | static_cast<uint64_t>(i);
+        }
+        if (has_invalid)
+            key_bits = 32;      // The invalid key has all the bits, so it must be sorted with all of them
+
+        uint64_t *sorted = radix_sort(values, temp, n_points, key_bits, n_threads);
+        uint64_t *starts = (sorted == values) ? temp : values;
+
+        // The invalid points are at the end
+        size_t n_valid = n_points;
+        while (n_valid > 0 && (sorted[n_valid - 1] >> 32) == INVALID_KEY)
+            n_valid--;
+
+        // First value of each voxel, found by each thread in its part of the sorted values
+        std::vector<size_t> thread_voxels(n_threads + 1, 0);
+        int used_threads = 1;
+        #pragma omp parallel num_threads(n_threads)
+        {
+            const int team = omp_get_num_threads();
+            const int thread = omp_get_thread_num();
+            size_t begin, end;
+            thread_range(n_valid, team, thread, begin, end);
+
+            size_t count = 0;
+            for (size_t i = begin; i < end; i++)
+                count += (i == 0 || (sorted[i] >> 32) != (sorted[i - 1] >> 32));
+            thread_voxels[thread + 1] = count;
+
+            #pragma omp barrier
+            #pragma omp single
+            {
+                used_threads = team;
+                for (int t = 0; t < team; t++)
+                    thread_voxels[t + 1] += thread_voxels[t];
+            }
+
+            size_t position = thread_voxels[thread];
+            for (size_t i = begin; i < end; i++)
+                if (i == 0 || (sorted[i] >> 32) != (sorted[i - 1] >> 32))
+                    starts[position++] = i;
+        }
+        const int64_t n_voxels = static_cast<int64_t>(thread_voxels[used_threads]);
+
+        // Centroid and mean color of each voxel, written directly in the output arrays
+        #pragma omp parallel for num_threads(n_threads) schedule(static)
+        for (int64_t v = 0; v < n_voxels; v++) {
+            size_t begin = starts[v];
+            size_t end = (v + 1 < n_voxels) ? starts[v + 1] : n_valid;
+            double sum[6] = {0, 0, 0, 0, 0, 0};
+            for (size_t j = begin; j < end; j++) {
+                const size_t index = sorted[j] & INDEX_MASK;
+                for (int k = 0; k < 3; k++) {
+                    sum[k] += points[3 * index + k];
+                    sum[3 + k] += colors[3 * index + k];
+                }
+            }
+            const double inverse_count = 1.0 / static_cast<double>(end - begin);
+            for (int k = 0; k < 3; k++) {
+                downsample_points[3 * v + k] = static_cast<float>(sum[k] * inverse_count);
+                downsample_colors[3 * v + k] = static_cast<float>(sum[3 + k] * inverse_count);
+            }
+        }
+
+        return n_voxels;
+    }
+}
@@ -0,0 +1,196 @@
+from utils.ground_truth import ground_truth
+import numpy as np
+import math as mt
+
+
+"""
+    Global map of the ground truth accumulated over the frames, with sparse voxels.
+
+    Each occupied voxel is an int64 key with its 3 integer coordinates (21 bits each), saved in a sorted array
+    (not a hash table), so finding the voxels of a frame in the map is a binary search (O(k log n) for the k voxels
+    of a frame). The new voxels are inserted in a small sorted buffer ('new_keys'), merged into the sorted array in
+    batches when it grows over 1/8 of the map, so the copy of the whole map (O(n)) is amortized over many frames.
+    The voxels far from the vehicle are evicted (also the whole map, O(n)) only after the vehicle moved 10% of
+    'max_distance' since the last eviction, so the map keeps some voxels a bit farther than 'max_distance' and the
+    size of the map doesn't grow with the route.
+    The map is in the coordinates of the world used by the ground truth (Y axis inverted).
+"""
+
+_BITS = 21
+_OFFSET = 1 << (_BITS - 1)     # The coordinates are between -2^20 and 2^20 - 1 voxels
+_MASK = (1 << _BITS) - 1
+_MIN_MERGE = 1 << 16            # Minimum number of new voxels buffered before merging them into the map
+_EVICT_MARGIN = 0.1             # Distance moved by the vehicle between evictions (ratio of 'max_distance')
+
+
+def create_voxel_map(voxel_size=0.2, max_distance=100.0):
+    """
+    Create an empty voxel map.
+
+    :param voxel_size: Size of the voxels in meters.
+    :param max_distance: The voxels farther than this distance (meters, in the XY plane) from the vehicle are evicted.
+
+    :return: Dictionary with the voxels of the map.
+    """
+    return {
+        "voxel_size": voxel_size,
+        "max_distance": max_distance,
+        "keys": np.zeros(0, dtype=np.int64),        # Sorted keys of the occupied voxels
+        "hits": np.zeros(0, dtype=np.uint32),       # Number of frames where each voxel was seen occupied
+        "new_keys": np.zeros(0, dtype=np.int64),    # Sorted keys of the voxels not merged yet in 'keys'
+        "new_hits": np.zeros(0, dtype=np.uint32),
+        "evicted_at": None,                         # Position of the vehicle in the last eviction
+    }
+
+
+def pack_keys(voxel_indices):
+    """Pack the integer coordinates (N, 3) of the voxels in int64 keys (N,)."""
+
+    voxel_indices = voxel_indices.astype(np.int64) + _OFFSET
+    return (voxel_indices[:, 0] << (2 * _BITS)) | (voxel_indices[:, 1] << _BITS) | voxel_indices[:, 2]
+
+
+def unpack_keys(keys):
+    """Unpack the int64 keys (N,) of the voxels in their integer coordinates (N, 3)."""
+
+    voxel_indices = np.empty((len(keys), 3), dtype=np.int64)
+    voxel_indices[:, 0] = (keys >> (2 * _BITS)) & _MASK
+    voxel_indices[:, 1] = (keys >> _BITS) & _MASK
+    voxel_indices[:, 2] = keys & _MASK
+
+    return voxel_indices - _OFFSET
+
+
+def voxel_centers(voxel_map, keys=None):
+    """Centers (N, 3) of the voxels of the map (or of 'keys') in meters."""
+
+    keys = voxel_map['keys'] if keys is None else keys
+    return (unpack_keys(keys) + 0.5) * voxel_map['voxel_size']
+
+
+def _find(sorted_keys, keys):
+    """Position of each key (sorted) in 'sorted_keys' and if it is there."""
+
+    positions = np.searchsorted(sorted_keys, keys)
+    if len(sorted_keys) == 0:
+        return positions, np.zeros(len(keys), dtype=bool)
+
+    return positions, sorted_keys[np.minimum(positions, len(sorted_keys) - 1)] == keys
+
+
+def _insert(sorted_keys, hits, keys):
+    """Insert the keys (sorted, not in 'sorted_keys') with 1 hit, the keys stay sorted (copies both arrays)."""
+
+    positions = np.searchsorted(sorted_keys, keys)
+    return np.insert(sorted_keys, positions, keys), np.insert(hits, positions, np.uint32(1))
+
+
+def merge(voxel_map):
+    """Merge the buffer of the new voxels into the sorted keys of the map (a copy of the whole map)."""
+
+    if len(voxel_map['new_keys']):
+        voxel_map['keys'], voxel_map['hits'] = _insert(voxel_map['keys'], voxel_map['hits'], voxel_map['new_keys'])
+        voxel_map['hits'][np.searchsorted(voxel_map['keys'], voxel_map['new_keys'])] = voxel_map['new_hits']
+        voxel_map['new_keys'] = np.zeros(0, dtype=np.int64)
+        voxel_map['new_hits'] = np.zeros(0, dtype=np.uint32)
+
+
+def integrate(voxel_map, points):
+    """
+    Add the occupied voxels of a frame to the map. The voxels already in the map only increment their hits,
+    the new ones are inserted in the buffer of new voxels (merged into the map when it is big enough).
+
+    :param points: Points (N, 3) of the frame in the coordinates of the map.
+
+    :return: Number of new voxels.
+    """
+    voxel_indices = np.floor(np.asarray(points, dtype=np.float64) / voxel_map['voxel_size'])
+    keys = np.unique(pack_keys(voxel_indices))
+
+    positions, known = _find(voxel_map['keys'], keys)
+    voxel_map['hits'][positions[known]] += 1
+
+    keys = keys[~known]
+    positions, buffered = _find(voxel_map['new_keys'], keys)
+    voxel_map['new_hits'][positions[buffered]] += 1
+
+    new_keys = keys[~buffered]
+    voxel_map['new_keys'], voxel_map['new_hits'] = _insert(voxel_map['new_keys'], voxel_map['new_hits'], new_keys)
+    if len(voxel_map['new_keys']) > max(_MIN_MERGE, len(voxel_map['keys']) // 8):
+        merge(voxel_map)
+
+    return len(new_keys)
+
+
+def _x_range(voxel_map, min_x, max_x, keys='keys'):
+    """Slice of the keys with the X coordinate between 'min_x' and 'max_x' meters (X is in the highest bits, so they are contiguous)."""
+
+    voxel_size = voxel_map['voxel_size']
+    bounds = np.array([[mt.floor(min_x / voxel_size), -_OFFSET, -_OFFSET],
+                       [mt.floor(max_x / voxel_size) + 1, -_OFFSET, -_OFFSET]])
+    start, end = np.searchsorted(voxel_map[keys], pack_keys(bounds))
+
+    return slice(start, end)
+
+
+def evict(voxel_map, position, force=False):
+    """
+    Remove the voxels farther than 'max_distance' (in the XY plane) from 'position' (the vehicle), only if the
+    vehicle moved more than 10% of 'max_distance' since the last eviction (or with 'force').
+
+    :return: Number of voxels removed.
+    """
+    max_distance = voxel_map['max_distance']
+    last = voxel_map['evicted_at']
+    if not force and last is not None and np.hypot(position[0] - last[0], position[1] - last[1]) < _EVICT_MARGIN * max_distance:
+        return 0
+    voxel_map['evicted_at'] = (float(position[0]), float(position[1]))
+
+    merge(voxel_map)
+    n_voxels = len(voxel_map['keys'])
+
+    # First the voxels out of the X range (without unpacking the keys)
+    x_range = _x_range(voxel_map, position[0] - max_distance, position[0] + max_distance)
+    keys = voxel_map['keys'][x_range]
+    hits = voxel_map['hits'][x_range]
+
+    # Distance in voxels, with the integer coordinates of the voxels
+    voxel_size = voxel_map['voxel_size']
+    dx = ((keys >> (2 * _BITS)) & _MASK) - _OFFSET + 0.5 - position[0] / voxel_size
+    dy = ((keys >> _BITS) & _MASK) - _OFFSET + 0.5 - position[1] / voxel_size
+    keep = dx * dx + dy * dy <= (max_distance / voxel_size) ** 2
+    if not np.all(keep):
+        keys = keys[keep]
+        hits = hits[keep]
+
+    voxel_map['keys'] = keys
+    voxel_map['hits'] = hits
+
+    return n_voxels - len(keys)
+
+
+def extract_grid(voxel_map, origin, rotation=None, min_hits=1, **grid_options):
+    """
+    Get the occupancy grid around the vehicle from the map, with the same format of 'ground_truth.occupancy_grid_map'.
+
+    :param origin: Position (3,) of the origin of the grid in the coordinates of the map.
+    :param rotation: Rotation (3x3) from the axes of the grid to the axes of the map (None if they are the same).
+    :param min_hits: Minimum number of frames where a voxel was seen to be occupied.
+    :param grid_options: Size of the grid (see 'ground_truth.occupancy_grid_map').
+    """
+    # Only the voxels in the X range of the grid (with any rotation)
+    max_range = np.sqrt(2) * grid_options.get('max_range_X_Y', 40) + voxel_map['voxel_size']
+    keys, hits = [], []
+    for name in ('keys', 'new_keys'):
+        x_range = _x_range(voxel_map, origin[0] - max_range, origin[0] + max_range, name)
+        keys.append(voxel_map[name][x_range])
+        hits.append(voxel_map['hits' if name == 'keys' else 'new_hits'][x_range])
+    keys, hits = np.concatenate(keys), np.concatenate(hits)
+    if min_hits > 1:
+        keys = keys[hits >= min_hits]
+
+    points = voxel_centers(voxel_map, keys) - np.asarray(origin, dtype=np.float64)
+    if rotation is not None:
+        points = points @ np.asarray(rotation, dtype=np.float64)
+
+    return ground_truth.occupancy_grid_map(points, **grid_options)
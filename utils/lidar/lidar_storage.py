@@ -0,0 +1,134 @@
+import numpy as np
+
+
+"""
+    Compact storage of the lidar points with their intensity.
+
+    The coordinates are quantized to centimeters in int16 ("cm", error <= 5 mm up to 327 m) or saved in float16
+    ("float16", relative error <= 2^-11, 3.2 cm at 75 m), and the intensity (0 to 1) in uint8 (error <= 1/510).
+    So each point uses 7 bytes instead of 24 of float64 (before the compression of the .npz).
+    The file has the metadata to decode it: format, scale of the coordinates and of the intensity and error bound.
+"""
+
+LIDAR_FORMATS = ("float64", "cm", "float16")
+
+_CM_SCALE = 0.01                            # Meters of each unit of the "cm" format
+_INTENSITY_SCALE = 1.0 / 255.0
+_FLOAT16_EPSILON = 2.0 ** -11               # Maximum relative error of the rounding to float16
+
+
+def error_bound(lidar_format, max_range=75.0):
+    """Maximum error in meters of the coordinates of a format, for the points up to 'max_range' meters."""
+
+    if lidar_format == "cm":
+        return _CM_SCALE / 2
+    if lidar_format == "float16":
+        return max_range * _FLOAT16_EPSILON
+    if lidar_format == "float64":
+        return 0.0
+
+    raise ValueError(f"Unknown lidar format '{lidar_format}', must be one of {LIDAR_FORMATS}")
+
+
+def encode_lidar(points, intensity=None, lidar_format="cm"):
+    """
+    Encode the lidar points and their intensity.
+
+    :param points: Points (N, 3) in meters.
+    :param intensity: Intensity (N,) between 0 and 1 (None if it is not known).
+
+    :return: Dictionary with the arrays and the metadata (see 'save_lidar').
+    """
+    points = np.asarray(points)
+    if lidar_format == "cm":
+        quantized = np.rint(points * (1.0 / _CM_SCALE))
+        limit = np.iinfo(np.int16).max
+        if len(quantized) and np.abs(quantized).max() > limit:
+            raise ValueError(f"Points farther than {limit * _CM_SCALE:.2f} m can't be saved in centimeters (int16)")
+        encoded_points = quantized.astype(np.int16)
+        scale = _CM_SCALE
+    elif lidar_format == "float16":
+        encoded_points = points.astype(np.float16)
+        scale = 1.0
+    elif lidar_format == "float64":
+        encoded_points = points.astype(np.float64)
+        scale = 1.0
+    else:
+        raise ValueError(f"Unknown lidar format '{lidar_format}', must be one of {LIDAR_FORMATS}")
+
+    max_range = float(np.abs(points).max()) if len(points) else 0.0
+    encoded = {
+        "points": encoded_points,
+        "format": np.array(lidar_format),
+        "scale": np.float64(scale),
+        "error_bound": np.float64(error_bound(lidar_format, max_range)),
+    }
+    if intensity is not None:
+        encoded["intensity"] = np.rint(np.clip(intensity, 0, 1) * 255).astype(np.uint8)
+        encoded["intensity_scale"] = np.float64(_INTENSITY_SCALE)
+
+    return encoded
+
+
+def decode_lidar(encoded, dtype=np.float32):
+    """
+    Decode the points of 'encode_lidar' (or of a file of 'save_lidar').
+
+    :return: Points (N, 3) in meters and intensity (N,) between 0 and 1 (None if it was not saved).
+    """
+    points = encoded["points"].astype(dtype)
+    scale = float(encoded["scale"])
+    if scale != 1.0:
+        points *= dtype(scale)
+
+    intensity = None
+    if "intensity" in encoded:
+        intensity = encoded["intensity"].astype(dtype) * dtype(encoded["intensity_scale"])
+
+    return points, intensity
+
+
+def save_lidar(path, points, intensity=None, lidar_format="cm"):
+    """Save the lidar points (and intensity) in a compressed .npz file."""
+
+    np.savez_compressed(path, **encode_lidar(points, intensity, lidar_format))
+
+
+def load_lidar(path, dtype=np.float32):
+    """
+    Load the lidar points of a file of 'save_lidar' or of the old .npz files (only the float64 points in 'arr_0').
+
+    :return: Points (N, 3) in meters and intensity (N,) (None if it was not saved).
+    """
+    with np.load(path) as data:
+        if "points" not in data.files:
+            return data["arr_0"].astype(dtype, copy=False), None
+        return decode_lidar({key: data[key] for key in data.files}, dtype)
+
+
+def check_error_bound(points, intensity=None, lidar_format="cm"):
+    """
+    Check that the points (and intensity) decoded are within the error bound of the format.
+
+    :return: Maximum error of the coordinates (meters) and of the intensity.
+    """
+    encoded = encode_lidar(points, intensity, lidar_format)
+    decoded_points, decoded_intensity = decode_lidar(encoded, np.float64)
+
+    points_error = float(np.abs(decoded_points - points).max()) if len(points) else 0.0
+    # The bound of float16 is relative to each coordinate (the rounding is done in float16, tolerance of 1 ulp of float32)
+    if lidar_format == "float16":
+        bound = np.abs(np.asarray(points, dtype=np.float64)) * _FLOAT16_EPSILON
+        ok = np.all(np.abs(decoded_points - points) <= bound + 1e-7)
+    else:
+        ok = points_error <= float(encoded["error_bound"]) + 1e-9
+    if not ok:
+        raise AssertionError(f"Error of the points {points_error} m over the bound of '{lidar_format}' ({float(encoded['error_bound'])} m)")
+
+    intensity_error = 0.0
+    if intensity is not None:
+        intensity_error = float(np.abs(decoded_intensity - np.clip(intensity, 0, 1)).max()) if len(intensity) else 0.0
+        if intensity_error > _INTENSITY_SCALE / 2 + 1e-6:
+            raise AssertionError(f"Error of the intensity {intensity_error} over the bound {_INTENSITY_SCALE / 2}")
+
+    return points_error, intensity_error
@@ -0,0 +1,130 @@
+from utils.lidar import lidar_storage
+import argparse
+import multiprocessing
+import os
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Voxelize the lidar points of the captures")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder with the captures (OUT_DIR of main_dataset.py or OUT_ROOT of batch_dataset.py)', default="_out")
+parser.add_argument('-w', '--workers', type=int, help='Number of processes (0 = number of CPUs)', default=0)
+parser.add_argument('--overwrite', type=int, help='Voxelize again the frames already voxelized', default=0)
+
+
+"""
+    Lidar input grids with the same bounds and voxel size of 'ground_truth.occupancy_grid_map', so the models read
+    them without voxelizing the lidar points in every epoch.
+
+    Each occupied voxel has 3 features: number of points, mean height and mean intensity of its points.
+    Only the occupied voxels are saved (flat index in the grid and their features, without compression),
+    so a frame is a few hundreds of KB and loading it is reading the file and filling the dense grid.
+"""
+
+FEATURES = ("count", "mean_height", "mean_intensity")
+
+
+def voxelize_lidar(points, intensity=None, voxel_size=0.4, max_range_X_Y=40, min_range_Z=-4, max_range_Z=2.4):
+    """
+    Features of the voxels of the lidar points, with the voxels of 'occupancy_grid_map'.
+
+    :param points: Points (N, 3) of the lidar in the coordinates of the grid.
+    :param intensity: Intensity (N,) of each point (None if it is not known, the mean intensity is 0).
+
+    :return: Dictionary with the flat index (in the grid) of the occupied voxels and their features.
+    """
+    min_bound = np.array([-max_range_X_Y, -max_range_X_Y, min_range_Z])
+    max_bound = np.array([max_range_X_Y, max_range_X_Y, max_range_Z])
+    grid_size = np.ceil((max_bound - min_bound) / voxel_size).astype(int)
+
+    # Voxel of each point, the same of 'occupancy_grid_map' (in the type of the points)
+    points = np.asarray(points)
+    voxel_indices = np.floor((points - min_bound.astype(points.dtype)) / points.dtype.type(voxel_size)).astype(np.int64)
+    inside = np.all((voxel_indices >= 0) & (voxel_indices < grid_size), axis=1)
+    flat_indices = np.ravel_multi_index(voxel_indices[inside].T, grid_size)
+
+    # Sums of each voxel of the grid (no sorting), only the occupied voxels are kept
+    n_voxels = int(np.prod(grid_size))
+    count = np.bincount(flat_indices, minlength=n_voxels)
+    voxels = np.flatnonzero(count)
+    count = count[voxels]
+    height_sum = np.bincount(flat_indices, weights=points[inside, 2], minlength=n_voxels)[voxels]
+    if intensity is None:
+        intensity_sum = np.zeros(len(voxels))
+    else:
+        intensity_sum = np.bincount(flat_indices, weights=np.asarray(intensity)[inside], minlength=n_voxels)[voxels]
+
+    return {
+        "grid_size": grid_size,
+        "voxel_size": voxel_size,
+        "voxels": voxels.astype(np.uint32),
+        "count": np.minimum(count, np.iinfo(np.uint16).max).astype(np.uint16),
+        "mean_height": (height_sum / count).astype(np.float16),
+        "mean_intensity": (intensity_sum / count).astype(np.float16),
+    }
+
+
+def save_lidar_voxel(path, features):
+    """Save the features of 'voxelize_lidar' in a .npz file (without compression, so reading it is only I/O)."""
+
+    np.savez(path, **features)
+
+
+def densify(features, dtype=np.float32):
+    """
+    Dense grid of the features of 'voxelize_lidar' (or of a file of 'save_lidar_voxel').
+
+    :return: Array (3, X, Y, Z) with the channels of FEATURES (0 in the empty voxels).
+    """
+    grid_size = tuple(int(size) for size in features["grid_size"])
+    grid = np.zeros((len(FEATURES), int(np.prod(grid_size))), dtype=dtype)
+    voxels = features["voxels"]
+    for channel, feature in enumerate(FEATURES):
+        grid[channel, voxels] = features[feature]
+
+    return grid.reshape((len(FEATURES),) + grid_size)
+
+
+def load_lidar_voxel(path, dense=True, dtype=np.float32):
+    """
+    Load a file of 'save_lidar_voxel'.
+
+    :param dense: Return the dense grid (see 'densify') instead of the sparse features.
+    """
+    with np.load(path) as data:
+        features = {key: data[key] for key in data.files}
+
+    return densify(features, dtype) if dense else features
+
+
+def _voxelize_file(task):
+    """Task of the pool: voxelize the lidar points of one frame."""
+
+    lidar_path, out_path = task
+    points, intensity = lidar_storage.load_lidar(lidar_path)
+    save_lidar_voxel(out_path, voxelize_lidar(points, intensity))
+
+    return out_path
+
+
+def main(args):
+
+    # The captures are the folders with the lidar points of main_dataset.py
+    tasks = []
+    for root, dirs, _ in os.walk(args.in_dir):
+        if "lidar_points" not in dirs:
+            continue
+        dirs[:] = []
+        os.makedirs(os.path.join(root, "lidar_voxel"), exist_ok=True)
+        for name in sorted(os.listdir(os.path.join(root, "lidar_points"))):
+            out_path = os.path.join(root, "lidar_voxel", name)
+            if name.endswith(".npz") and (args.overwrite or not os.path.exists(out_path)):
+                tasks.append((os.path.join(root, "lidar_points", name), out_path))
+
+    print(f"Voxelizing {len(tasks)} frames...")
+    with multiprocessing.Pool(args.workers or os.cpu_count()) as pool:
+        for done, _ in enumerate(pool.imap_unordered(_voxelize_file, tasks, chunksize=8), 1):
+            if done % 100 == 0 or done == len(tasks):
+                print(f"{done}/{len(tasks)}")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,146 @@
+import numpy as np
+
+
+"""
+    Range image of the lidar: each sweep projected to an image (channels, width) with the range, intensity and a
+    mask of the valid pixels (the rays without a hit and the points dropped by CARLA are not valid).
+
+    The CARLA ray cast lidar shoots each channel at a fixed elevation (from 'upper_fov' to 'lower_fov', evenly
+    spaced) and, with a full rotation in each tick (rotation frequency 20 Hz and 0.05 s ticks), 'width' rays per channel
+    at azimuths evenly spaced from 0. So each point has its own pixel and the inverse ('range_image_to_points') only
+    loses the quantization of the range. The points must be in the frame of the sensor (the raw measurement).
+
+    Saved in a compressed .npz with the range in uint16 (2 mm), the intensity in uint8, the mask and the fov.
+"""
+
+# Same lidar of main_dataset.py (OS0: 128 channels, 2621440 points per second at 20 Hz -> 1024 points per channel)
+CHANNELS = 128
+WIDTH = 1024
+UPPER_FOV = 45.0
+LOWER_FOV = -45.0
+
+_RANGE_SCALE = 0.002                # Meters of each unit of the saved range (up to 131 m)
+_INTENSITY_SCALE = 1.0 / 255.0
+
+
+def range_image_shape(attributes):
+    """Shape (channels, width) of the range image of the attributes of a lidar blueprint (strings, like main_dataset.py)."""
+
+    channels = int(attributes['channels'])
+    points_per_sweep = float(attributes['points_per_second']) / float(attributes['rotation_frequency'])
+
+    return channels, int(round(points_per_sweep / channels))
+
+
+def points_to_range_image(points, intensity=None, channels=CHANNELS, width=WIDTH, upper_fov=UPPER_FOV, lower_fov=LOWER_FOV):
+    """
+    Project the points of a sweep to a range image. If two points fall in the same pixel the nearest one is kept.
+
+    :param points: Points (N, 3) in the frame of the sensor.
+    :param intensity: Intensity (N,) of the points (None = zeros).
+
+    :return: Dictionary with "range" (channels, width) float32 meters, "intensity" float32, "mask" bool and the fov.
+    """
+    points = np.asarray(points, dtype=np.float32)
+    distance = np.sqrt(np.einsum('ij,ij->i', points, points))
+
+    # Row of the nearest channel (the first row is the upper one) and column of the nearest azimuth
+    elevation = np.degrees(np.arcsin(np.clip(points[:, 2] / np.maximum(distance, 1e-6), -1, 1)))
+    row = np.rint((upper_fov - elevation) * ((channels - 1) / (upper_fov - lower_fov))).astype(np.int64)
+    azimuth = np.arctan2(points[:, 1], points[:, 0])
+    column = np.rint(azimuth * (width / (2 * np.pi))).astype(np.int64) % width
+
+    valid = (distance > 0) & (row >= 0) & (row < channels)
+    pixel = (row * width + column)[valid]
+    distance = distance[valid]
+
+    # Nearest point of each pixel: sorted by pixel and distance, the first one of each pixel
+    order = np.lexsort((distance, pixel))
+    pixel = pixel[order]
+    first = np.ones(len(pixel), dtype=bool)
+    first[1:] = pixel[1:] != pixel[:-1]
+    kept = order[first]
+
+    range_image = np.zeros(channels * width, dtype=np.float32)
+    range_image[pixel[first]] = distance[kept]
+    intensity_image = np.zeros(channels * width, dtype=np.float32)
+    if intensity is not None:
+        intensity_image[pixel[first]] = np.asarray(intensity, dtype=np.float32)[valid][kept]
+    mask = np.zeros(channels * width, dtype=bool)
+    mask[pixel[first]] = True
+
+    return {
+        "range": range_image.reshape(channels, width),
+        "intensity": intensity_image.reshape(channels, width),
+        "mask": mask.reshape(channels, width),
+        "upper_fov": np.float32(upper_fov),
+        "lower_fov": np.float32(lower_fov),
+    }
+
+
+def measurement_range_image(lidar_data, channels=CHANNELS, width=WIDTH, upper_fov=UPPER_FOV, lower_fov=LOWER_FOV):
+    """Range image of a carla.LidarMeasurement (the raw points are in the frame of the sensor)."""
+
+    raw = np.frombuffer(lidar_data.raw_data, dtype=np.float32).reshape(-1, 4)
+
+    return points_to_range_image(raw[:, :3], raw[:, 3], channels, width, upper_fov, lower_fov)
+
+
+def range_image_to_points(image):
+    """
+    Points of the valid pixels of a range image (in the order of the pixels, row by row).
+
+    :return: Points (M, 3) float32 in the frame of the sensor and their intensity (M,).
+    """
+    channels, width = image["range"].shape
+    upper_fov, lower_fov = float(image["upper_fov"]), float(image["lower_fov"])
+
+    row, column = np.nonzero(image["mask"])
+    distance = image["range"][row, column].astype(np.float32)
+
+    # Angles of the rays of each row and column (computed once for the image)
+    elevation = np.radians(upper_fov - np.arange(channels) * ((upper_fov - lower_fov) / (channels - 1)))
+    azimuth = np.arange(width) * (2 * np.pi / width)
+    cos_elevation = np.cos(elevation).astype(np.float32)
+
+    points = np.empty((len(row), 3), dtype=np.float32)
+    points[:, 0] = distance * cos_elevation[row] * np.cos(azimuth).astype(np.float32)[column]
+    points[:, 1] = distance * cos_elevation[row] * np.sin(azimuth).astype(np.float32)[column]
+    points[:, 2] = distance * np.sin(elevation).astype(np.float32)[row]
+
+    return points, image["intensity"][row, column]
+
+
+def save_range_image(path, image):
+    """Save a range image in a compressed .npz file (range in uint16, intensity in uint8)."""
+
+    range_units = np.rint(image["range"] * (1.0 / _RANGE_SCALE))
+    np.savez_compressed(
+        path,
+        range=np.clip(range_units, 0, np.iinfo(np.uint16).max).astype(np.uint16),
+        intensity=np.rint(np.clip(image["intensity"], 0, 1) * 255).astype(np.uint8),
+        mask=image["mask"],
+        range_scale=np.float64(_RANGE_SCALE),
+        intensity_scale=np.float64(_INTENSITY_SCALE),
+        upper_fov=np.float32(image["upper_fov"]),
+        lower_fov=np.float32(image["lower_fov"]),
+    )
+
+
+def decode_range_image(data):
+    """Range image of the arrays of a file of 'save_range_image' (dictionary or np.load)."""
+
+    return {
+        "range": data["range"].astype(np.float32) * np.float32(data["range_scale"]),
+        "intensity": data["intensity"].astype(np.float32) * np.float32(data["intensity_scale"]),
+        "mask": data["mask"],
+        "upper_fov": np.float32(data["upper_fov"]),
+        "lower_fov": np.float32(data["lower_fov"]),
+    }
+
+
+def load_range_image(path):
+    """Load a range image of 'save_range_image'."""
+
+    with np.load(path) as data:
+        return decode_range_image(data)
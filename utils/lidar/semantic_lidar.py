@@ -0,0 +1,101 @@
+import numpy as np
+
+
+"""
+    Semantic lidar (sensor.lidar.ray_cast_semantic) without copies and without ASCII files.
+
+    The raw data of a SemanticLidarMeasurement is an array of 24 bytes per point (x, y, z, cos_angle as float32 and
+    object index, semantic tag as uint32), so it is read as a structured array that uses the same memory of the
+    measurement, and saved as a binary .npy file (24 bytes per point, loaded with the same fields).
+    The points are in the frame of the sensor (X forward, Y right, Z up), 'ego_points' gives them in the
+    ego frame of the voxel grids (X forward, Y left, Z up).
+"""
+
+SEMANTIC_LIDAR_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('cos_angle', '<f4'),       # Cosine of the angle between the ray and the normal of the surface hit
+    ('object_idx', '<u4'),      # Id of the actor hit (0 if it is not an actor)
+    ('semantic_tag', '<u4'),    # Semantic tag of the object hit (CARLA tags, 0 = unlabeled)
+])
+
+EMPTY = 255     # Label of the voxels without points in the semantic occupancy grid
+
+
+def semantic_points(measurement):
+    """
+    Decode the raw data of a semantic lidar measurement as a structured array, without copying it
+    (the array is read only and uses the memory of the measurement, so keep the measurement while it is used).
+
+    :param measurement: carla.SemanticLidarMeasurement (or anything with the same 'raw_data').
+    :return: Structured array (N,) with the fields of SEMANTIC_LIDAR_DTYPE.
+    """
+    return np.frombuffer(measurement.raw_data, dtype=SEMANTIC_LIDAR_DTYPE)
+
+
+def ego_points(points, dtype=np.float32):
+    """Coordinates (N, 3) of the points in the ego frame (X forward, Y left, Z up), the Y axis of the sensor is inverted."""
+
+    xyz = np.empty((len(points), 3), dtype=dtype)
+    xyz[:, 0] = points['x']
+    np.negative(points['y'], out=xyz[:, 1])
+    xyz[:, 2] = points['z']
+
+    return xyz
+
+
+def save_semantic_lidar(path, points):
+    """Save the points (structured array of 'semantic_points') in a binary .npy file."""
+
+    np.save(path, points, allow_pickle=False)
+
+
+def load_semantic_lidar(path, mmap=True):
+    """
+    Load the points saved by 'save_semantic_lidar'.
+
+    :param mmap: Map the file instead of reading it (only the fields used are read from the disk).
+    :return: Structured array (N,) with the fields of SEMANTIC_LIDAR_DTYPE.
+    """
+    return np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+
+def semantic_occupancy_grid(points, semantic_tags, voxel_size=0.4, max_range_X_Y=40, min_range_Z=-4, max_range_Z=2.4):
+    """
+    Semantic occupancy grid with the same size and coordinates of 'ground_truth.occupancy_grid_map': the label of
+    each voxel is the semantic tag of most of its points (the lowest tag if there is a tie) and EMPTY without points.
+
+    :param points: Points (N, 3) in the coordinates of the grid (see 'ego_points').
+    :param semantic_tags: Semantic tag (N,) of each point.
+
+    :return: Grid (uint8) with the label of each voxel.
+    """
+    min_bound = np.array([-max_range_X_Y, -max_range_X_Y, min_range_Z])
+    max_bound = np.array([max_range_X_Y, max_range_X_Y, max_range_Z])
+    grid_size = np.ceil((max_bound - min_bound) / voxel_size).astype(int)
+
+    labels = np.full(grid_size, EMPTY, dtype=np.uint8)
+
+    # Voxel of each point, the same of 'occupancy_grid_map' (in the type of the points)
+    points = np.asarray(points)
+    voxel_indices = np.floor((points - min_bound.astype(points.dtype)) / points.dtype.type(voxel_size)).astype(np.int64)
+    inside = np.all((voxel_indices >= 0) & (voxel_indices < grid_size), axis=1)
+    if not np.any(inside):
+        return labels
+
+    # Number of points of each (voxel, tag), the keys are sorted by voxel and then by tag
+    flat_indices = np.ravel_multi_index(voxel_indices[inside].T, grid_size)
+    keys, counts = np.unique(flat_indices * 256 + np.asarray(semantic_tags)[inside].astype(np.int64), return_counts=True)
+    voxels = keys >> 8
+    tags = keys & 255
+
+    # The (voxel, tag) with more points is the first of each voxel (the sort is stable, so the lowest tag wins the ties)
+    order = np.lexsort((-counts, voxels))
+    voxels = voxels[order]
+    first = np.ones(len(voxels), dtype=bool)
+    first[1:] = voxels[1:] != voxels[:-1]
+
+    labels.ravel()[voxels[first]] = tags[order][first]
+
+    return labels
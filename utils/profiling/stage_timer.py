@@ -0,0 +1,162 @@
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+
+"""
+    Timing of the stages of the capture loop.
+
+    The stages are measured with 'with stage_timer.stage("name"):' and do nothing while the profiling is disabled.
+    The stages can be nested, the time saved per frame for each stage is its own time (without the nested stages),
+    so the sum of the stages of a frame is the time of the frame.
+    Optionally, the peak memory of each frame is measured with tracemalloc (numpy arrays and Python objects,
+    not the memory allocated inside the c++ code).
+"""
+
+_profile = {
+    "enabled": False,
+    "start": 0.0,       # perf_counter when the profiling was enabled (origin of the trace)
+    "frame": None,      # Current frame, the stages are saved in this frame
+    "memory": None,     # {frame: peak memory in MB} if the memory is measured
+    "frames": {},       # {frame: {stage: milliseconds}}
+    "stages": [],       # Names of the stages in the order they appear
+    "events": [],       # Events of the Chrome trace
+}
+_lock = threading.Lock()
+_thread = threading.local()
+
+
+def enable_profiling(memory=False):
+    """
+    Enable the profiling and clear the times measured before.
+
+    :param memory: If True, also measure the peak memory of each frame (slower).
+    """
+    with _lock:
+        _profile.update(enabled=True, start=time.perf_counter(), frame=None, frames={}, stages=[], events=[],
+                        memory={} if memory else None)
+    if memory:
+        tracemalloc.start()
+
+
+def disable_profiling():
+    _save_peak_memory()
+    if _profile['memory'] is not None:
+        tracemalloc.stop()
+    _profile['enabled'] = False
+
+
+def _save_peak_memory():
+    """Save the peak memory since the last call as the peak memory of the current frame."""
+
+    if not _profile['enabled'] or _profile['memory'] is None or _profile['frame'] is None:
+        return
+    _, peak = tracemalloc.get_traced_memory()
+    _profile['memory'][_profile['frame']] = peak / 1e6
+    # Restart the peak (tracemalloc.reset_peak only exists in Python >= 3.9)
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+def set_frame(frame):
+    """Set the frame where the next stages are saved."""
+
+    _save_peak_memory()
+    _profile['frame'] = frame
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager to measure the time of a stage of the current frame.
+
+    :param name: Name of the stage, e.g. "tick", "downsample"...
+    """
+    if not _profile['enabled']:
+        yield
+        return
+
+    # Stack of the stages running in this thread, each entry has the time of its nested stages
+    stack = _thread.__dict__.setdefault('stack', [])
+    frame = _profile['frame']
+    stack.append([0.0])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        nested_time = stack.pop()[0]
+        if stack:
+            stack[-1][0] += duration
+
+        with _lock:
+            if name not in _profile['stages']:
+                _profile['stages'].append(name)
+            frame_stages = _profile['frames'].setdefault(frame, {})
+            frame_stages[name] = frame_stages.get(name, 0.0) + (duration - nested_time) * 1000
+            _profile['events'].append({
+                "name": name, "cat": "stage", "ph": "X",
+                "ts": (start - _profile['start']) * 1e6, "dur": duration * 1e6,
+                "pid": os.getpid(), "tid": threading.get_ident(), "args": {"frame": frame},
+            })
+
+
+def export_profile(out_dir):
+    """
+    Save the times of the stages per frame in 'stages.csv' (milliseconds) and the trace of all the stages
+    in 'trace.json' (open in chrome://tracing or https://ui.perfetto.dev).
+
+    :param out_dir: Folder to save the files.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    with _lock:
+        stages = list(_profile['stages'])
+        frames = dict(_profile['frames'])
+        events = list(_profile['events'])
+        memory = _profile['memory']
+
+    with open(f"{out_dir}/stages.csv", 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["frame"] + stages + ["total"] + (["peak_memory_mb"] if memory is not None else []))
+        for frame, frame_stages in frames.items():
+            times = [frame_stages.get(name, 0.0) for name in stages]
+            peak = [f"{memory.get(frame, 0.0):.1f}"] if memory is not None else []
+            writer.writerow([frame] + [f"{t:.3f}" for t in times] + [f"{sum(times):.3f}"] + peak)
+
+    with open(f"{out_dir}/trace.json", 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    print(f"Profile saved in {out_dir}/stages.csv and {out_dir}/trace.json")
+
+
+def print_summary():
+    """Print the p50, p95 and max time (milliseconds) of each stage over all the frames (and of the peak memory)."""
+
+    with _lock:
+        stages = list(_profile['stages'])
+        frames = list(_profile['frames'].values())
+        memory = _profile['memory']
+
+    if not frames:
+        return
+
+    print(f"\n{'Stage':<28}{'p50 (ms)':>10}{'p95 (ms)':>10}{'max (ms)':>10}")
+    totals = np.zeros(len(frames))
+    for name in stages:
+        times = np.array([frame_stages.get(name, 0.0) for frame_stages in frames])
+        totals += times
+        print(f"{name:<28}{np.percentile(times, 50):>10.2f}{np.percentile(times, 95):>10.2f}{times.max():>10.2f}")
+    print(f"{'total':<28}{np.percentile(totals, 50):>10.2f}{np.percentile(totals, 95):>10.2f}{totals.max():>10.2f}")
+
+    if memory:
+        peaks = np.array(list(memory.values()))
+        print(f"{'peak memory (MB)':<28}{np.percentile(peaks, 50):>10.1f}{np.percentile(peaks, 95):>10.1f}{peaks.max():>10.1f}")
@@ -36,7 +36,15 @@ def set_traffic_light_timings(world, green_time=10.0, yellow_time=2.0, red_time=
         light.set_red_time(red_time)
 
 
-def setup_carla(map):
+def connect_client(host='localhost', port=2000, timeout=10.0):
+    """
+    Connect to a CARLA server. The returned client can be reused to run several jobs
+    (and load several maps) on the same server without reconnecting.
+    
+    :param host: Host of the CARLA server.
+    :param port: RPC port of the CARLA server (each server also uses port+1 for streaming).
+    :param timeout: Timeout in seconds of the client requests.
+    """
     try:
         sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
             sys.version_info.major,
@@ -45,24 +53,39 @@ def setup_carla(map):
     except IndexError:
         pass
 
-    client = carla.Client('localhost', 2000)
-    client.set_timeout(10.0)
+    client = carla.Client(host, port)
+    client.set_timeout(timeout)
+    
+    return client
+
+
+def setup_carla(map, client=None, tm_port=8000):
+    """
+    Get the world of the server (loading the map only if it is not the current one),
+    the blueprint library and the traffic manager, and apply the server settings.
+    
+    :param map: Name of the map to use, e.g. "Town01_Opt".
+    :param client: A client from 'connect_client', if None a new one is created on the default port.
+    :param tm_port: Port of the traffic manager (must be different for each server on the same host).
+    """
+    if client is None:
+        client = connect_client()
 
     world = client.get_world()
 
     
     if not world.get_map().name == 'Carla/Maps/' + map:
         print(f"Current world: {world.get_map().name}... loading {map}...")
-        client.load_world(map)
+        world = client.load_world(map)
     print(f"Current world: {world.get_map().name}")
     
         
     # To edit the traffic 
-    traffic_manager = client.get_trafficmanager(8000)
+    traffic_manager = client.get_trafficmanager(tm_port)
 
     blueprint_library = world.get_blueprint_library()
     
     server_settings(world)
     set_traffic_light_timings(world)
 
-    return world, blueprint_library, traffic_manager
\ No newline at end of file
+    return world, blueprint_library, traffic_manager
@@ -23,7 +23,7 @@ def spawn_vehicle_route(world, blueprint_library, traffic_manager, route_map, ro
     
     
     # spawn the vehicle at the starting point
-    vehicle = spawn_vehicle(world, blueprint_library, start_point=route_indices[0])
+    vehicle = spawn_vehicle(world, blueprint_library, traffic_manager, start_point=route_indices[0])
     print("Vehicle spawned!")
     
     
@@ -41,15 +41,17 @@ def spawn_vehicle_route(world, blueprint_library, traffic_manager, route_map, ro
     return vehicle, spawn_points[route_indices[0]]
 
 
-def spawn_vehicle(world, blueprint_library, start_point=random.randint(0, 30)):
+def spawn_vehicle(world, blueprint_library, traffic_manager, start_point=random.randint(0, 30)):
     # Get the blueprint for the vehicle - Tesla Model 3
     bp = blueprint_library.filter('model3')[0]
+    bp.set_attribute('role_name', 'hero')   # Ego vehicle of the traffic manager (hybrid physics mode)
     
     # Get the spawn point
     transform = world.get_map().get_spawn_points()[start_point]
     
     vehicle = world.spawn_actor(bp, transform)
     
-    vehicle.set_autopilot(True)
+    # Driven by the traffic manager of this server (tm_port), not the default one of port 8000
+    vehicle.set_autopilot(True, traffic_manager.get_port())
     
     return vehicle
\ No newline at end of file
@@ -0,0 +1,332 @@
+from utils.lidar import lidar_storage
+import argparse
+import collections
+import glob
+import os
+import queue
+import re
+import threading
+import time
+import numpy as np
+import open3d as o3d
+
+parser = argparse.ArgumentParser(description="Play the frames of a capture")
+parser.add_argument('-i', '--in_dir', type=str, help='Folder with the data of the capture (OUT_DIR of main_dataset.py)', default="_out")
+parser.add_argument('-s', '--streams', type=str, nargs='+', help='Data to show in each frame', default=["voxel", "lidar"], choices=["voxel", "lidar", "ground_truth", "map", "labels"])
+parser.add_argument('--fps', type=float, help='Frames per second of the playback', default=10.0)
+parser.add_argument('--start', type=int, help='Index of the first frame', default=0)
+parser.add_argument('--max_points', type=int, help='Maximum number of points of each point cloud (level of detail 0, each level has 4 times less points)', default=500_000)
+parser.add_argument('--cache', type=int, help='Number of frames kept in the cache (decoded with their geometry)', default=64)
+parser.add_argument('--prefetch', type=int, help='Number of frames loaded ahead in the background', default=8)
+parser.add_argument('--loop', type=int, help='Start again after the last frame', default=1)
+
+
+"""
+    Viewer of the captures of main_dataset.py, playing the frames at a target frame rate.
+
+    The frames ahead of the one shown are decoded (and their geometry built) by a background thread, and kept
+    in a LRU cache with the ones already shown, so going back and forth doesn't read the files again.
+    The point clouds are subsampled to a maximum number of points (level of detail), and the voxel grids are
+    shown as the points of the centers of the occupied voxels (built from the .npz without a VoxelGrid).
+
+    Keys: SPACE = pause/play, RIGHT/LEFT = next/previous frame (paused), +/- = more/less detail, Q/ESC = quit.
+"""
+
+# Folder and file pattern of each stream
+STREAMS = {
+    "voxel": ("ground_truth_voxel", "*.npz"),
+    "map": ("ground_truth_map", "*.npz"),
+    "labels": ("ground_truth_labels", "*.npz"),
+    "lidar": ("lidar_points", "*.npz"),
+    "ground_truth": ("ground_truth", "*.ply"),
+}
+
+VOXEL_SIZE = 0.4
+GRID_MIN_BOUND = np.array([-40, -40, -4])    # Same limits of 'ground_truth.occupancy_grid_map'
+
+_FRAME_NUMBER = re.compile(r'_?(\d+)\.\w+$')
+
+
+def list_frames(in_dir, streams):
+    """
+    Find the files of each frame of the capture, matched by the frame number at the end of the file names
+    (only the frames with a file of every stream).
+
+    :return: List (sorted by frame number) of dictionaries {stream: path}.
+    """
+    frames = None
+    stream_files = {}
+    for stream in streams:
+        folder, pattern = STREAMS[stream]
+        files = {}
+        for path in glob.glob(os.path.join(in_dir, folder, pattern)):
+            match = _FRAME_NUMBER.search(os.path.basename(path))
+            if match:
+                files[int(match.group(1))] = path
+        frames = files.keys() if frames is None else frames & files.keys()
+        stream_files[stream] = files
+
+    return [{stream: stream_files[stream][number] for stream in streams} for number in sorted(frames or [])]
+
+
+def subsample(points, max_points, colors=None):
+    """
+    Level of detail: keep at most 'max_points' points, taking one of every N points
+    (the points of a capture are ordered by the camera or the laser, so the result is evenly spread).
+    """
+    if max_points <= 0 or len(points) <= max_points:
+        return points, colors
+
+    step = -(-len(points) // max_points)
+    return points[::step], (None if colors is None else colors[::step])
+
+
+def height_colors(points, min_z=-4.0, max_z=2.4):
+    """Colors (N, 3) of the points by their height (blue low, red high)."""
+
+    height = np.clip((points[:, 2] - min_z) / (max_z - min_z), 0, 1)[:, None]
+    return height * np.array([1.0, 0.2, 0.0]) + (1 - height) * np.array([0.0, 0.4, 1.0])
+
+
+def voxel_points(voxel_grid, value=None):
+    """Centers (N, 3) of the voxels of a grid (all non zero voxels, or the ones with 'value'), in the coordinates of the points."""
+
+    indices = np.argwhere(voxel_grid if value is None else voxel_grid == value)
+    return (indices + 0.5) * VOXEL_SIZE + GRID_MIN_BOUND
+
+
+def load_stream(stream, path, max_points):
+    """
+    Decode the file of a stream and build its geometry.
+
+    :return: o3d.geometry.PointCloud.
+    """
+    colors = None
+    if stream in ("voxel", "map"):
+        points = voxel_points(np.load(path)['arr_0'])
+        colors = height_colors(points)
+    elif stream == "labels":
+        labels = np.load(path)['arr_0']
+        # Occupied in the colors of the height, free in light gray (the unknown voxels are not shown)
+        occupied, free = voxel_points(labels, 1), voxel_points(labels, 2)
+        points = np.vstack([occupied, free])
+        colors = np.vstack([height_colors(occupied), np.full((len(free), 3), 0.85)])
+    elif stream == "lidar":
+        points, _ = lidar_storage.load_lidar(path)
+    else:
+        cloud = o3d.io.read_point_cloud(path)
+        points = np.asarray(cloud.points)
+        colors = np.asarray(cloud.colors) if cloud.has_colors() else None
+
+    points, colors = subsample(points, max_points, colors)
+    if colors is None:
+        colors = np.broadcast_to([0.1, 0.1, 0.8], points.shape)     # BLUE like the lidar of main_dataset.py
+
+    geometry = o3d.geometry.PointCloud()
+    geometry.points = o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64))
+    geometry.colors = o3d.utility.Vector3dVector(np.asarray(colors, dtype=np.float64))
+
+    return geometry
+
+
+def create_cache(frames, max_frames=64, prefetch=8):
+    """
+    Create the LRU cache of the decoded frames and start the thread that loads the frames ahead.
+
+    :param frames: List of 'list_frames'.
+    :return: Dictionary with the state of the cache (see 'get_frame').
+    """
+    cache = {
+        "frames": frames,
+        "max_frames": max_frames,
+        "prefetch": prefetch,
+        "entries": collections.OrderedDict(),   # {(index, max_points): [geometries]} from the least to the most recently used
+        "loading": {},                          # {(index, max_points): threading.Event} of the frames being loaded
+        "lock": threading.Lock(),
+        "requests": queue.Queue(),
+        "hits": 0,
+        "misses": 0,
+    }
+    thread = threading.Thread(target=_prefetch_worker, args=(cache,), daemon=True)
+    thread.start()
+    cache["thread"] = thread
+
+    return cache
+
+
+def _load_frame(cache, key):
+    """Load a frame in the cache (only once, if it is already being loaded wait for it)."""
+
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            return cache["entries"][key]
+        event = cache["loading"].get(key)
+        owner = event is None
+        if owner:
+            event = cache["loading"][key] = threading.Event()
+
+    if not owner:
+        event.wait()
+        with cache["lock"]:
+            geometries = cache["entries"].get(key)
+        # Load it again if it failed in the other thread
+        return geometries if geometries is not None else _load_frame(cache, key)
+
+    index, max_points = key
+    try:
+        geometries = [load_stream(stream, path, max_points) for stream, path in cache["frames"][index].items()]
+        with cache["lock"]:
+            cache["entries"][key] = geometries
+            while len(cache["entries"]) > cache["max_frames"]:
+                cache["entries"].popitem(last=False)
+    finally:
+        with cache["lock"]:
+            del cache["loading"][key]
+        event.set()
+
+    return geometries
+
+
+def _prefetch_worker(cache):
+    """Background thread: load the requested frames that are not in the cache."""
+
+    while True:
+        key = cache["requests"].get()
+        if key is None:
+            break
+        with cache["lock"]:
+            cached = key in cache["entries"] or key in cache["loading"]
+        if not cached:
+            try:
+                _load_frame(cache, key)
+            except Exception as error:
+                print(f"Failed to load frame {key[0]}: {error}")
+
+
+def get_frame(cache, index, max_points):
+    """
+    Get the geometries of a frame (from the cache or loading it now) and request the next frames to the prefetch thread.
+
+    :return: List with one o3d.geometry.PointCloud for each stream.
+    """
+    key = (index, max_points)
+    with cache["lock"]:
+        hit = key in cache["entries"]
+        cache["hits" if hit else "misses"] += 1
+
+    geometries = _load_frame(cache, key)
+
+    # Only the frames that are not requested yet (the queue stays short when the playback is faster than the loading)
+    n_frames = len(cache["frames"])
+    if cache["requests"].qsize() < cache["prefetch"]:
+        for next_index in range(index + 1, index + 1 + cache["prefetch"]):
+            cache["requests"].put((next_index % n_frames, max_points))
+
+    return geometries
+
+
+def close_cache(cache):
+    """Stop the prefetch thread."""
+
+    cache["requests"].put(None)
+    cache["thread"].join(timeout=1.0)
+
+
+def play(cache, fps=10.0, start=0, max_points=500_000, loop=True):
+    """
+    Show the frames in a window at 'fps' frames per second (see the keys in the docstring of the module).
+
+    :return: Number of frames shown.
+    """
+    frames = cache["frames"]
+    state = {"index": start, "paused": False, "lod": 0, "quit": False, "step": 0}
+
+    def toggle_pause(vis):
+        state["paused"] = not state["paused"]
+        return False
+
+    def step(direction):
+        def callback(vis):
+            state["step"] = direction
+            return False
+        return callback
+
+    def change_lod(delta):
+        def callback(vis):
+            state["lod"] = max(0, state["lod"] + delta)
+            print(f"Level of detail {state['lod']}: {max_points // 4 ** state['lod'] if max_points > 0 else 'all'} points")
+            return False
+        return callback
+
+    def close(vis):
+        state["quit"] = True
+        return False
+
+    vis = o3d.visualization.VisualizerWithKeyCallback()
+    vis.create_window(window_name="Viewer")
+    vis.register_key_callback(ord(" "), toggle_pause)
+    vis.register_key_callback(262, step(1))        # RIGHT
+    vis.register_key_callback(263, step(-1))       # LEFT
+    vis.register_key_callback(ord("="), change_lod(-1))
+    vis.register_key_callback(ord("-"), change_lod(1))
+    vis.register_key_callback(ord("Q"), close)
+    vis.register_key_callback(256, close)          # ESC
+
+    shown = 0
+    current = None
+    period = 1.0 / fps
+    next_time = time.perf_counter()
+    while not state["quit"]:
+        level_points = max_points // 4 ** state["lod"] if max_points > 0 else 0
+        key = (state["index"], level_points)
+
+        if key != current:
+            geometries = get_frame(cache, *key)
+            vis.clear_geometries()
+            for geometry in geometries:
+                vis.add_geometry(geometry, reset_bounding_box=current is None)
+            current = key
+            shown += 1
+            print(f"\rFrame {state['index'] + 1}/{len(frames)} | cache hits: {cache['hits']} misses: {cache['misses']}", end="")
+
+        if not vis.poll_events():
+            break
+        vis.update_renderer()
+
+        # Next frame at the target frame rate (or when a key is pressed in pause)
+        now = time.perf_counter()
+        if state["step"]:
+            state["index"] = (state["index"] + state["step"]) % len(frames)
+            state["step"] = 0
+        elif not state["paused"] and now >= next_time:
+            next_time = max(next_time + period, now)
+            if state["index"] + 1 >= len(frames) and not loop:
+                break
+            state["index"] = (state["index"] + 1) % len(frames)
+        else:
+            time.sleep(min(0.005, max(0.0, next_time - now)))
+
+    vis.destroy_window()
+    print()
+
+    return shown
+
+
+def main(args):
+
+    frames = list_frames(args.in_dir, args.streams)
+    if not frames:
+        print(f"No frames with {args.streams} in {args.in_dir}")
+        return
+    print(f"{len(frames)} frames with {args.streams}")
+
+    cache = create_cache(frames, args.cache, args.prefetch)
+    try:
+        play(cache, args.fps, min(args.start, len(frames) - 1), args.max_points, bool(args.loop))
+    finally:
+        close_cache(cache)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
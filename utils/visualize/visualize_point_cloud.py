@@ -1,5 +1,6 @@
 import open3d as o3d
 from open3d import visualization
+import numpy as np
 import glob 
 import argparse
 
@@ -23,7 +24,15 @@ def main():
         lidar_cloud = o3d.io.read_point_cloud(glob.glob('../../_out/lidar/*.ply')[0])        # Lidar
         visualization.draw_geometries([lidar_cloud])    # Visualize point cloud
     elif args.segmentation:
-        lidarSegm_cloud = o3d.io.read_point_cloud(glob.glob('../../_out/lidarSegm/*.ply')[0])    # Segmentation
+        segm_files = glob.glob('../../_out/lidarSegm/*.npy')
+        if segm_files:
+            # Binary semantic lidar (fields x, y, z, cos_angle, object_idx and semantic_tag), colored by the semantic tag
+            points = np.load(segm_files[0], mmap_mode='r')
+            lidarSegm_cloud = o3d.geometry.PointCloud()
+            lidarSegm_cloud.points = o3d.utility.Vector3dVector(np.stack([points['x'], -points['y'], points['z']], axis=1).astype(np.float64))
+            lidarSegm_cloud.colors = o3d.utility.Vector3dVector(np.random.default_rng(0).random((256, 3))[points['semantic_tag']])
+        else:
+            lidarSegm_cloud = o3d.io.read_point_cloud(glob.glob('../../_out/lidarSegm/*.ply')[0])    # Segmentation
         visualization.draw_geometries([lidarSegm_cloud])    # Visualize point cloud
     
     